@@ -12,9 +12,13 @@ from datetime import timedelta
 import configargparse
 
 from . import bot
+from . import cache
 from . import interval
+from . import metrics
+from . import ratelimit
 from . import gitlab
 from . import user as user_module
+from . import webhook
 
 
 class MargeBotCliArgError(Exception):
@@ -30,7 +34,7 @@ def time_interval(str_interval):
         raise configargparse.ArgumentTypeError('Invalid time interval (e.g. 12[s|min|h]): %s' % str_interval)
 
 
-def _parse_config(args):
+def _parse_config(args):  # pylint: disable=too-many-statements,too-many-branches
 
     def regexp(str_regex):
         try:
@@ -129,6 +133,44 @@ def _parse_config(args):
         action='store_true',
         help='Enable processing MRs in batches\n',
     )
+    parser.add_argument(
+        '--max-batch-size',
+        type=int,
+        default=None,
+        metavar='N',
+        help=(
+            'Never batch more than N MRs. Below that, batch sizes adapt to how often past batches\n'
+            'failed CI, so as to merge as many MRs per pipeline as possible.\n'
+        ),
+    )
+    parser.add_argument(
+        '--batch-stats-file',
+        type=str,
+        default=None,
+        metavar='PATH',
+        help=(
+            'Adapt batch sizes to how often past batches failed CI (see --max-batch-size), and\n'
+            'keep track of those in this file, so that they are not forgotten on restarts.\n'
+        ),
+    )
+    parser.add_argument(
+        '--batch-bisect',
+        action='store_true',
+        help=(
+            'When CI fails for a batch, find the first MR to break it by testing shorter batches,\n'
+            'a few at a time, and merge the MRs ahead of it (requires --batch).\n'
+        ),
+    )
+    parser.add_argument(
+        '--merge-train-depth',
+        type=int,
+        default=0,
+        metavar='N',
+        help=(
+            'Merge MRs one by one, but whilst CI runs for one, already test up to N-1 of the ones\n'
+            'behind it, each on top of those ahead of it. 0 (the default) disables merge trains.\n'
+        ),
+    )
     parser.add_argument(
         '--add-part-of',
         action='store_true',
@@ -203,6 +245,166 @@ def _parse_config(args):
         default='.*',
         help='Only process MRs whose source branches match the given regular expression.\n',
     )
+    parser.add_argument(
+        '--api-pool-size',
+        type=int,
+        default=10,
+        help='How many per-host pools of keep-alive connections to GitLab to keep.\n',
+    )
+    parser.add_argument(
+        '--api-max-connections',
+        type=int,
+        default=10,
+        help='Maximum number of keep-alive connections to keep open to a single GitLab host.\n',
+    )
+    parser.add_argument(
+        '--api-page-workers',
+        type=int,
+        default=4,
+        help='How many pages of a GitLab listing to fetch concurrently.\n',
+    )
+    parser.add_argument(
+        '--api-cache-size',
+        type=int,
+        default=0,
+        help=(
+            'How many GitLab responses to remember and revalidate with conditional requests\n'
+            '(ETag/If-None-Match). 0 disables the cache.\n'
+        ),
+    )
+    parser.add_argument(
+        '--api-max-retries',
+        type=int,
+        default=3,
+        help=(
+            'How many times to retry GitLab API calls that time out or fail with a 429 or 5xx,\n'
+            'before giving up. Only calls that are safe to repeat are retried.\n'
+        ),
+    )
+    parser.add_argument(
+        '--api-retry-backoff',
+        type=time_interval,
+        default='1s',
+        help='Initial delay between retries of GitLab API calls; it doubles (with jitter) on each retry.\n',
+    )
+    parser.add_argument(
+        '--api-rate-limit',
+        type=float,
+        default=None,
+        metavar='REQUESTS_PER_SEC',
+        help=(
+            'Never make more GitLab API calls per second than this (on average); 0 means no limit.\n'
+            'Regardless, marge paces itself according to the RateLimit-* headers GitLab sends.\n'
+        ),
+    )
+    parser.add_argument(
+        '--api-rate-limit-burst',
+        type=int,
+        default=10,
+        help='How many GitLab API calls can be made in a burst before rate limiting kicks in.\n',
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=None,
+        metavar='PORT',
+        help='Export GitLab API call counts and latencies for Prometheus over HTTP on this port.\n',
+    )
+    parser.add_argument(
+        '--discovery',
+        default='projects',
+        choices=('projects', 'assigned'),
+        help=(
+            'How to look for work: list the MRs of each project marge is a member of (projects),\n'
+            'or list all MRs assigned to marge at once, and only visit their projects (assigned).\n'
+        ),
+    )
+    parser.add_argument(
+        '--project-refresh-interval',
+        type=time_interval,
+        default='0s',
+        help=(
+            'How often to list all projects marge is a member of. In between, only the projects\n'
+            'with recent activity are listed, and checked for MRs right away. Note that assigning\n'
+            'an MR to marge does not count as project activity, so it may be picked up only when\n'
+            'the project is next due. 0 lists all projects every time.\n'
+        ),
+    )
+    parser.add_argument(
+        '--max-project-poll-interval',
+        type=time_interval,
+        default='2min',
+        help=(
+            'Projects in which there was nothing to do are checked less and less often, down to\n'
+            'this often. Those with MRs to handle are checked every few seconds.\n'
+        ),
+    )
+    parser.add_argument(
+        '--project-workers',
+        type=int,
+        default=1,
+        metavar='N',
+        help=(
+            'How many projects to merge MRs in at the same time; e.g. to not keep all other\n'
+            'projects waiting whilst CI runs in one of them. Each project gets its own clone.\n'
+        ),
+    )
+    parser.add_argument(
+        '--adaptive-ci-polling',
+        action='store_true',
+        help=(
+            'Poll CI status based on how long pipelines usually take in each project:\n'
+            'rarely at first, and more often when they should be about to finish.\n'
+        ),
+    )
+    parser.add_argument(
+        '--webhook-port',
+        type=int,
+        default=None,
+        metavar='PORT',
+        help=(
+            'Receive GitLab merge request, pipeline and push webhooks on this port, to react to\n'
+            'them right away. Polling then only happens every --webhook-poll-interval.\n'
+        ),
+    )
+    parser.add_argument(
+        '--webhook-secret',
+        type=str,
+        default=None,
+        metavar='TOKEN',
+        help='Only accept webhooks with this secret token (best set via ENV variable or config file).\n',
+    )
+    parser.add_argument(
+        '--webhook-poll-interval',
+        type=time_interval,
+        default='5min',
+        help='How often to look for work anyway when receiving webhooks, in case some get lost.\n',
+    )
+    parser.add_argument(
+        '--use-graphql',
+        action='store_true',
+        help=(
+            'Use the GraphQL API to fetch what is needed to decide whether MRs can be merged,\n'
+            'one query per project rather than a few REST calls per MR (GitLab 14+).\n'
+        ),
+    )
+    parser.add_argument(
+        '--user-cache-ttl',
+        type=time_interval,
+        default='1h',
+        help=(
+            'How long to remember the users marge looks up, e.g. approvers for --add-reviewers,\n'
+            'instead of fetching them again for every merge attempt. 0 disables the cache.\n'
+        ),
+    )
+    parser.add_argument(
+        '--compact-resources',
+        action='store_true',
+        help=(
+            'Only keep the fields marge uses of the projects, merge requests, etc. it fetches.\n'
+            'Saves memory when handling many of them; other fields are refetched on demand.\n'
+        ),
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -212,6 +414,22 @@ def _parse_config(args):
 
     if config.use_merge_strategy and config.batch:
         raise MargeBotCliArgError('--use-merge-strategy and --batch are currently mutually exclusive')
+    if config.api_rate_limit is not None and config.api_rate_limit < 0:
+        raise MargeBotCliArgError('--api-rate-limit must not be negative')
+    if config.api_rate_limit_burst < 1:
+        raise MargeBotCliArgError('--api-rate-limit-burst must be at least 1')
+    if config.max_batch_size is not None and config.max_batch_size < 2:
+        raise MargeBotCliArgError('--max-batch-size must be at least 2')
+    if config.batch_bisect and not config.batch:
+        raise MargeBotCliArgError('--batch-bisect requires --batch')
+    if config.merge_train_depth and config.batch:
+        raise MargeBotCliArgError('--merge-train-depth and --batch are mutually exclusive')
+    if config.merge_train_depth and config.use_merge_strategy:
+        raise MargeBotCliArgError(
+            '--use-merge-strategy and --merge-train-depth are currently mutually exclusive'
+        )
+    if config.merge_train_depth < 0:
+        raise MargeBotCliArgError('--merge-train-depth must not be negative')
     if config.use_merge_strategy and config.add_tested:
         raise MargeBotCliArgError('--use-merge-strategy and --add-tested are currently mutually exclusive')
     if config.rebase_remotely:
@@ -262,8 +480,37 @@ def main(args=None):
     else:
         logging.getLogger("requests").setLevel(logging.WARNING)
 
+    gitlab.Resource.compact = options.compact_resources
+    user_cache_ttl = options.user_cache_ttl.total_seconds()
+    user_module.User.cache = cache.LRUCache(maxsize=256, ttl=user_cache_ttl) if user_cache_ttl > 0 else None
+
+    api_metrics = None
+    if options.metrics_port is not None:
+        api_metrics = metrics.ApiMetrics()
+        api_metrics.serve(options.metrics_port)
+
     with _secret_auth_token_and_ssh_key(options) as (auth_token, ssh_key_file):
-        api = gitlab.Api(options.gitlab_url, auth_token)
+        api = gitlab.Api(
+            options.gitlab_url,
+            auth_token,
+            pool_connections=options.api_pool_size,
+            pool_maxsize=options.api_max_connections,
+            page_workers=options.api_page_workers,
+            cache=(
+                cache.ResponseCache(options.api_cache_size, ttls=cache.DEFAULT_TTLS)
+                if options.api_cache_size > 0 else None
+            ),
+            retry=gitlab.RetryPolicy(
+                max_retries=options.api_max_retries,
+                backoff_factor=options.api_retry_backoff.total_seconds(),
+                max_backoff=60,
+            ),
+            rate_limiter=ratelimit.RateLimiter(
+                rate=options.api_rate_limit,
+                burst=options.api_rate_limit_burst,
+            ),
+            metrics=api_metrics,
+        )
         user = user_module.User.myself(api)
         if options.max_ci_time_in_minutes:
             logging.warning(
@@ -274,6 +521,8 @@ def main(args=None):
 
         if options.batch:
             logging.warning('Experimental batch mode enabled')
+        if options.merge_train_depth:
+            logging.warning('Experimental merge train mode enabled')
 
         if options.use_merge_strategy:
             fusion = bot.Fusion.merge
@@ -306,9 +555,25 @@ def main(args=None):
                 embargo=options.embargo,
                 ci_timeout=options.ci_timeout,
                 fusion=fusion,
+                use_graphql=options.use_graphql,
             ),
             batch=options.batch,
+            discovery=options.discovery,
+            project_refresh_interval=options.project_refresh_interval,
+            webhook_poll_interval=options.webhook_poll_interval,
+            adaptive_ci_polling=options.adaptive_ci_polling,
+            project_workers=options.project_workers,
+            max_project_poll_interval=options.max_project_poll_interval,
+            merge_train_depth=options.merge_train_depth,
+            batch_bisect=options.batch_bisect,
+            max_batch_size=options.max_batch_size,
+            batch_stats_file=options.batch_stats_file,
         )
 
-        marge_bot = bot.Bot(api=api, config=config)
+        events = None
+        if options.webhook_port is not None:
+            events = webhook.EventHub()
+            events.serve(options.webhook_port, secret=options.webhook_secret)
+
+        marge_bot = bot.Bot(api=api, config=config, events=events)
         marge_bot.start()
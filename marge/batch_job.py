@@ -1,10 +1,11 @@
 # pylint: disable=too-many-branches,too-many-statements
+import contextlib
 import logging as log
 from time import sleep
 
-from . import git
+from . import git, gitlab
 from .commit import Commit
-from .job import MergeJob, CannotMerge, SkipMerge
+from .job import MergeJob, CannotMerge, CIFailed, Fusion, SkipMerge
 from .merge_request import MergeRequest
 from .pipeline import Pipeline
 
@@ -15,15 +16,38 @@ class CannotBatch(Exception):
 
 class BatchMergeJob(MergeJob):
     BATCH_BRANCH_NAME = 'marge_bot_batch_merge_job'
-
-    def __init__(self, *, api, user, project, repo, options, merge_requests):
-        super().__init__(api=api, user=user, project=project, repo=repo, options=options)
+    # How many shorter batches to test at the same time when bisecting a failed one
+    BISECT_WIDTH = 3
+    # How many MRs to check whether they can be merged at the same time
+    MAX_CONCURRENT_CHECKS = 8
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, *, api, user, project, repo, options, merge_requests,
+            snapshots=None, bisect=False, batch_sizer=None, events=None, ci_poller=None,
+    ):
+        super().__init__(
+            api=api, user=user, project=project, repo=repo, options=options,
+            events=events, ci_poller=ci_poller,
+        )
         self._merge_requests = merge_requests
+        # GraphQL snapshots of (some of) the MRs by iid, as of when they were listed
+        self._snapshots = snapshots or {}
+        self._bisect = bisect
+        self._batch_sizer = batch_sizer
+
+    @property
+    def target_branch(self):
+        return self._merge_requests[0].target_branch
+
+    @property
+    def batch_branch_name(self):
+        # So that batches for different target branches can be tested at the same time
+        return '{}_{}'.format(BatchMergeJob.BATCH_BRANCH_NAME, self.target_branch)
 
     def remove_batch_branch(self):
         log.info('Removing local batch branch')
         try:
-            self._repo.remove_branch(BatchMergeJob.BATCH_BRANCH_NAME)
+            self._repo.remove_branch(self.batch_branch_name)
         except git.GitError:
             pass
 
@@ -32,6 +56,7 @@ class BatchMergeJob(MergeJob):
         params = {
             'author_id': self._user.id,
             'labels': BatchMergeJob.BATCH_BRANCH_NAME,
+            'target_branch': self.target_branch,
             'state': 'opened',
             'order_by': 'created_at',
             'sort': 'desc',
@@ -45,10 +70,10 @@ class BatchMergeJob(MergeJob):
             log.info('Closing batch MR !%s', batch_mr.iid)
             batch_mr.close()
 
-    def create_batch_mr(self, target_branch):
+    def create_batch_mr(self, target_branch, source_branch=None):
         log.info('Creating batch MR')
         params = {
-            'source_branch': BatchMergeJob.BATCH_BRANCH_NAME,
+            'source_branch': source_branch or self.batch_branch_name,
             'target_branch': target_branch,
             'title': 'Marge Bot Batch MR - DO NOT TOUCH',
             'labels': BatchMergeJob.BATCH_BRANCH_NAME,
@@ -68,23 +93,44 @@ class BatchMergeJob(MergeJob):
             if merge_request.target_branch == target_branch
         ]
 
-    def ensure_mergeable_mr(self, merge_request):
-        super().ensure_mergeable_mr(merge_request)
+    def ensure_mergeable_mr(self, merge_request, snapshot=None):
+        if snapshot is None or not self.snapshot_looks_mergeable(snapshot):
+            super().ensure_mergeable_mr(merge_request)
 
         if self._project.only_allow_merge_if_pipeline_succeeds:
-            ci_status = self.get_mr_ci_status(merge_request)
+            ci_status = None
+            # unless the MR was refetched above and has changed since
+            if snapshot is not None and snapshot.sha == merge_request.sha:
+                ci_status = snapshot.ci_status
+            if ci_status is None:
+                ci_status = self.get_mr_ci_status(merge_request)
             if ci_status != 'success':
                 raise CannotBatch('This MR has not passed CI.')
 
     def get_mergeable_mrs(self, merge_requests):
         log.info('Filtering mergeable MRs')
-        mergeable_mrs = []
-        for merge_request in merge_requests:
+        if not merge_requests:
+            return []
+
+        def check(merge_request):
             try:
-                self.ensure_mergeable_mr(merge_request)
-            except (CannotBatch, SkipMerge) as ex:
+                self.ensure_mergeable_mr(merge_request, self._snapshots.get(merge_request.iid))
+            except (CannotBatch, CannotMerge) as ex:
+                return ex
+            return None
+
+        # Each check is a few API requests, which are best not waited for one after the other
+        max_workers = min(self.MAX_CONCURRENT_CHECKS, len(merge_requests))
+        with gitlab.AsyncApi(self._api, max_concurrency=max_workers) as async_api:
+            errors = async_api.run_concurrently([
+                async_api.run(check, merge_request) for merge_request in merge_requests
+            ])
+
+        mergeable_mrs = []
+        for merge_request, ex in zip(merge_requests, errors):
+            if isinstance(ex, (CannotBatch, SkipMerge)):
                 log.warning('Skipping unbatchable MR: "%s"', ex)
-            except CannotMerge as ex:
+            elif isinstance(ex, CannotMerge):
                 log.warning('Skipping unmergeable MR: "%s"', ex)
                 self.unassign_from_mr(merge_request)
                 merge_request.comment("I couldn't merge this branch: {}".format(ex))
@@ -94,7 +140,66 @@ class BatchMergeJob(MergeJob):
 
     def push_batch(self):
         log.info('Pushing batch branch')
-        self._repo.push(BatchMergeJob.BATCH_BRANCH_NAME, force=True)
+        self._repo.push(self.batch_branch_name, force=True)
+
+    def prefix_branch_name(self, length):
+        return '{}_prefix_{}'.format(self.batch_branch_name, length)
+
+    def push_prefix(self, prefix_sha, length):
+        """Push the batch of the first `length` MRs, which ends at `prefix_sha`; return its batch MR."""
+        branch = self.prefix_branch_name(length)
+        try:
+            self._repo.checkout_branch(branch, prefix_sha)
+            self._repo.push(branch, force=True)
+        except git.GitError as err:
+            raise CannotBatch('Failed to push {} for bisecting the batch'.format(branch)) from err
+        return self.create_batch_mr(target_branch=self.target_branch, source_branch=branch)
+
+    def bisect(self, prefix_shas):
+        """Find how many MRs at the start of a batch whose CI failed pass CI together.
+
+        `prefix_shas[k]` is the head of the batch of the first k + 1 MRs. Several of those
+        are tested at once, so that each round narrows down the culprit to a fraction of
+        what was left to try.
+        """
+        good, bad = 0, len(prefix_shas)
+        pushed_lengths = set()
+        try:
+            while bad - good > 1:
+                lengths = sorted({good + (bad - good) * i // (self.BISECT_WIDTH + 1)
+                                  for i in range(1, self.BISECT_WIDTH + 1)} - {good})
+                log.info('Bisecting batch: testing the first %s MRs', lengths)
+                batch_mrs = []
+                try:
+                    for length in lengths:
+                        pushed_lengths.add(length)
+                        batch_mrs.append((length, self.push_prefix(prefix_shas[length - 1], length)))
+                    for length, batch_mr in batch_mrs:
+                        if length >= bad:
+                            continue
+                        try:
+                            self.wait_for_ci_to_pass(batch_mr)
+                        except CIFailed:
+                            bad = length
+                        else:
+                            good = length
+                except CannotMerge as err:
+                    raise CannotBatch(err.reason) from err
+                finally:
+                    for _, batch_mr in batch_mrs:
+                        batch_mr.close()
+        finally:
+            if pushed_lengths:
+                self.remove_prefix_branches(sorted(pushed_lengths))
+        return good
+
+    def remove_prefix_branches(self, lengths):
+        log.info('Removing remote bisection branches')
+        try:
+            self._repo.remove_remote_branches(*[self.prefix_branch_name(length) for length in lengths])
+        except git.GitError:
+            # Not worth failing over: they get overwritten by the next bisection anyway
+            log.warning('Failed to remove remote bisection branches', exc_info=True)
 
     def ensure_mr_not_changed(self, merge_request):
         log.info('Ensuring MR !%s did not change', merge_request.iid)
@@ -154,7 +259,11 @@ class BatchMergeJob(MergeJob):
 
         # At this point Gitlab should have recognised the MR as being accepted.
         log.info('Successfully merged MR !%s', merge_request.iid)
+        self.cancel_pipelines(merge_request)
+
+        return final_sha
 
+    def cancel_pipelines(self, merge_request):
         pipelines = Pipeline.pipelines_by_branch(
             api=self._api,
             project_id=merge_request.source_project_id,
@@ -164,6 +273,78 @@ class BatchMergeJob(MergeJob):
         for pipeline in pipelines:
             pipeline.cancel()
 
+    def cancel_pushed_pipelines(self, merge_request, sha):
+        """Cancel the pipelines that pushing `sha` to the MR's source branch set off."""
+        pipelines = Pipeline.pipelines_by_branch(
+            api=self._api,
+            project_id=merge_request.source_project_id,
+            branch=merge_request.source_branch,
+            sha=sha,
+        )
+        for pipeline in pipelines:
+            # they may not have got as far as running yet
+            if pipeline.status in ('created', 'pending', 'running'):
+                pipeline.cancel()
+
+    def can_push_atomically(self, merge_requests):
+        """Whether a tested batch can be merged as it is, without rebasing its MRs one by one again."""
+        return (
+            self._options.fusion is Fusion.rebase and
+            # the commits we tested are the ones to merge, and only then approvals may reset
+            not self._options.requests_commit_tagging and
+            not self._options.reapprove and
+            all(merge_request.source_project_id == self._project.id for merge_request in merge_requests)
+        )
+
+    def accept_batch(self, merge_requests, prefix_shas, expected_remote_target_branch_sha):
+        """Merge a tested batch in one atomic push; return the new sha of the target branch.
+
+        The target branch gets the batch head, and each source branch its MR's commits as
+        rebased in the batch, so that GitLab sees all MRs as merged. If an MR can't be merged
+        anymore, those ahead of it still are (as they were tested without it), and then its
+        error is raised.
+        """
+        failure = None
+        for length, merge_request in enumerate(merge_requests):
+            try:
+                with self.reporting_failures(merge_request):
+                    self.ensure_mr_not_changed(merge_request)
+                    self.ensure_mergeable_mr(merge_request)
+            except (CannotBatch, CannotMerge) as err:
+                failure = err
+                merge_requests = merge_requests[:length]
+                break
+        if not merge_requests:
+            raise failure
+
+        # Make sure latest commit in remote <target_branch> is the one we tested against
+        new_target_sha = Commit.last_on_branch(self._project.id, self.target_branch, self._api).id
+        if new_target_sha != expected_remote_target_branch_sha:
+            raise CannotBatch('Someone was naughty and by-passed marge')
+
+        log.info('Merging %s MRs in a single push', len(merge_requests))
+        final_sha = prefix_shas[len(merge_requests) - 1]
+        try:
+            # This fails if someone pushed to any of the branches since we fetched them
+            self._repo.push_atomic(
+                self.target_branch,
+                final_sha,
+                {
+                    merge_request.source_branch: (prefix_sha, merge_request.sha)
+                    for merge_request, prefix_sha in zip(merge_requests, prefix_shas)
+                },
+            )
+        except git.GitError as err:
+            raise CannotBatch('Failed to push the batch; did someone push whilst merging?') from err
+
+        sleep(2)
+
+        for merge_request, prefix_sha in zip(merge_requests, prefix_shas):
+            log.info('Successfully merged MR !%s', merge_request.iid)
+            self.cancel_pushed_pipelines(merge_request, prefix_sha)
+
+        if failure is not None:
+            raise failure
         return final_sha
 
     def execute(self):
@@ -171,7 +352,7 @@ class BatchMergeJob(MergeJob):
         self.remove_batch_branch()
         self.close_batch_mr()
 
-        target_branch = self._merge_requests[0].target_branch
+        target_branch = self.target_branch
         merge_requests = self.get_mrs_with_common_target_branch(target_branch)
         merge_requests = self.get_mergeable_mrs(merge_requests)
 
@@ -187,11 +368,18 @@ class BatchMergeJob(MergeJob):
         remote_target_branch_sha = self._repo.get_commit_hash('origin/%s' % target_branch)
 
         self._repo.checkout_branch(target_branch, 'origin/%s' % target_branch)
-        self._repo.checkout_branch(BatchMergeJob.BATCH_BRANCH_NAME, 'origin/%s' % target_branch)
+        self._repo.checkout_branch(self.batch_branch_name, 'origin/%s' % target_branch)
+
+        max_size = self._batch_sizer.batch_size(self._project.id) if self._batch_sizer is not None else None
+        if max_size is not None and len(merge_requests) > max_size:
+            log.info('Batching at most %s of %s MRs', max_size, len(merge_requests))
 
         working_merge_requests = []
+        prefix_shas = []
 
         for merge_request in merge_requests:
+            if max_size is not None and len(working_merge_requests) >= max_size:
+                break
             try:
                 _, source_repo_url, merge_request_remote = self.fetch_source_project(merge_request)
                 self._repo.checkout_branch(
@@ -202,14 +390,14 @@ class BatchMergeJob(MergeJob):
                 # Update <source_branch> on latest <batch> branch so it contains previous MRs
                 self.fuse(
                     merge_request.source_branch,
-                    BatchMergeJob.BATCH_BRANCH_NAME,
+                    self.batch_branch_name,
                     source_repo_url=source_repo_url,
                     local=True,
                 )
 
                 # Update <batch> branch with MR changes
-                self._repo.fast_forward(
-                    BatchMergeJob.BATCH_BRANCH_NAME,
+                prefix_sha = self._repo.fast_forward(
+                    self.batch_branch_name,
                     merge_request.source_branch,
                     local=True,
                 )
@@ -223,6 +411,7 @@ class BatchMergeJob(MergeJob):
                 continue
             else:
                 working_merge_requests.append(merge_request)
+                prefix_shas.append(prefix_sha)
         if len(working_merge_requests) <= 1:
             raise CannotBatch('not enough ready merge requests')
         if self._project.only_allow_merge_if_pipeline_succeeds:
@@ -235,37 +424,90 @@ class BatchMergeJob(MergeJob):
                 merge_request.comment('I will attempt to batch this MR (!{})...'.format(batch_mr.iid))
             try:
                 self.wait_for_ci_to_pass(batch_mr)
+            except CIFailed as err:
+                self.record_batch_outcome(len(working_merge_requests), passed=False)
+                if not self._bisect:
+                    self.comment_batch_failed(working_merge_requests, batch_mr, err.reason)
+                    raise CannotBatch(err.reason) from err
+                try:
+                    working_merge_requests = self.drop_culprit(working_merge_requests, prefix_shas, batch_mr)
+                except CannotBatch as bisect_err:
+                    self.comment_batch_failed(working_merge_requests, batch_mr, str(bisect_err))
+                    raise
             except CannotMerge as err:
-                for merge_request in working_merge_requests:
-                    merge_request.comment(
-                        'Batch MR !{batch_mr_iid} failed: {error} I will retry later...'.format(
-                            batch_mr_iid=batch_mr.iid,
-                            error=err.reason,
-                        ),
-                    )
+                self.comment_batch_failed(working_merge_requests, batch_mr, err.reason)
                 raise CannotBatch(err.reason) from err
+            else:
+                self.record_batch_outcome(len(working_merge_requests), passed=True)
+        if not working_merge_requests:
+            return
+        if self.can_push_atomically(working_merge_requests):
+            self.accept_batch(working_merge_requests, prefix_shas, remote_target_branch_sha)
+            return
         for merge_request in working_merge_requests:
-            try:
-                # FIXME: this should probably be part of the merge request
-                _, source_repo_url, merge_request_remote = self.fetch_source_project(merge_request)
-                self.ensure_mr_not_changed(merge_request)
-                self.ensure_mergeable_mr(merge_request)
-                remote_target_branch_sha = self.accept_mr(
-                    merge_request,
-                    remote_target_branch_sha,
-                    source_repo_url=source_repo_url,
-                )
-            except CannotBatch as err:
-                merge_request.comment(
-                    "I couldn't merge this branch: {error} I will retry later...".format(
-                        error=str(err),
-                    ),
-                )
-                raise
-            except SkipMerge:
-                # Raise here to avoid being caught below - we don't want to be unassigned.
-                raise
-            except CannotMerge as err:
-                self.unassign_from_mr(merge_request)
-                merge_request.comment("I couldn't merge this branch: %s" % err.reason)
-                raise
+            remote_target_branch_sha = self.accept_tested_mr(merge_request, remote_target_branch_sha)
+
+    def record_batch_outcome(self, size, passed):
+        if self._batch_sizer is not None:
+            self._batch_sizer.record(self._project.id, size, passed)
+
+    def comment_batch_failed(self, merge_requests, batch_mr, reason):
+        for merge_request in merge_requests:
+            merge_request.comment(
+                'Batch MR !{batch_mr_iid} failed: {error} I will retry later...'.format(
+                    batch_mr_iid=batch_mr.iid,
+                    error=reason,
+                ),
+            )
+
+    def drop_culprit(self, merge_requests, prefix_shas, batch_mr):
+        """Bisect a batch whose CI failed; return the MRs that can be merged."""
+        good = self.bisect(prefix_shas)
+        culprit = merge_requests[good]
+        log.warning('Batch MR !%s failed because of MR !%s', batch_mr.iid, culprit.iid)
+        self.unassign_from_mr(culprit)
+        culprit.comment(
+            "I couldn't merge this branch: CI failed in batch MR !{batch_mr_iid}, and it was the first "
+            "MR in it to break CI!".format(batch_mr_iid=batch_mr.iid)
+        )
+        for merge_request in merge_requests[good + 1:]:
+            merge_request.comment(
+                'Batch MR !{batch_mr_iid} failed because of !{culprit_iid}. I will retry later...'.format(
+                    batch_mr_iid=batch_mr.iid,
+                    culprit_iid=culprit.iid,
+                ),
+            )
+        return merge_requests[:good]
+
+    def accept_tested_mr(self, merge_request, expected_remote_target_branch_sha):
+        """Merge an MR that passed CI as part of a batch; return the new sha of the target branch."""
+        with self.reporting_failures(merge_request):
+            # FIXME: this should probably be part of the merge request
+            _, source_repo_url, _ = self.fetch_source_project(merge_request)
+            self.ensure_mr_not_changed(merge_request)
+            self.ensure_mergeable_mr(merge_request)
+            return self.accept_mr(
+                merge_request,
+                expected_remote_target_branch_sha,
+                source_repo_url=source_repo_url,
+            )
+
+    @contextlib.contextmanager
+    def reporting_failures(self, merge_request):
+        """Tell the MR's author why it couldn't be merged, if that is the case."""
+        try:
+            yield
+        except CannotBatch as err:
+            merge_request.comment(
+                "I couldn't merge this branch: {error} I will retry later...".format(
+                    error=str(err),
+                ),
+            )
+            raise
+        except SkipMerge:
+            # Raise here to avoid being caught below - we don't want to be unassigned.
+            raise
+        except CannotMerge as err:
+            self.unassign_from_mr(merge_request)
+            merge_request.comment("I couldn't merge this branch: %s" % err.reason)
+            raise
@@ -0,0 +1,73 @@
+import json
+import logging as log
+import math
+import os
+import threading
+
+
+class BatchSizer:
+    """Picks how many MRs to batch in each project, from how past batches went.
+
+    If each MR breaks CI with probability p, a batch of n MRs passes with probability
+    s = (1 - p)^n, and merges n * s MRs per pipeline on average; which is highest for
+    n = -1 / ln(1 - p). We estimate p from the (decaying) rate at which past batches
+    passed and their average size.
+    """
+
+    def __init__(self, *, max_size=None, stats_file=None, min_batches=5, decay=0.95):
+        self._max_size = max_size
+        self._stats_file = stats_file
+        # Until there are enough batches to go by, we don't hold back
+        self._min_batches = min_batches
+        # So that what happened recently counts most
+        self._decay = decay
+        self._lock = threading.Lock()
+        self._stats_by_project_id = self._load() if stats_file else {}
+
+    def batch_size(self, project_id):
+        """The most MRs to put in a batch for `project_id` (None if there is no limit)."""
+        with self._lock:
+            stats = self._stats_by_project_id.get(project_id)
+        size = None
+        if stats is not None and stats['batches'] >= self._min_batches:
+            success_rate = stats['successes'] / stats['batches']
+            if success_rate < 1:
+                mean_size = stats['merge_requests'] / stats['batches']
+                # -1 / ln(1 - p), with p = 1 - success_rate ** (1 / mean_size)
+                optimal_size = mean_size / -math.log(success_rate) if success_rate > 0 else 0
+                size = max(2, int(round(optimal_size)))
+        if self._max_size is not None:
+            size = self._max_size if size is None else min(size, self._max_size)
+        return size
+
+    def record(self, project_id, size, passed):
+        """Take note that CI for a batch of `size` MRs in `project_id` `passed` or not."""
+        with self._lock:
+            stats = self._stats_by_project_id.setdefault(
+                project_id, {'batches': 0, 'successes': 0, 'merge_requests': 0},
+            )
+            stats['batches'] = stats['batches'] * self._decay + 1
+            stats['successes'] = stats['successes'] * self._decay + (1 if passed else 0)
+            stats['merge_requests'] = stats['merge_requests'] * self._decay + size
+            if self._stats_file:
+                self._save()
+
+    def _load(self):
+        try:
+            with open(self._stats_file) as stats_file:
+                return {int(project_id): stats for project_id, stats in json.load(stats_file).items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            log.warning('Ignoring unreadable batch statistics in %s: %s', self._stats_file, err)
+            return {}
+
+    def _save(self):
+        # Write and rename, so that the file is never left half-written
+        tmp_file_name = self._stats_file + '.tmp'
+        try:
+            with open(tmp_file_name, 'w') as stats_file:
+                json.dump(self._stats_by_project_id, stats_file)
+            os.replace(tmp_file_name, self._stats_file)
+        except OSError as err:
+            log.warning('Could not save batch statistics to %s: %s', self._stats_file, err)
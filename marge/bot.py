@@ -1,23 +1,53 @@
 import logging as log
 import time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory
 
 from . import batch_job
+from . import batch_sizer
+from . import ci_poller
 from . import git
+from . import gitlab
+from . import graphql
 from . import job
 from . import merge_request as merge_request_module
+from . import ratelimit
+from . import registry
+from . import scheduler
 from . import single_merge_job
 from . import store
+from . import train_job
 from .project import AccessLevel, Project
 
 MergeRequest = merge_request_module.MergeRequest
 
 
 class Bot:
-    def __init__(self, *, api, config):
+    def __init__(self, *, api, config, events=None):
         self._api = api
         self._config = config
+        self._events = events
+        self._projects_by_id = {}
+        self._ci_poller = ci_poller.CIPoller() if config.adaptive_ci_polling else None
+        self._batch_sizer = (
+            batch_sizer.BatchSizer(max_size=config.max_batch_size, stats_file=config.batch_stats_file)
+            if config.max_batch_size or config.batch_stats_file else None
+        )
+        # Jobs for different projects and target branches can run in parallel,
+        # but only one at a time for each (project id, target branch)
+        self._executor = (
+            ThreadPoolExecutor(max_workers=config.project_workers, thread_name_prefix='project')
+            if config.project_workers > 1 else None
+        )
+        self._futures_by_key = {}
+        # The target branches of the MRs last handed to workers, by project id
+        self._target_branches_by_project_id = {}
+        self._project_registry = (
+            registry.ProjectRegistry(api, full_refresh_interval=config.project_refresh_interval)
+            if config.project_refresh_interval else None
+        )
+        self._scheduler = scheduler.Scheduler(max_interval=config.max_project_poll_interval.total_seconds())
 
         user = config.user
         opts = config.merge_opts
@@ -39,7 +69,21 @@ class Bot:
                 timeout=self._config.git_timeout,
                 reference=self._config.git_reference_repo,
             )
-            self._run(repo_manager)
+            try:
+                self._run(repo_manager)
+            finally:
+                self._stop_workers()
+
+    def _stop_workers(self):
+        """Drop the jobs no worker has started on, and wait for the others to finish.
+
+        They use the clones in our temporary directory, so it can't go before they do.
+        """
+        if self._executor is None:
+            return
+        for future in self._futures_by_key.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
 
     @property
     def user(self):
@@ -50,26 +94,94 @@ class Bot:
         return self._api
 
     def _run(self, repo_manager):
-        time_to_sleep_between_projects_in_secs = 1
-        min_time_to_sleep_after_iterating_all_projects_in_secs = 30
+        if self._config.discovery == 'assigned':
+            self._run_assigned(repo_manager)
+        else:
+            self._run_scheduled(repo_manager)
+
+    def _listing_interval_secs(self):
+        """How often to look for (changes in) our projects or MRs, if no webhook tells us first."""
+        return 30 if self._events is None else self._config.webhook_poll_interval.total_seconds()
+
+    def _run_assigned(self, repo_manager):
+        # A single listing tells us about all our MRs, so there is nothing to schedule
         while True:
-            projects = self._get_projects()
-            self._process_projects(
-                repo_manager,
-                time_to_sleep_between_projects_in_secs,
-                projects,
-            )
-            big_sleep = max(0,
-                            min_time_to_sleep_after_iterating_all_projects_in_secs -
-                            time_to_sleep_between_projects_in_secs * len(projects))
-            log.info('Sleeping for %s seconds...', big_sleep)
-            time.sleep(big_sleep)
+            self._reap_workers()
+            self._process_assigned_merge_requests(repo_manager)
+            secs = self._listing_interval_secs()
+            log.info('Sleeping for %s seconds...', secs)
+            self._sleep(repo_manager, secs)
+
+    def _process_assigned_merge_requests(self, repo_manager, project_ids=None):
+        """Look for MRs assigned to us (only in `project_ids`, if given) and merge them."""
+        # looking for work can wait, if we are about to run out of API requests
+        with ratelimit.background():
+            projects_with_merge_requests = self._get_assigned_merge_requests()
+        for project, merge_requests in projects_with_merge_requests:
+            if project_ids is None or project.id in project_ids:
+                self._handle_merge_requests(repo_manager, project, merge_requests)
+
+    def _sleep(self, repo_manager, secs):
+        """Sleep for `secs`, unless webhooks tell us about projects to have another look at meanwhile."""
+        if self._events is None:
+            time.sleep(secs)
+            return
+        deadline = time.monotonic() + secs
+        remaining = secs
+        while remaining > 0:
+            project_ids = self._events.take_pending(remaining)
+            if project_ids:
+                log.info('Woken up by events in projects %s', sorted(project_ids))
+                self._process_assigned_merge_requests(repo_manager, project_ids)
+            remaining = deadline - time.monotonic()
 
-    def _get_projects(self):
+    def _run_scheduled(self, repo_manager):
+        listing_interval = self._listing_interval_secs()
+        next_listing = time.monotonic()
+        while True:
+            self._reap_workers()
+            if time.monotonic() >= next_listing:
+                with ratelimit.background():
+                    self._schedule_projects()
+                next_listing = time.monotonic() + listing_interval
+
+            project_ids = self._scheduler.pop_due()
+            projects = [self._projects_by_id[project_id] for project_id in project_ids]
+            busy_projects = self._process_projects(repo_manager, projects)
+            for project in projects:
+                self._scheduler.done(project.id, busy=project in busy_projects)
+
+            secs = next_listing - time.monotonic()
+            secs_until_next = self._scheduler.secs_until_next()
+            if secs_until_next is not None:
+                secs = min(secs, secs_until_next)
+            if secs > 0:
+                log.debug('Next project is due in %.1f seconds...', secs)
+                self._wait_for_events(secs)
+
+    def _wait_for_events(self, secs):
+        """Wait for `secs`, or until webhooks make some projects due right away."""
+        if self._events is None:
+            time.sleep(secs)
+            return
+        project_ids = self._events.take_pending(secs)
+        if project_ids:
+            # Anything else will be picked up by the next listing
+            log.info('Woken up by events in projects %s', sorted(project_ids))
+            self._scheduler.wake(project_ids)
+
+    def _schedule_projects(self):
+        """Bring the schedule up to date with our current projects."""
         log.info('Finding out my current projects...')
-        my_projects = Project.fetch_all_mine(self._api)
+        if self._project_registry is not None:
+            active_projects = self._project_registry.refresh()
+            my_projects = self._project_registry.projects()
+        else:
+            active_projects = []
+            my_projects = Project.fetch_all_mine(self._api)
         project_regexp = self._config.project_regexp
         filtered_projects = [p for p in my_projects if project_regexp.match(p.path_with_namespace)]
+        self._projects_by_id = {p.id: p for p in filtered_projects}
         log.debug(
             'Projects that match project_regexp: %s',
             [p.path_with_namespace for p in filtered_projects]
@@ -80,32 +192,88 @@ class Bot:
                 'Projects that do not match project_regexp: %s',
                 [p.path_with_namespace for p in filtered_out]
             )
-        return filtered_projects
+        self._scheduler.sync(self._projects_by_id)
+        self._scheduler.wake(project.id for project in active_projects)
 
-    def _process_projects(
-        self,
-        repo_manager,
-        time_to_sleep_between_projects_in_secs,
-        projects,
-    ):
+    def _get_assigned_merge_requests(self):
+        """Find the projects where there is work to do, with their MRs assigned to us.
+
+        A single listing of all our MRs, so that checking for work is cheap
+        regardless of how many projects we are a member of.
+        """
+        log.info('Finding merge requests assigned to me...')
+        merge_requests_by_project_id = {}
+        for merge_request in MergeRequest.fetch_all_open_assigned_to_me(self._api, self._config.merge_order):
+            merge_requests_by_project_id.setdefault(merge_request.project_id, []).append(merge_request)
+
+        projects_with_merge_requests = []
+        for project_id, merge_requests in merge_requests_by_project_id.items():
+            project = Project.fetch_by_id(project_id, self._api)
+            project_name = project.path_with_namespace
+            if not self._config.project_regexp.match(project_name):
+                log.debug('Project %s does not match project_regexp', project_name)
+                continue
+            if project.access_level < AccessLevel.reporter:
+                log.warning("Don't have enough permissions to browse merge requests in %s!", project_name)
+                continue
+            merge_requests = self._filter_merge_requests(merge_requests)
+            if merge_requests:
+                projects_with_merge_requests.append((project, merge_requests))
+        return projects_with_merge_requests
+
+    def _process_projects(self, repo_manager, projects):
+        """Merge what there is to merge in `projects`; return those in which there was something."""
+        busy_projects = []
         for project in projects:
             project_name = project.path_with_namespace
 
             if project.access_level < AccessLevel.reporter:
                 log.warning("Don't have enough permissions to browse merge requests in %s!", project_name)
                 continue
-            merge_requests = self._get_merge_requests(project, project_name)
-            self._process_merge_requests(repo_manager, project, merge_requests)
-            time.sleep(time_to_sleep_between_projects_in_secs)
+            if self._busy_with(project):
+                # No point in listing MRs that no worker would be free to take
+                log.info('Still busy with all MRs in %s...', project_name)
+                busy_projects.append(project)
+                continue
+            with ratelimit.background():
+                merge_requests, snapshots = self._get_merge_requests(project, project_name)
+            if merge_requests:
+                busy_projects.append(project)
+            self._handle_merge_requests(repo_manager, project, merge_requests, snapshots)
+        return busy_projects
 
     def _get_merge_requests(self, project, project_name):
+        """Return our MRs in a project, and their GraphQL snapshots by iid (if we got any)."""
         log.info('Fetching merge requests assigned to me in %s...', project_name)
+        if self._config.merge_opts.use_graphql:
+            try:
+                snapshots = graphql.fetch_open_merge_requests(
+                    self._api,
+                    project_name,
+                    assignee_username=self.user.username,
+                    merge_order=self._config.merge_order,
+                )
+            except gitlab.GraphQLError as err:
+                log.warning('GraphQL query failed for %s, falling back to REST: %s', project_name, err)
+            else:
+                my_merge_requests = [
+                    MergeRequest(self._api, snapshot.merge_request_info(project.id)) for snapshot in snapshots
+                ]
+                return (
+                    self._filter_merge_requests(my_merge_requests),
+                    {snapshot.iid: snapshot for snapshot in snapshots},
+                )
         my_merge_requests = MergeRequest.fetch_all_open_for_user(
             project_id=project.id,
             user_id=self.user.id,
             api=self._api,
             merge_order=self._config.merge_order,
+            target_branch=merge_request_module.literal_branch(self._config.branch_regexp),
+            source_branch=merge_request_module.literal_branch(self._config.source_branch_regexp),
         )
+        return self._filter_merge_requests(my_merge_requests), {}
+
+    def _filter_merge_requests(self, my_merge_requests):
         branch_regexp = self._config.branch_regexp
         filtered_mrs = [mr for mr in my_merge_requests
                         if branch_regexp.match(mr.target_branch)]
@@ -134,60 +302,123 @@ class Bot:
             )
         return source_filtered_mrs
 
-    def _process_merge_requests(self, repo_manager, project, merge_requests):
+    def _busy_with(self, project):
+        """Whether there are workers on all target branches we last found MRs for in `project`."""
+        target_branches = self._target_branches_by_project_id.get(project.id)
+        return bool(target_branches) and all(
+            (project.id, target_branch) in self._futures_by_key and
+            not self._futures_by_key[(project.id, target_branch)].done()
+            for target_branch in target_branches
+        )
+
+    def _reap_workers(self):
+        """Forget about finished workers, and raise their errors (as if we had been doing their job)."""
+        for key, future in list(self._futures_by_key.items()):
+            if future.done():
+                del self._futures_by_key[key]
+                future.result()
+
+    def _handle_merge_requests(self, repo_manager, project, merge_requests, snapshots=None):
+        if self._executor is None or not merge_requests:
+            # one job at a time, for whichever target branch comes first
+            self._process_merge_requests(repo_manager, project, merge_requests, snapshots=snapshots)
+            return
+
+        # MRs for different target branches can't conflict, so each target branch gets its own worker
+        merge_requests_by_target_branch = {}
+        for merge_request in merge_requests:
+            merge_requests_by_target_branch.setdefault(merge_request.target_branch, []).append(merge_request)
+
+        self._reap_workers()
+        self._target_branches_by_project_id[project.id] = set(merge_requests_by_target_branch)
+        for target_branch, branch_merge_requests in merge_requests_by_target_branch.items():
+            key = (project.id, target_branch)
+            if key in self._futures_by_key:
+                log.info('Still busy with MRs for %s in %s...', target_branch, project.path_with_namespace)
+                continue
+            log.info('Handing %s requests for %s to a worker', len(branch_merge_requests), target_branch)
+            self._futures_by_key[key] = self._executor.submit(
+                self._process_merge_requests, repo_manager, project, branch_merge_requests, target_branch,
+                snapshots,
+            )
+
+    def _process_merge_requests(
+            self, repo_manager, project, merge_requests, target_branch=None, snapshots=None,
+    ):
         if not merge_requests:
             log.info('Nothing to merge at this point...')
             return
 
         try:
-            repo = repo_manager.repo_for_project(project)
+            repo = repo_manager.repo_for_project(project, target_branch)
         except git.GitError:
             log.exception("Couldn't initialize repository for project!")
             raise
 
         log.info('Got %s requests to merge;', len(merge_requests))
-        if self._config.batch and len(merge_requests) > 1:
-            log.info('Attempting to merge as many MRs as possible using BatchMergeJob...')
-            batch_merge_job = batch_job.BatchMergeJob(
-                api=self._api,
-                user=self.user,
-                project=project,
-                merge_requests=merge_requests,
-                repo=repo,
-                options=self._config.merge_opts,
+        if (self._config.batch or self._config.merge_train_depth) and len(merge_requests) > 1:
+            batch_merge_job = self._get_batch_job(
+                project=project, merge_requests=merge_requests, repo=repo, snapshots=snapshots,
             )
+            job_name = type(batch_merge_job).__name__
+            log.info('Attempting to merge as many MRs as possible using %s...', job_name)
             try:
                 batch_merge_job.execute()
                 return
             except batch_job.CannotBatch as err:
-                log.warning('BatchMergeJob aborted: %s', err)
+                log.warning('%s aborted: %s', job_name, err)
             except batch_job.CannotMerge as err:
-                log.warning('BatchMergeJob failed: %s', err)
+                log.warning('%s failed: %s', job_name, err)
                 return
             except git.GitError as err:
-                log.exception('BatchMergeJob failed: %s', err)
+                log.exception('%s failed: %s', job_name, err)
         log.info('Attempting to merge the oldest MR...')
         merge_request = merge_requests[0]
         merge_job = self._get_single_job(
             project=project, merge_request=merge_request, repo=repo,
             options=self._config.merge_opts,
+            snapshot=(snapshots or {}).get(merge_request.iid),
         )
         merge_job.execute()
 
-    def _get_single_job(self, project, merge_request, repo, options):
+    def _get_batch_job(self, project, merge_requests, repo, snapshots=None):
+        params = dict(
+            api=self._api,
+            user=self.user,
+            project=project,
+            merge_requests=merge_requests,
+            snapshots=snapshots,
+            repo=repo,
+            options=self._config.merge_opts,
+            events=self._events,
+            ci_poller=self._ci_poller,
+        )
+        if self._config.merge_train_depth:
+            return train_job.MergeTrainJob(depth=self._config.merge_train_depth, **params)
+        return batch_job.BatchMergeJob(
+            bisect=self._config.batch_bisect, batch_sizer=self._batch_sizer, **params,
+        )
+
+    def _get_single_job(self, project, merge_request, repo, options, snapshot=None):
         return single_merge_job.SingleMergeJob(
             api=self._api,
             user=self.user,
             project=project,
             merge_request=merge_request,
+            snapshot=snapshot,
             repo=repo,
             options=options,
+            events=self._events,
+            ci_poller=self._ci_poller,
         )
 
 
 class BotConfig(namedtuple('BotConfig',
                            'user ssh_key_file project_regexp merge_order merge_opts git_timeout ' +
-                           'git_reference_repo branch_regexp source_branch_regexp batch')):
+                           'git_reference_repo branch_regexp source_branch_regexp batch discovery ' +
+                           'project_refresh_interval webhook_poll_interval adaptive_ci_polling ' +
+                           'project_workers max_project_poll_interval merge_train_depth batch_bisect ' +
+                           'max_batch_size batch_stats_file')):
     pass
 
 
@@ -0,0 +1,83 @@
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+
+class LRUCache:
+    """A thread-safe mapping of bounded size, which forgets the least recently used entries first.
+
+    With a `ttl`, entries are also forgotten `ttl` secs after they were put.
+    """
+
+    def __init__(self, maxsize, ttl=None, clock=time.monotonic):
+        assert maxsize > 0, maxsize
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # of (value, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return default
+            value, expires_at = self._entries[key]
+            if expires_at is not None and self._clock() >= expires_at:
+                del self._entries[key]
+                return default
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            expires_at = self._clock() + self._ttl if self._ttl is not None else None
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachedResponse(namedtuple('CachedResponse', 'etag body validated_at')):
+    pass
+
+
+class ResponseCache:
+    """Remembers GitLab responses (and their ETags) so that they can be revalidated cheaply.
+
+    Within its endpoint's TTL a response is served as is. Past that, we ask GitLab
+    whether it changed (`If-None-Match`), and keep serving it for as long as it says no.
+    """
+
+    def __init__(self, maxsize, ttls=(), default_ttl=0, clock=time.monotonic):
+        self._responses = LRUCache(maxsize)
+        self._ttls = [(re.compile(endpoint_regexp), ttl) for endpoint_regexp, ttl in ttls]
+        self._default_ttl = default_ttl
+        self._clock = clock
+
+    def ttl(self, endpoint):
+        return next((ttl for regexp, ttl in self._ttls if regexp.match(endpoint)), self._default_ttl)
+
+    def lookup(self, key):
+        return self._responses.get(key)
+
+    def is_fresh(self, cached, endpoint):
+        return self._clock() - cached.validated_at < self.ttl(endpoint)
+
+    def store(self, key, etag, body, endpoint):
+        # without an ETag, a response is only any good for as long as its TTL
+        if etag or self.ttl(endpoint) > 0:
+            self._responses.put(key, CachedResponse(etag=etag, body=body, validated_at=self._clock()))
+
+    def revalidated(self, key, cached):
+        self._responses.put(key, cached._replace(validated_at=self._clock()))
+
+
+# GitLab's version only changes on upgrades, yet we look it up all the time
+DEFAULT_TTLS = (
+    (r'\A/version\Z', 600),
+)
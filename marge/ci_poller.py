@@ -0,0 +1,70 @@
+import logging as log
+import statistics
+import threading
+
+from .pipeline import Pipeline
+
+
+class CIPoller:
+    """Decides how long to wait before checking on CI again, learning how long it takes.
+
+    We keep a moving average of how long pipelines take per project, starting from
+    the project's recent pipelines. Early on we poll sparsely, and more and more often
+    as CI gets closer to being done. We also poll less when GitLab is slow to answer.
+    """
+
+    def __init__(self, *, min_delay=5, max_delay=300, default_delay=10, smoothing=0.3, slowness_factor=20):
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._default_delay = default_delay
+        self._smoothing = smoothing
+        # how many times longer than a poll takes we wait between polls, at least
+        self._slowness_factor = slowness_factor
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    def expected_duration(self, project_id):
+        """How long CI is expected to take in a project, in secs (or None if we have no idea)."""
+        with self._lock:
+            return self._durations.get(project_id)
+
+    def learn_history(self, project_id, api):
+        """Estimate CI duration in a project from its recent pipelines, unless we already have."""
+        with self._lock:
+            if project_id in self._durations:
+                return
+            # even if there is nothing to learn, there's no point in trying again
+            self._durations[project_id] = None
+
+        pipelines = Pipeline.recent(project_id, api)
+        durations = [pipeline.duration for pipeline in pipelines if pipeline.duration is not None]
+        if durations:
+            with self._lock:
+                if self._durations[project_id] is None:
+                    self._durations[project_id] = statistics.median(durations)
+            log.info('CI in project %s usually takes %.0f secs', project_id, statistics.median(durations))
+
+    def record(self, project_id, secs):
+        """Take note that CI took `secs` in a project."""
+        with self._lock:
+            previous = self._durations.get(project_id)
+            self._durations[project_id] = (
+                secs if previous is None else self._smoothing * secs + (1 - self._smoothing) * previous
+            )
+
+    def delay(self, project_id, elapsed_secs, poll_secs=0):
+        """Secs to wait before polling CI again, `elapsed_secs` after we started waiting for it.
+
+        `poll_secs` is how long the last poll took.
+        """
+        expected = self.expected_duration(project_id)
+        if expected is None:
+            delay = self._default_delay
+        elif elapsed_secs < expected:
+            # halve the time to the expected finish, so we poll ever more densely near it
+            delay = (expected - elapsed_secs) / 2
+        else:
+            # and when it's late, less and less densely as it gets later
+            delay = (elapsed_secs - expected) / 4
+        delay = max(delay, self._slowness_factor * poll_secs)
+        return min(max(delay, self._min_delay), self._max_delay)
@@ -9,6 +9,7 @@ GET = gitlab.GET
 
 
 class Commit(gitlab.Resource):
+    FIELDS = ('id', 'project_id', 'short_id', 'title', 'author_name', 'author_email', 'status', 'message')
 
     @classmethod
     def fetch_by_id(cls, project_id, sha, api):
@@ -20,6 +21,12 @@ class Commit(gitlab.Resource):
         ))
         return cls(api, info)
 
+    @classmethod
+    def refetch_command(cls, info):
+        if 'project_id' not in info:
+            return None
+        return GET('/projects/{0[project_id]}/repository/commits/{0[id]}'.format(info))
+
     @classmethod
     def last_on_branch(cls, project_id, branch, api):
         info = api.call(GET(
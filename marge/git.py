@@ -148,6 +148,23 @@ class Repo(namedtuple('Repo', 'remote_url local_path ssh_key_file timeout refere
         force_flag = '--force' if force else ''
         self.git('push', force_flag, source, '%s:%s' % (branch, branch))
 
+    def push_atomic(self, target_branch, target_sha, source_branches):
+        """Push `target_sha` to `target_branch` and each of `source_branches` to origin, all or nothing.
+
+        `source_branches` maps branch names to `(sha, expected_sha)`: each branch is overwritten
+        with `sha`, but only if it is still at `expected_sha` on the remote. The target branch is
+        only ever fast-forwarded.
+        """
+        leases = []
+        refspecs = ['%s:refs/heads/%s' % (target_sha, target_branch)]
+        for branch, (sha, expected_sha) in sorted(source_branches.items()):
+            leases.append('--force-with-lease=refs/heads/%s:%s' % (branch, expected_sha))
+            refspecs.append('%s:refs/heads/%s' % (sha, branch))
+        self.git('push', '--atomic', *leases, 'origin', *refspecs)
+
+    def remove_remote_branches(self, *branches):
+        self.git('push', 'origin', '--delete', *branches)
+
     def get_commit_hash(self, rev='HEAD'):
         """Return commit hash for `rev` (default "HEAD")."""
         result = self.git('rev-parse', rev)
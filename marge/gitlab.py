@@ -1,33 +1,115 @@
+import asyncio
+import email.utils
+import functools
+import itertools
 import json
 import logging as log
-from collections import namedtuple
+import random
+import re
+import time
+import urllib.parse
+from collections import deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from . import ratelimit
+
+API_PATH = '/api/v4'
 
 
 class Api:
-    def __init__(self, gitlab_url, auth_token):
+    def __init__(
+            self, gitlab_url, auth_token, *,
+            pool_connections=10, pool_maxsize=10, page_workers=4, cache=None, retry=None,
+            rate_limiter=None, metrics=None,
+    ):
         self._auth_token = auth_token
-        self._api_base_url = gitlab_url.rstrip('/') + '/api/v4'
+        self._gitlab_url = gitlab_url.rstrip('/')
+        self._session = _make_session(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self._page_workers = max(1, page_workers)
+        self._cache = cache
+        self._retry = retry or RetryPolicy.never()
+        self._rate_limiter = rate_limiter
+        self._metrics = metrics
 
     def call(self, command, sudo=None):
+        if self._cache is not None and command.cacheable:
+            return self._cached_call(command, sudo)
+        response = self._request(command, sudo)
+        return self._process_response(command, response)
+
+    def _cached_call(self, command, sudo):
+        key = (command.endpoint, tuple(sorted(command.call_args['params'].items())), sudo)
+        cached = self._cache.lookup(key)
+        if cached and self._cache.is_fresh(cached, command.endpoint):
+            body = cached.body
+        else:
+            # GitLab answers with a cheap 304 if nothing changed since we last asked
+            extra_headers = {'If-None-Match': cached.etag} if cached and cached.etag else None
+            response = self._request(command, sudo, extra_headers=extra_headers)
+            if cached and response.status_code == 304:
+                self._cache.revalidated(key, cached)
+                body = cached.body
+            elif response.status_code == 200:
+                body = response.content
+                self._cache.store(key, response.headers.get('ETag'), body, command.endpoint)
+            else:
+                return self._process_response(command, response)
+
+        # parse every time, as callers are free to modify what they get back
+        result = json.loads(body.decode('utf-8'))
+        return command.extract(result) if command.extract else result
+
+    def _request(self, command, sudo=None, extra_headers=None):
         method = command.method
-        url = self._api_base_url + command.endpoint
+        url = self._gitlab_url + command.path + command.endpoint
         headers = {'PRIVATE-TOKEN': self._auth_token}
+        headers.update(extra_headers or {})
         if sudo:
             headers['SUDO'] = '%d' % sudo
-        log.debug('REQUEST: %s %s %r %r', method.__name__.upper(), url, headers, command.call_args)
-        # Timeout to prevent indefinitely hanging requests. 60s is very conservative,
-        # but should be short enough to not cause any practical annoyances. We just
-        # crash rather than retry since marge-bot should be run in a restart loop anyway.
-        try:
-            response = method(url, headers=headers, timeout=60, **command.call_args)
-        except requests.exceptions.Timeout as err:
-            log.error('Request timeout: %s', err)
-            raise
-        log.debug('RESPONSE CODE: %s', response.status_code)
-        log.debug('RESPONSE BODY: %r', response.content)
-
+        log.debug('REQUEST: %s %s %r %r', method.upper(), url, headers, command.call_args)
+        # Crashing would throw away all of our clones (marge-bot should be run in a
+        # restart loop anyway), so transient failures are retried a few times first.
+        attempt = 0
+        while True:
+            # Timeout to prevent indefinitely hanging requests. 60s is very conservative,
+            # but should be short enough to not cause any practical annoyances.
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            started_at = time.monotonic()
+            try:
+                response = command.dispatch(self._session, url, headers=headers, timeout=60)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as err:
+                self._observe(command, None, started_at)
+                if not (command.idempotent and attempt < self._retry.max_retries):
+                    log.error('Request failed: %s', err)
+                    raise
+                delay = self._retry.backoff(attempt)
+                log.warning('Request failed (%s), retrying in %.1f secs', err, delay)
+            else:
+                self._observe(command, response.status_code, started_at)
+                log.debug('RESPONSE CODE: %s', response.status_code)
+                log.debug('RESPONSE BODY: %r', response.content)
+                if self._rate_limiter is not None:
+                    self._rate_limiter.update(response.headers)
+                if not (self._retry.should_retry(command, response) and attempt < self._retry.max_retries):
+                    return response
+                delay = self._retry.delay(attempt, response)
+                log.warning('Got %s from GitLab, retrying in %.1f secs', response.status_code, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _observe(self, command, status_code, started_at):
+        if self._metrics is not None:
+            elapsed = time.monotonic() - started_at
+            self._metrics.observe(command.method, command.endpoint, status_code, elapsed)
+
+    @staticmethod
+    def _process_response(command, response):
         if response.status_code == 202:
             return True  # Accepted
 
@@ -64,24 +146,224 @@ class Api:
 
         raise error(response.status_code, err_message)
 
-    def collect_all_pages(self, get_command):
-        result = []
-        fetch_again, page_no = True, 1
-        while fetch_again:
-            page = self.call(get_command.for_page(page_no))
-            if page:
-                result.extend(page)
-                page_no += 1
-            else:
-                fetch_again = False
+    def graphql(self, query, variables=None):
+        """Run a GraphQL `query` and return its data.
+
+        GitLab answers 200 even when the query fails, with the reasons in `errors`.
+        """
+        result = self.call(GRAPHQL('/graphql', {'query': query, 'variables': variables or {}}))
+        if result.get('errors'):
+            raise GraphQLError(200, result['errors'])
+        return result['data']
 
-        return result
+    def _fetch_page(self, command):
+        """Return a page of results together with the pagination headers GitLab sent along."""
+        response = self._request(command)
+        return self._process_response(command, response), response.headers
+
+    def collect_all_pages(self, get_command):
+        return list(self.iter_pages(get_command))
+
+    def iter_pages(self, get_command):
+        """Yield the items of a listing as each page arrives, so callers can filter or stop early."""
+        if get_command.supports_keyset_pagination:
+            return self._iter_keyset_pages(get_command)
+        return self._iter_offset_pages(get_command)
+
+    def _iter_offset_pages(self, get_command):
+        page, headers = self._fetch_page(get_command.for_page(1))
+        if not page:
+            return
+        yield from page
+        yield from self._iter_remaining_offset_pages(get_command, headers)
+
+    def _iter_remaining_offset_pages(self, get_command, headers):
+        total_pages = _int_header(headers, 'X-Total-Pages')
+        if total_pages is not None:
+            # We know how many pages there are, so keep a few of them in flight at once
+            yield from self._iter_pages_concurrently(get_command, range(2, total_pages + 1))
+            return
+
+        # GitLab omits X-Total-Pages for very large collections, and older versions
+        # send no pagination headers at all; fall back to walking the pages in order
+        next_page = _int_header(headers, 'X-Next-Page', default=2)
+        while next_page is not None:
+            page, headers = self._fetch_page(get_command.for_page(next_page))
+            if not page:
+                return
+            yield from page
+            next_page = _int_header(headers, 'X-Next-Page', default=next_page + 1)
+
+    def _iter_keyset_pages(self, get_command):
+        # Deep offset pages get slower and slower to serve (and are capped on large
+        # instances), whereas every keyset page costs the same to fetch.
+        command = get_command.for_keyset()
+        page, headers = self._fetch_page(command)
+        if not page:
+            return
+        yield from page
+
+        if 'X-Next-Page' in headers or 'X-Total-Pages' in headers:
+            # this GitLab predates keyset pagination, and just ignored our request for it
+            yield from self._iter_remaining_offset_pages(command, headers)
+            return
+
+        next_url = _next_link(headers)
+        while next_url is not None:
+            page, headers = self._fetch_page(command.for_url(next_url))
+            yield from page
+            next_url = _next_link(headers)
+
+    def _iter_pages_concurrently(self, get_command, page_numbers):
+        page_numbers = iter(page_numbers)
+        priority = ratelimit.current_priority()
+
+        def fetch(page_no):
+            with ratelimit.prioritized(priority):
+                page, _ = self._fetch_page(get_command.for_page(page_no))
+            return page
+
+        with ThreadPoolExecutor(max_workers=self._page_workers) as executor:
+            # Only keep as many pages around as there are workers, to bound memory usage
+            pending = deque(
+                executor.submit(fetch, page_no)
+                for page_no in itertools.islice(page_numbers, self._page_workers)
+            )
+            try:
+                while pending:
+                    page = pending.popleft().result()
+                    page_no = next(page_numbers, None)
+                    if page_no is not None:
+                        pending.append(executor.submit(fetch, page_no))
+                    yield from page
+            finally:
+                # the caller may have stopped early; don't fetch pages nobody will look at
+                for future in pending:
+                    future.cancel()
 
     def version(self):
         response = self.call(GET('/version'))
         return Version.parse(response['version'])
 
 
+class AsyncApi:
+    """An awaitable front-end to `Api`, for fanning out many GitLab calls at once.
+
+    It speaks the same `Command` vocabulary and raises the same `ApiError`s as the
+    `Api` it wraps, whose calls it runs on a bounded pool of worker threads (so they
+    share its pooled connections). `run()` does the same for any blocking function,
+    e.g. `await async_api.run(merge_request.fetch_approvals)`.
+    """
+
+    def __init__(self, api, max_concurrency=8):
+        self._api = api
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    @property
+    def api(self):
+        return self._api
+
+    async def run(self, fun, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fun, *args, **kwargs))
+
+    async def call(self, command, sudo=None):
+        return await self.run(self._api.call, command, sudo)
+
+    async def collect_all_pages(self, get_command):
+        return await self.run(self._api.collect_all_pages, get_command)
+
+    async def version(self):
+        return await self.run(self._api.version)
+
+    def run_concurrently(self, awaitables):
+        """Wait for all `awaitables` from blocking code, and return their results in order."""
+        async def gather():
+            return await asyncio.gather(*awaitables)
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(gather())
+        finally:
+            loop.close()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+class RetryPolicy(namedtuple('RetryPolicy', 'max_retries backoff_factor max_backoff')):
+    """How (and how often) to retry API calls that failed for transient reasons."""
+
+    @classmethod
+    def never(cls):
+        return cls(max_retries=0, backoff_factor=0, max_backoff=0)
+
+    def should_retry(self, command, response):
+        if response.status_code == 429:
+            # Too Many Requests; GitLab rejected it without looking, so it is always safe to retry
+            return True
+        return command.idempotent and 500 <= response.status_code < 600
+
+    def backoff(self, attempt):
+        # exponential backoff, with "full jitter" so that retries don't all arrive at once
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def delay(self, attempt, response):
+        retry_after = _retry_after_secs(response.headers.get('Retry-After'))
+        if retry_after is not None:
+            # however long we are told to wait, a worker shouldn't get stuck for hours
+            return min(retry_after, self.max_backoff)
+        return self.backoff(attempt)
+
+
+def _retry_after_secs(value):
+    """Parse a Retry-After header, which is either a number of seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def _make_session(pool_connections, pool_maxsize):
+    """A keep-alive session, so consecutive calls reuse their TCP/TLS connections."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _int_header(headers, name, default=None):
+    """Parse a numeric pagination header; GitLab sends an empty X-Next-Page on the last page."""
+    value = headers.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _next_link(headers):
+    for link in requests.utils.parse_header_links(headers.get('Link', '')):
+        if link.get('rel') == 'next':
+            return link['url']
+    return None
+
+
 def from_singleton_list(fun=None):
     fun = fun or (lambda x: x)
 
@@ -99,15 +381,28 @@ class Command(namedtuple('Command', 'endpoint args extract')):
     def __new__(cls, endpoint, args=None, extract=None):
         return super(Command, cls).__new__(cls, endpoint, args or {}, extract)
 
+    cacheable = False
+    idempotent = True
+    path = API_PATH
+
+    @property
+    def method(self):
+        raise NotImplementedError
+
     @property
     def call_args(self):
         return {'json': self.args}
 
+    def dispatch(self, session, url, **kwargs):
+        return session.request(self.method.upper(), url, **kwargs, **self.call_args)
+
 
 class GET(Command):
+    cacheable = True
+
     @property
     def method(self):
-        return requests.get
+        return 'get'
 
     @property
     def call_args(self):
@@ -117,23 +412,58 @@ class GET(Command):
         args = self.args
         return self._replace(args=dict(args, page=page_no, per_page=100))
 
+    @property
+    def supports_keyset_pagination(self):
+        # GitLab only supports keyset pagination on some listings, and only when ordering by id
+        return (
+            bool(_KEYSET_PAGINATED_ENDPOINTS.match(self.endpoint)) and
+            self.args.get('order_by', 'id') == 'id'
+        )
+
+    def for_keyset(self):
+        args = dict(self.args, pagination='keyset', per_page=100, order_by='id')
+        args.setdefault('sort', 'asc')
+        return self._replace(args=args)
+
+    def for_url(self, url):
+        """The same request, but for the `url` that GitLab linked to (e.g. the next page)."""
+        parsed_url = urllib.parse.urlsplit(url)
+        _, endpoint = parsed_url.path.split(API_PATH, 1)
+        return self._replace(endpoint=endpoint, args=dict(urllib.parse.parse_qsl(parsed_url.query)))
+
+
+# See https://docs.gitlab.com/ee/api/README.html#keyset-based-pagination; merge request
+# listings are not among them, so those keep using offset pagination.
+_KEYSET_PAGINATED_ENDPOINTS = re.compile(r'\A/(projects|groups/[^/]+/projects|users)\Z')
+
 
 class PUT(Command):
     @property
     def method(self):
-        return requests.put
+        return 'put'
 
 
 class POST(Command):
+    idempotent = False
+
     @property
     def method(self):
-        return requests.post
+        return 'post'
 
 
 class DELETE(Command):
     @property
     def method(self):
-        return requests.delete
+        return 'delete'
+
+
+class GRAPHQL(Command):
+    """A GraphQL query; these only read, so are safe to retry, unlike other POSTs."""
+    path = '/api'
+
+    @property
+    def method(self):
+        return 'post'
 
 
 def _prepare_params(params):
@@ -158,6 +488,12 @@ class ApiError(Exception):
         return arg
 
 
+class GraphQLError(ApiError):
+    @property
+    def error_message(self):
+        return '; '.join(error.get('message', '') for error in self.args[1])
+
+
 class BadRequest(ApiError):
     pass
 
@@ -199,14 +535,34 @@ class UnexpectedError(ApiError):
 
 
 class Resource:
+    # The fields of `info` that a resource actually uses. In compact mode, a resource
+    # only keeps these (see `CompactInfo`); None means it always keeps everything.
+    FIELDS = None
+    compact = False
+
     def __init__(self, api, info):
-        self._info = info
         self._api = api
+        self._info = info
 
     @property
     def info(self):
         return self._info
 
+    @property
+    def _info(self):
+        return self.__info
+
+    @_info.setter
+    def _info(self, info):
+        if self.compact and self.FIELDS is not None:
+            info = CompactInfo.type_for(self.__class__)(self._api, info)
+        self.__info = info
+
+    @classmethod
+    def refetch_command(cls, info):  # pylint: disable=unused-argument
+        """The command to fetch all of a resource's info, if we know how."""
+        return None
+
     @property
     def id(self):  # pylint: disable=invalid-name
         return self.info['id']
@@ -219,6 +575,65 @@ class Resource:
         return '{0.__class__.__name__}({0._api}, {0.info})'.format(self)
 
 
+_MISSING = object()
+
+
+class CompactInfo(Mapping):
+    """A read-only stand-in for a resource's info, which only keeps its declared `FIELDS`.
+
+    GitLab sends a lot of things we never look at (descriptions, links, ...), so when we
+    deal with tens of thousands of resources, keeping just what we need in `__slots__`
+    saves a lot of memory. Should anyone need an undeclared field after all, it is
+    looked up by fetching the resource again.
+    """
+    __slots__ = ('_api',)
+    _fields = ()
+    _resource_class = None
+    _types = {}
+
+    def __init__(self, api, info):
+        self._api = api
+        for field in self._fields:
+            setattr(self, field, info.get(field, _MISSING))
+
+    @classmethod
+    def type_for(cls, resource_class):
+        compact_info_type = cls._types.get(resource_class)
+        if compact_info_type is None:
+            fields = tuple(resource_class.FIELDS)
+            compact_info_type = cls._types[resource_class] = type(
+                resource_class.__name__ + 'Info',
+                (cls,),
+                {'__slots__': fields, '_fields': fields, '_resource_class': resource_class},
+            )
+        return compact_info_type
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            value = getattr(self, key)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+
+        command = self._resource_class.refetch_command(self)
+        if command is None:
+            raise KeyError(key)
+        log.warning('%s is not one of the %s FIELDS, refetching it', key, self._resource_class.__name__)
+        return self._api.call(command)[key]
+
+    def __contains__(self, key):
+        return key in self._fields and getattr(self, key) is not _MISSING
+
+    def __iter__(self):
+        return (field for field in self._fields if getattr(self, field) is not _MISSING)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class Version(namedtuple('Version', 'release edition')):
     @classmethod
     def parse(cls, string):
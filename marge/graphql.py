@@ -0,0 +1,116 @@
+"""
+Everything marge needs to know to decide whether it can merge a project's open MRs,
+fetched in a single (paginated) GraphQL query instead of several REST calls per MR.
+"""
+import logging as log
+from collections import namedtuple
+
+
+OPEN_MERGE_REQUESTS_QUERY = '''
+query($fullPath: ID!, $assignee: String, $sort: MergeRequestSort, $after: String) {
+  project(fullPath: $fullPath) {
+    mergeRequests(state: opened, assigneeUsername: $assignee, sort: $sort, first: 100, after: $after) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        id iid title state draft squash webUrl
+        sourceBranch targetBranch sourceProjectId targetProjectId diffHeadSha
+        author { id }
+        assignees { nodes { id } }
+        approvalsLeft
+        approvedBy { nodes { username } }
+        headPipeline { sha status }
+      }
+    }
+  }
+}
+'''
+
+_SORT = {'created_at': 'CREATED_ASC', 'updated_at': 'UPDATED_ASC'}
+
+
+class MergeRequestSnapshot(namedtuple('MergeRequestSnapshot', [
+        'id', 'iid', 'title', 'state', 'work_in_progress', 'squash', 'web_url',
+        'source_branch', 'target_branch', 'source_project_id', 'target_project_id', 'sha',
+        'author_id', 'assignee_ids', 'approvals_left', 'approver_usernames',
+        'pipeline_sha', 'pipeline_status',
+])):
+    """The state of an open MR, as of when it was fetched."""
+    __slots__ = ()
+
+    @classmethod
+    def from_node(cls, node):
+        pipeline = node.get('headPipeline') or {}
+        return cls(
+            id=_id_from_gid(node['id']),
+            iid=int(node['iid']),
+            title=node['title'],
+            state=node['state'],
+            work_in_progress=node['draft'],
+            squash=node['squash'],
+            web_url=node['webUrl'],
+            source_branch=node['sourceBranch'],
+            target_branch=node['targetBranch'],
+            source_project_id=node['sourceProjectId'],
+            target_project_id=node['targetProjectId'],
+            sha=node['diffHeadSha'],
+            author_id=_id_from_gid(node['author']['id']),
+            assignee_ids=[_id_from_gid(assignee['id']) for assignee in node['assignees']['nodes']],
+            approvals_left=node.get('approvalsLeft') or 0,
+            approver_usernames=[user['username'] for user in (node.get('approvedBy') or {}).get('nodes', [])],
+            pipeline_sha=pipeline.get('sha'),
+            # the REST API (and so the rest of marge) uses lowercase statuses
+            pipeline_status=pipeline['status'].lower() if pipeline.get('status') else None,
+        )
+
+    @property
+    def ci_status(self):
+        """The status of the pipeline for the MR's current head, if there is one."""
+        return self.pipeline_status if self.pipeline_sha == self.sha else None
+
+    def merge_request_info(self, project_id):
+        """The subset of the REST API representation of this MR that marge uses."""
+        return {
+            'id': self.id,
+            'iid': self.iid,
+            'project_id': project_id,
+            'title': self.title,
+            'state': self.state,
+            'work_in_progress': self.work_in_progress,
+            'squash': self.squash,
+            'web_url': self.web_url,
+            'source_branch': self.source_branch,
+            'target_branch': self.target_branch,
+            'source_project_id': self.source_project_id,
+            'target_project_id': self.target_project_id,
+            'sha': self.sha,
+            'author': {'id': self.author_id},
+            'assignees': [{'id': assignee_id} for assignee_id in self.assignee_ids],
+        }
+
+
+def fetch_open_merge_requests(api, project_path, *, assignee_username=None, merge_order='created_at'):
+    """Return snapshots of all open MRs of a project (optionally, just those assigned to someone)."""
+    variables = {
+        'fullPath': project_path,
+        'assignee': assignee_username,
+        'sort': _SORT[merge_order],
+        'after': None,
+    }
+    snapshots = []
+    while True:
+        project = api.graphql(OPEN_MERGE_REQUESTS_QUERY, variables)['project']
+        if project is None:
+            log.warning('GraphQL could not find project %s', project_path)
+            return snapshots
+        merge_requests = project['mergeRequests']
+        snapshots.extend(MergeRequestSnapshot.from_node(node) for node in merge_requests['nodes'])
+
+        page_info = merge_requests['pageInfo']
+        if not page_info['hasNextPage']:
+            return snapshots
+        variables = dict(variables, after=page_info['endCursor'])
+
+
+def _id_from_gid(gid):
+    # e.g. 'gid://gitlab/User/123'
+    return int(gid.rsplit('/', 1)[-1])
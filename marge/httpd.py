@@ -0,0 +1,17 @@
+import logging as log
+import threading
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_in_background(handler_class, port, host=''):
+    """Start serving requests with `handler_class` on a daemon thread, and return the server."""
+    server = _ThreadingHTTPServer((host, port), handler_class)
+    thread = threading.Thread(target=server.serve_forever, name=handler_class.__name__, daemon=True)
+    thread.start()
+    log.info('Listening on %s:%s', *server.server_address[:2])
+    return server
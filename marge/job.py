@@ -5,7 +5,7 @@ import time
 from collections import namedtuple
 from datetime import datetime, timedelta
 
-from . import git, gitlab
+from . import git, gitlab, ratelimit
 from .branch import Branch
 from .interval import IntervalUnion
 from .merge_request import MergeRequestRebaseFailed
@@ -14,14 +14,20 @@ from .user import User
 from .pipeline import Pipeline
 
 
+# When webhooks tell us about changes, polling is just a fallback in case we miss some
+POLL_SECS_WITH_WEBHOOKS = 60
+
+
 class MergeJob:
 
-    def __init__(self, *, api, user, project, repo, options):
+    def __init__(self, *, api, user, project, repo, options, events=None, ci_poller=None):
         self._api = api
         self._user = user
         self._project = project
         self._repo = repo
         self._options = options
+        self._events = events
+        self._ci_poller = ci_poller
         self._merge_timeout = timedelta(minutes=5)
 
     @property
@@ -67,6 +73,20 @@ class MergeJob:
         if self._user.id not in merge_request.assignee_ids:
             raise SkipMerge('It is not assigned to me anymore!')
 
+    def snapshot_looks_mergeable(self, snapshot):
+        """Whether a GraphQL `snapshot` of an MR shows it passing all checks but CI.
+
+        If it doesn't, `ensure_mergeable_mr` has the final say (and the details).
+        """
+        return (
+            snapshot.state in ('opened', 'reopened', 'locked') and
+            not snapshot.work_in_progress and
+            not (snapshot.squash and self._options.requests_commit_tagging) and
+            not snapshot.approvals_left and
+            self._user.id in snapshot.assignee_ids and
+            not self.during_merge_embargo()
+        )
+
     def add_trailers(self, merge_request):
 
         log.info('Adding trailers for MR !%s', merge_request.iid)
@@ -161,15 +181,28 @@ class MergeJob:
     def wait_for_ci_to_pass(self, merge_request, commit_sha=None):
         time_0 = datetime.utcnow()
         waiting_time_in_secs = 10
+        ci_was_running = False
 
         if commit_sha is None:
             commit_sha = merge_request.sha
 
+        if self._ci_poller is not None:
+            with ratelimit.background():
+                self._ci_poller.learn_history(self._project.id, self._api)
+
         log.info('Waiting for CI to pass for MR !%s', merge_request.iid)
         while datetime.utcnow() - time_0 < self._options.ci_timeout:
-            ci_status = self.get_mr_ci_status(merge_request, commit_sha=commit_sha)
+            events_cursor = self._events.cursor() if self._events is not None else None
+            poll_started_at = time.monotonic()
+            with ratelimit.background():
+                ci_status = self.get_mr_ci_status(merge_request, commit_sha=commit_sha)
+            poll_secs = time.monotonic() - poll_started_at
+            elapsed_secs = (datetime.utcnow() - time_0).total_seconds()
+
             if ci_status == 'success':
                 log.info('CI for MR !%s passed', merge_request.iid)
+                if self._ci_poller is not None and ci_was_running:
+                    self._ci_poller.record(self._project.id, elapsed_secs)
                 return
 
             if ci_status == 'skipped':
@@ -177,19 +210,37 @@ class MergeJob:
                 return
 
             if ci_status == 'failed':
-                raise CannotMerge('CI failed!')
+                raise CIFailed('CI failed!')
 
             if ci_status == 'canceled':
                 raise CannotMerge('Someone canceled the CI.')
 
-            if ci_status not in ('pending', 'running'):
+            if ci_status in ('pending', 'running'):
+                ci_was_running = True
+            else:
                 log.warning('Suspicious CI status: %r', ci_status)
 
+            if self._ci_poller is not None:
+                waiting_time_in_secs = self._ci_poller.delay(self._project.id, elapsed_secs, poll_secs)
             log.debug('Waiting for %s secs before polling CI status again', waiting_time_in_secs)
-            time.sleep(waiting_time_in_secs)
+            self.wait_for_events(merge_request, events_cursor, waiting_time_in_secs)
 
         raise CannotMerge('CI is taking too long.')
 
+    def wait_for_events(self, merge_request, events_cursor, secs):
+        """Sleep for `secs`; or, if we get webhooks, until something happens around `merge_request`.
+
+        Only events after `events_cursor` count, so that we don't miss any that came in
+        since we last looked.
+        """
+        if self._events is None:
+            time.sleep(secs)
+            return
+        project_ids = {merge_request.source_project_id, merge_request.target_project_id}
+        timeout = max(secs, POLL_SECS_WITH_WEBHOOKS)
+        if self._events.wait_for(project_ids, events_cursor, timeout):
+            log.debug('Woken up by an event for MR !%s', merge_request.iid)
+
     def unassign_from_mr(self, merge_request):
         log.info('Unassigning from MR !%s', merge_request.iid)
         author_id = merge_request.author_id
@@ -208,7 +259,8 @@ class MergeJob:
             # approving is not idempotent, so we need to check first that there are no approvals,
             # otherwise we'll get a failure on trying to re-instate the previous approvals
             def sufficient_approvals():
-                return merge_request.fetch_approvals().sufficient
+                with ratelimit.background():
+                    return merge_request.fetch_approvals().sufficient
             # Make sure we don't race by ensuring approvals have reset since the push
             waiting_time_in_secs = 5
             approval_timeout_in_secs = self._options.approval_timeout.total_seconds()
@@ -385,7 +437,7 @@ class MergeJob:
 def _get_reviewer_names_and_emails(commits, approvals, api):
     """Return a list ['A. Prover <a.prover@example.com', ...]` for `merge_request.`"""
     uids = approvals.approver_ids
-    users = [User.fetch_by_id(uid, api) for uid in uids]
+    users = User.fetch_all_by_id(uids, api)
     self_reviewed = {commit['author_email'] for commit in commits} & {user.email for user in users}
     if self_reviewed and len(users) <= 1:
         raise CannotMerge('Commits require at least one independent reviewer.')
@@ -408,6 +460,7 @@ JOB_OPTIONS = [
     'embargo',
     'ci_timeout',
     'fusion',
+    'use_graphql',
 ]
 
 
@@ -423,6 +476,7 @@ class MergeJobOptions(namedtuple('MergeJobOptions', JOB_OPTIONS)):
             cls, *,
             add_tested=False, add_part_of=False, add_reviewers=False, reapprove=False,
             approval_timeout=None, embargo=None, ci_timeout=None, fusion=Fusion.rebase,
+            use_graphql=False,
     ):
         approval_timeout = approval_timeout or timedelta(seconds=0)
         embargo = embargo or IntervalUnion.empty()
@@ -436,6 +490,7 @@ class MergeJobOptions(namedtuple('MergeJobOptions', JOB_OPTIONS)):
             embargo=embargo,
             ci_timeout=ci_timeout,
             fusion=fusion,
+            use_graphql=use_graphql,
         )
 
 
@@ -453,6 +508,10 @@ class SkipMerge(CannotMerge):
     pass
 
 
+class CIFailed(CannotMerge):
+    pass
+
+
 class GitLabRebaseResultMismatch(CannotMerge):
     def __init__(self, gitlab_sha, expected_sha):
         super(GitLabRebaseResultMismatch, self).__init__(
@@ -1,14 +1,24 @@
 import logging as log
+import re
 import time
 
-from . import gitlab
+from . import gitlab, ratelimit
 from .approvals import Approvals
 
 
 GET, POST, PUT, DELETE = gitlab.GET, gitlab.POST, gitlab.PUT, gitlab.DELETE
 
 
-class MergeRequest(gitlab.Resource):
+class MergeRequest(gitlab.Resource):  # pylint: disable=too-many-public-methods
+    FIELDS = (
+        'id', 'iid', 'project_id', 'title', 'state', 'rebase_in_progress', 'merge_error',
+        'assignee', 'assignees', 'author', 'source_branch', 'target_branch', 'sha', 'squash',
+        'source_project_id', 'target_project_id', 'work_in_progress', 'approved_by', 'web_url',
+    )
+
+    @classmethod
+    def refetch_command(cls, info):
+        return GET('/projects/{0[project_id]}/merge_requests/{0[iid]}'.format(info))
 
     @classmethod
     def create(cls, api, project_id, params):
@@ -21,7 +31,7 @@ class MergeRequest(gitlab.Resource):
 
     @classmethod
     def search(cls, api, project_id, params):
-        merge_requests = api.collect_all_pages(GET(
+        merge_requests = api.iter_pages(GET(
             '/projects/{project_id}/merge_requests'.format(project_id=project_id),
             params,
         ))
@@ -34,19 +44,37 @@ class MergeRequest(gitlab.Resource):
         return merge_request
 
     @classmethod
-    def fetch_all_open_for_user(cls, project_id, user_id, api, merge_order):
-        all_merge_request_infos = api.collect_all_pages(GET(
+    def fetch_all_open_for_user(
+            cls, project_id, user_id, api, merge_order, *,
+            target_branch=None, source_branch=None,
+    ):
+        params = {'state': 'opened', 'order_by': merge_order, 'sort': 'asc', 'assignee_id': user_id}
+        if target_branch is not None:
+            params['target_branch'] = target_branch
+        if source_branch is not None:
+            params['source_branch'] = source_branch
+        all_merge_request_infos = api.iter_pages(GET(
             '/projects/{project_id}/merge_requests'.format(project_id=project_id),
-            {'state': 'opened', 'order_by': merge_order, 'sort': 'asc'},
+            params,
         ))
-        my_merge_request_infos = [
+        # GitLab already filtered them, but better safe than sorry
+        my_merge_request_infos = (
             mri for mri in all_merge_request_infos
             if ((mri.get('assignee', {}) or {}).get('id') == user_id) or
                (user_id in [assignee.get('id') for assignee in (mri.get('assignees', []) or [])])
-        ]
+        )
 
         return [cls(api, merge_request_info) for merge_request_info in my_merge_request_infos]
 
+    @classmethod
+    def fetch_all_open_assigned_to_me(cls, api, merge_order):
+        """All open MRs assigned to the API user, across all projects."""
+        merge_request_infos = api.iter_pages(GET(
+            '/merge_requests',
+            {'scope': 'assigned_to_me', 'state': 'opened', 'order_by': merge_order, 'sort': 'asc'},
+        ))
+        return [cls(api, merge_request_info) for merge_request_info in merge_request_infos]
+
     @property
     def project_id(self):
         return self.info['project_id']
@@ -144,7 +172,8 @@ class MergeRequest(gitlab.Resource):
         wait_between_attempts_in_secs = 1
 
         for _ in range(max_attempts):
-            self.refetch_info()
+            with ratelimit.background():
+                self.refetch_info()
             if not self.rebase_in_progress:
                 if self.merge_error:
                     raise MergeRequestRebaseFailed(self.merge_error)
@@ -192,3 +221,20 @@ class MergeRequest(gitlab.Resource):
 
 class MergeRequestRebaseFailed(Exception):
     pass
+
+
+# An optional \A or ^, then literal characters (escaped ones included), then \Z or $
+_LITERAL_PATTERN = re.compile(r'\A(?:\^|\\A)?((?:[^\\.^$*+?{}\[\]|()]|\\[^A-Za-z0-9])*)(?:\$|\\Z)\Z')
+
+
+def literal_branch(branch_regexp):
+    """The only branch name that `branch_regexp.match()`es, if there is just one, else None.
+
+    This allows us to have GitLab do the filtering for us.
+    """
+    if branch_regexp.flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+    match = _LITERAL_PATTERN.match(branch_regexp.pattern)
+    if match is None:
+        return None
+    return re.sub(r'\\(.)', r'\1', match.group(1)) or None
@@ -0,0 +1,117 @@
+import re
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler
+
+from . import httpd
+
+# in seconds; GitLab calls take anything from a few milliseconds to our 60s timeout
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_ENDPOINT_PLACEHOLDERS = [
+    (re.compile(r'/repository/branches/.+'), '/repository/branches/:branch'),
+    (re.compile(r'/repository/commits/[^/]+'), '/repository/commits/:sha'),
+    (re.compile(r'/(projects|groups|users|merge_requests|pipelines|notes)/[^/]+'), r'/\1/:id'),
+]
+
+
+def endpoint_template(endpoint):
+    """Turn e.g. /projects/12/merge_requests/34 into /projects/:id/merge_requests/:id."""
+    for regexp, placeholder in _ENDPOINT_PLACEHOLDERS:
+        endpoint = regexp.sub(placeholder, endpoint)
+    return endpoint
+
+
+def status_class(status_code):
+    return 'error' if status_code is None else '%dxx' % (status_code // 100)
+
+
+class _Histogram:  # pylint: disable=too-few-public-methods
+    def __init__(self, buckets):
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, buckets, value):
+        for i, upper_bound in enumerate(buckets):
+            if value <= upper_bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class ApiMetrics:
+    """Counts GitLab API calls and their latencies, by method, endpoint template and status class."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._calls = defaultdict(int)
+        self._latencies = {}
+
+    def observe(self, method, endpoint, status_code, secs):
+        labels = (method.upper(), endpoint_template(endpoint), status_class(status_code))
+        with self._lock:
+            self._calls[labels] += 1
+            histogram = self._latencies.get(labels)
+            if histogram is None:
+                histogram = self._latencies[labels] = _Histogram(self._buckets)
+            histogram.observe(self._buckets, secs)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = [
+            '# HELP marge_gitlab_api_calls_total GitLab API calls made.',
+            '# TYPE marge_gitlab_api_calls_total counter',
+        ]
+        with self._lock:
+            for labels, count in sorted(self._calls.items()):
+                lines.append('marge_gitlab_api_calls_total{%s} %d' % (_format_labels(labels), count))
+
+            lines.extend([
+                '# HELP marge_gitlab_api_call_duration_seconds Latency of GitLab API calls.',
+                '# TYPE marge_gitlab_api_call_duration_seconds histogram',
+            ])
+            for labels, histogram in sorted(self._latencies.items()):
+                formatted_labels = _format_labels(labels)
+                for upper_bound, bucket_count in zip(self._buckets, histogram.bucket_counts):
+                    lines.append('marge_gitlab_api_call_duration_seconds_bucket{%s,le="%s"} %d' % (
+                        formatted_labels, upper_bound, bucket_count,
+                    ))
+                lines.append('marge_gitlab_api_call_duration_seconds_bucket{%s,le="+Inf"} %d' % (
+                    formatted_labels, histogram.count,
+                ))
+                lines.append('marge_gitlab_api_call_duration_seconds_sum{%s} %s' % (
+                    formatted_labels, histogram.sum,
+                ))
+                lines.append('marge_gitlab_api_call_duration_seconds_count{%s} %d' % (
+                    formatted_labels, histogram.count,
+                ))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host=''):
+        """Export the metrics over HTTP (on any path, e.g. /metrics) from a background thread."""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass  # don't log every scrape
+
+        return httpd.serve_in_background(MetricsHandler, port, host)
+
+
+def _format_labels(labels):
+    method, path, status = labels
+    return 'method="%s",path="%s",status="%s"' % (_escape(method), _escape(path), _escape(status))
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
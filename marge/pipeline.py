@@ -1,3 +1,5 @@
+import maya
+
 from . import gitlab
 
 
@@ -5,15 +7,22 @@ GET, POST = gitlab.GET, gitlab.POST
 
 
 class Pipeline(gitlab.Resource):
+    FIELDS = ('id', 'project_id', 'status', 'ref', 'sha', 'created_at', 'updated_at', 'finished_at')
+
     def __init__(self, api, info, project_id):
         info['project_id'] = project_id
         super().__init__(api, info)
 
+    @classmethod
+    def refetch_command(cls, info):
+        return GET('/projects/{0[project_id]}/pipelines/{0[id]}'.format(info))
+
     @classmethod
     def pipelines_by_branch(
             cls, project_id, branch, api, *,
             ref=None,
             status=None,
+            sha=None,
             order_by='id',
             sort='desc',
     ):
@@ -24,6 +33,8 @@ class Pipeline(gitlab.Resource):
         }
         if status is not None:
             params['status'] = status
+        if sha is not None:
+            params['sha'] = sha
         pipelines_info = api.call(GET(
             '/projects/{project_id}/pipelines'.format(project_id=project_id),
             params,
@@ -42,6 +53,15 @@ class Pipeline(gitlab.Resource):
         pipelines_info.sort(key=lambda pipeline_info: pipeline_info['id'], reverse=True)
         return [cls(api, pipeline_info, project_id) for pipeline_info in pipelines_info]
 
+    @classmethod
+    def recent(cls, project_id, api, *, status='success', count=20):
+        """Fetch the latest `count` pipelines of a project with `status`, newest first."""
+        pipelines_info = api.call(GET(
+            '/projects/{project_id}/pipelines'.format(project_id=project_id),
+            {'status': status, 'order_by': 'id', 'sort': 'desc', 'per_page': count},
+        ))
+        return [cls(api, pipeline_info, project_id) for pipeline_info in pipelines_info]
+
     @property
     def project_id(self):
         return self.info['project_id']
@@ -62,6 +82,19 @@ class Pipeline(gitlab.Resource):
     def sha(self):
         return self.info['sha']
 
+    @property
+    def duration(self):
+        """Secs from when the pipeline was created to when it finished, queueing included.
+
+        GitLab doesn't include `finished_at` in pipeline listings, but for finished
+        pipelines, `updated_at` is a good approximation. None if we can't tell.
+        """
+        created_at = self.info.get('created_at')
+        finished_at = self.info.get('finished_at') or self.info.get('updated_at')
+        if not (created_at and finished_at):
+            return None
+        return (maya.parse(finished_at).datetime() - maya.parse(created_at).datetime()).total_seconds()
+
     def cancel(self):
         return self._api.call(POST(
             '/projects/{0.project_id}/pipelines/{0.id}/cancel'.format(self),
@@ -1,6 +1,5 @@
 import logging as log
 from enum import IntEnum, unique
-from functools import partial
 
 from . import gitlab
 
@@ -9,6 +8,15 @@ GET = gitlab.GET
 
 
 class Project(gitlab.Resource):
+    FIELDS = (
+        'id', 'path_with_namespace', 'ssh_url_to_repo', 'merge_requests_enabled',
+        'only_allow_merge_if_pipeline_succeeds', 'only_allow_merge_if_all_discussions_are_resolved',
+        'approvals_before_merge', 'permissions',
+    )
+
+    @classmethod
+    def refetch_command(cls, info):
+        return GET('/projects/{0[id]}'.format(info))
 
     @classmethod
     def fetch_by_id(cls, project_id, api):
@@ -17,20 +25,18 @@ class Project(gitlab.Resource):
 
     @classmethod
     def fetch_by_path(cls, project_path, api):
-        def filter_by_path_with_namespace(projects):
-            return [p for p in projects if p['path_with_namespace'] == project_path]
-
-        make_project = partial(cls, api)
-
-        all_projects = api.collect_all_pages(GET('/projects'))
-        return gitlab.from_singleton_list(make_project)(filter_by_path_with_namespace(all_projects))
+        all_projects = api.iter_pages(GET('/projects'))
+        # paths are unique, so we can stop listing as soon as we find it
+        return next((cls(api, p) for p in all_projects if p['path_with_namespace'] == project_path), None)
 
     @classmethod
-    def fetch_all_mine(cls, api):
+    def fetch_all_mine(cls, api, last_activity_after=None):
         projects_kwargs = {'membership': True,
                            'with_merge_requests_enabled': True,
                            'archived': False,
                            }
+        if last_activity_after is not None:
+            projects_kwargs['last_activity_after'] = last_activity_after.strftime('%Y-%m-%dT%H:%M:%SZ')
 
         # GitLab has an issue where projects may not show appropriate permissions in nested groups. Using
         # `min_access_level` is known to provide the correct projects, so we'll prefer this method
@@ -39,7 +45,7 @@ class Project(gitlab.Resource):
         if use_min_access_level:
             projects_kwargs["min_access_level"] = int(AccessLevel.developer)
 
-        projects_info = api.collect_all_pages(GET(
+        projects_info = api.iter_pages(GET(
             '/projects',
             projects_kwargs,
         ))
@@ -62,7 +68,7 @@ class Project(gitlab.Resource):
                 # We know we fetched projects with at least developer access, so we'll use that as
                 # a fallback if GitLab doesn't correctly report permissions as described above.
                 project_info["permissions"]["marge"] = {"access_level": AccessLevel.developer}
-            elif not project_seems_ok(projects_info):
+            elif not project_seems_ok(project_info):
                 continue
 
             projects.append(cls(api, project_info))
@@ -0,0 +1,112 @@
+import contextlib
+import logging as log
+import threading
+import time
+from enum import IntEnum, unique
+
+
+@unique
+class Priority(IntEnum):
+    background = 0
+    normal = 1
+
+
+_context = threading.local()
+
+
+def current_priority():
+    return getattr(_context, 'priority', Priority.normal)
+
+
+@contextlib.contextmanager
+def prioritized(priority):
+    previous = current_priority()
+    _context.priority = priority
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def background():
+    """API calls made within this block (e.g. polling) give way to more urgent ones
+    when we are running out of requests."""
+    return prioritized(Priority.background)
+
+
+class RateLimiter:
+    """A token bucket pacing our API calls so that we don't run into GitLab's rate limits.
+
+    The bucket refills at `rate` requests per second (no limit if None or 0) but, whenever
+    GitLab tells us how many requests we have left until its limit resets (`RateLimit-Remaining`
+    and `RateLimit-Reset`), we slow down to spread those evenly until then. Background calls
+    only go ahead while the bucket holds more than `background_reserve` of its capacity.
+    """
+
+    def __init__(
+            self, rate=None, burst=10, background_reserve=0.25, *,
+            clock=time.monotonic, wall_clock=time.time, sleep=time.sleep,
+    ):
+        assert burst >= 1
+        self._rate = rate or None
+        self._burst = burst
+        self._reserve = background_reserve * burst
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated_at = clock()
+        self._server_rate = None
+        self._server_rate_until = None
+
+    def _current_rate(self, now):
+        if self._server_rate_until is not None and now < self._server_rate_until:
+            if self._rate is None:
+                return self._server_rate
+            return min(self._rate, self._server_rate)
+        return self._rate
+
+    def _refill(self, now):
+        rate = self._current_rate(now)
+        if rate is None:
+            self._tokens = float(self._burst)
+        else:
+            self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * rate)
+        self._updated_at = now
+        return rate
+
+    def acquire(self, priority=None):
+        priority = current_priority() if priority is None else priority
+        # however little room there is for a reserve, the bucket can always fill up again
+        needed = 1 if priority >= Priority.normal else min(1 + self._reserve, self._burst)
+        while True:
+            with self._lock:
+                now = self._clock()
+                rate = self._refill(now)
+                if self._tokens >= needed:
+                    self._tokens -= 1
+                    return
+                if rate:
+                    delay = (needed - self._tokens) / rate
+                else:
+                    # GitLab says we have used up all our requests; wait for its limit to reset
+                    # (without its say-so, we'd have been refilled above)
+                    delay = max(0, self._server_rate_until - now)
+            log.debug('Rate limiting %s API call for %.2f secs', priority.name, delay)
+            self._sleep(delay)
+
+    def update(self, headers):
+        try:
+            remaining = int(headers['RateLimit-Remaining'])
+            reset_at = int(headers['RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return
+
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            secs_until_reset = max(1, reset_at - self._wall_clock())
+            self._server_rate = remaining / secs_until_reset
+            self._server_rate_until = now + secs_until_reset
+            self._tokens = min(self._tokens, remaining)
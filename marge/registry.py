@@ -0,0 +1,49 @@
+import logging as log
+from datetime import datetime, timedelta
+
+from .project import Project
+
+
+class ProjectRegistry:
+    """Keeps track of our projects, so we don't have to list them all on every cycle.
+
+    Between full refreshes, we only ask GitLab for projects with activity since the
+    previous refresh. Those are worth checking for MRs sooner than the rest.
+    """
+
+    def __init__(
+            self, api, *,
+            full_refresh_interval, activity_margin=timedelta(minutes=10), clock=datetime.utcnow,
+    ):
+        self._api = api
+        self._full_refresh_interval = full_refresh_interval
+        # GitLab only updates last_activity_at every few minutes, and our clocks may differ
+        self._activity_margin = activity_margin
+        self._clock = clock
+        self._projects = {}
+        self._last_refresh = None
+        self._last_full_refresh = None
+
+    def refresh(self):
+        """Update our projects; return those that had activity since the last refresh."""
+        now = self._clock()
+        if self._last_full_refresh is None or now - self._last_full_refresh >= self._full_refresh_interval:
+            log.info('Listing all my projects...')
+            active_projects = Project.fetch_all_mine(self._api)
+            self._projects = {project.id: project for project in active_projects}
+            self._last_full_refresh = now
+        else:
+            since = self._last_refresh - self._activity_margin
+            log.info('Listing my projects with activity since %s...', since)
+            active_projects = Project.fetch_all_mine(self._api, last_activity_after=since)
+            self._projects.update((project.id, project) for project in active_projects)
+        self._last_refresh = now
+        return active_projects
+
+    def get(self, project_id):
+        """The project with `project_id`, if it is one of ours as far as we know."""
+        return self._projects.get(project_id)
+
+    def projects(self):
+        """All our projects, as of the last refresh."""
+        return list(self._projects.values())
@@ -0,0 +1,88 @@
+import heapq
+import itertools
+import time
+
+
+class Scheduler:
+    """Decides when each project is next due to be checked for MRs.
+
+    Projects are kept in a priority queue keyed by when they are next due. Those in
+    which there was something to do are checked again after `min_interval` secs; each
+    time there is nothing to do, a project's interval grows by `backoff`, up to
+    `max_interval` secs. So idle projects cost little, however many of them there are.
+    """
+
+    def __init__(self, *, min_interval=10, max_interval=300, backoff=2, clock=time.monotonic):
+        self._min_interval = min(min_interval, max_interval)
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._clock = clock
+        self._queue = []  # of (due, seq, project_id); some may be stale
+        self._seq = itertools.count()  # so that ties go to whoever was scheduled first
+        self._due_by_project_id = {}
+        self._interval_by_project_id = {}
+
+    def __contains__(self, project_id):
+        return project_id in self._interval_by_project_id
+
+    def __len__(self):
+        return len(self._interval_by_project_id)
+
+    def sync(self, project_ids):
+        """Track exactly `project_ids`: new ones are due right away, gone ones are dropped."""
+        project_ids = set(project_ids)
+        for project_id in set(self._interval_by_project_id) - project_ids:
+            del self._interval_by_project_id[project_id]
+            self._due_by_project_id.pop(project_id, None)
+        for project_id in project_ids - set(self._interval_by_project_id):
+            self._interval_by_project_id[project_id] = self._min_interval
+            self._schedule(project_id, self._clock())
+
+    def wake(self, project_ids):
+        """Make (the tracked ones of) `project_ids` due right away, as something happened in them."""
+        now = self._clock()
+        for project_id in project_ids:
+            if project_id not in self:
+                continue
+            self._interval_by_project_id[project_id] = self._min_interval
+            # projects being checked right now will be scheduled when they are done
+            if self._due_by_project_id.get(project_id, now) > now:
+                self._schedule(project_id, now)
+
+    def pop_due(self):
+        """Return the ids of the projects that are due, most overdue first.
+
+        They are not scheduled again until they are `done`.
+        """
+        now = self._clock()
+        project_ids = []
+        while self._queue and self._queue[0][0] <= now:
+            due, _, project_id = heapq.heappop(self._queue)
+            if self._due_by_project_id.get(project_id) == due:
+                del self._due_by_project_id[project_id]
+                project_ids.append(project_id)
+        return project_ids
+
+    def done(self, project_id, busy):
+        """Schedule the next check of a project, depending on whether it was `busy`."""
+        if project_id not in self:
+            return
+        if busy:
+            interval = self._min_interval
+        else:
+            interval = min(self._interval_by_project_id[project_id] * self._backoff, self._max_interval)
+        self._interval_by_project_id[project_id] = interval
+        self._schedule(project_id, self._clock() + interval)
+
+    def secs_until_next(self):
+        """How long until the next project is due (None if there are none scheduled)."""
+        while self._queue and self._due_by_project_id.get(self._queue[0][2]) != self._queue[0][0]:
+            heapq.heappop(self._queue)
+        if not self._queue:
+            return None
+        return max(0, self._queue[0][0] - self._clock())
+
+    def _schedule(self, project_id, due):
+        # any earlier entry for the project is left in the queue, and skipped once popped
+        self._due_by_project_id[project_id] = due
+        heapq.heappush(self._queue, (due, next(self._seq), project_id))
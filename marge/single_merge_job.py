@@ -3,16 +3,24 @@ import logging as log
 import time
 from datetime import datetime
 
-from . import git, gitlab
+from . import git, gitlab, ratelimit
 from .commit import Commit
 from .job import CannotMerge, GitLabRebaseResultMismatch, MergeJob, SkipMerge
 
 
 class SingleMergeJob(MergeJob):
 
-    def __init__(self, *, api, user, project, repo, options, merge_request):
-        super().__init__(api=api, user=user, project=project, repo=repo, options=options)
+    def __init__(
+            self, *, api, user, project, repo, options, merge_request,
+            snapshot=None, events=None, ci_poller=None,
+    ):
+        super().__init__(
+            api=api, user=user, project=project, repo=repo, options=options,
+            events=events, ci_poller=ci_poller,
+        )
         self._merge_request = merge_request
+        # The MR's GraphQL snapshot, as of when it was listed
+        self._snapshot = snapshot
 
     def execute(self):
         merge_request = self._merge_request
@@ -44,9 +52,13 @@ class SingleMergeJob(MergeJob):
         api = self._api
         merge_request = self._merge_request
         updated_into_up_to_date_target_branch = False
+        snapshot = self._snapshot
 
         while not updated_into_up_to_date_target_branch:
-            self.ensure_mergeable_mr(merge_request)
+            if snapshot is None or not self.snapshot_looks_mergeable(snapshot):
+                self.ensure_mergeable_mr(merge_request)
+            # Once we've touched the MR, the snapshot is out of date
+            snapshot = None
             source_project, source_repo_url, _ = self.fetch_source_project(merge_request)
             target_project = self.get_target_project(merge_request)
             try:
@@ -148,7 +160,9 @@ class SingleMergeJob(MergeJob):
         waiting_time_in_secs = 10
 
         while datetime.utcnow() - time_0 < self._merge_timeout:
-            merge_request.refetch_info()
+            events_cursor = self._events.cursor() if self._events is not None else None
+            with ratelimit.background():
+                merge_request.refetch_info()
 
             if merge_request.state == 'merged':
                 return  # success!
@@ -157,6 +171,6 @@ class SingleMergeJob(MergeJob):
             assert merge_request.state in ('opened', 'reopened', 'locked'), merge_request.state
 
             log.info('Giving %s more secs for !%s to be merged...', waiting_time_in_secs, merge_request.iid)
-            time.sleep(waiting_time_in_secs)
+            self.wait_for_events(merge_request, events_cursor, waiting_time_in_secs)
 
         raise CannotMerge('It is taking too long to see the request marked as merged!')
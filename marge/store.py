@@ -1,4 +1,5 @@
 import tempfile
+import threading
 
 from . import git
 
@@ -12,27 +13,54 @@ class RepoManager:
         self._repos = {}
         self._timeout = timeout
         self._reference = reference
+        # Guards the dicts; cloning only holds the lock for its key, so lookups don't wait for it
+        self._lock = threading.Lock()
+        self._locks_by_key = {}
 
-    def repo_for_project(self, project):
-        repo = self._repos.get(project.id)
-        if not repo or repo.remote_url != project.ssh_url_to_repo:
-            repo_url = project.ssh_url_to_repo
-            local_repo_dir = tempfile.mkdtemp(dir=self._root_dir)
+    def repo_for_project(self, project, target_branch=None):
+        """A clone of `project`; a separate one for merging into `target_branch`, if given.
 
-            repo = git.Repo(repo_url, local_repo_dir, ssh_key_file=self._ssh_key_file,
-                            timeout=self._timeout, reference=self._reference)
-            repo.clone()
-            repo.config_user_info(
-                user_email=self._user.email,
-                user_name=self._user.name,
-            )
+        Jobs for different target branches then don't get in each other's way.
+        """
+        key = project.id if target_branch is None else (project.id, target_branch)
+        with self._lock:
+            repo = self._repos.get(key)
+            if repo and repo.remote_url == project.ssh_url_to_repo:
+                return repo
+            key_lock = self._locks_by_key.setdefault(key, threading.Lock())
 
-            self._repos[project.id] = repo
+        with key_lock:
+            with self._lock:
+                repo = self._repos.get(key)
+            # someone else may have cloned it whilst we waited
+            if not repo or repo.remote_url != project.ssh_url_to_repo:
+                repo = self._clone(project, target_branch)
+                with self._lock:
+                    self._repos[key] = repo
+        return repo
+
+    def _clone(self, project, target_branch):
+        repo_url = project.ssh_url_to_repo
+        local_repo_dir = tempfile.mkdtemp(dir=self._root_dir)
+        reference = self._reference
+        if target_branch is not None:
+            # borrow the objects of the project's main clone, instead of fetching them all again
+            reference = self.repo_for_project(project).local_path
 
+        repo = git.Repo(repo_url, local_repo_dir, ssh_key_file=self._ssh_key_file,
+                        timeout=self._timeout, reference=reference)
+        repo.clone()
+        repo.config_user_info(
+            user_email=self._user.email,
+            user_name=self._user.name,
+        )
         return repo
 
     def forget_repo(self, project):
-        self._repos.pop(project.id, None)
+        with self._lock:
+            for key in list(self._repos):
+                if key == project.id or (isinstance(key, tuple) and key[0] == project.id):
+                    del self._repos[key]
 
     @property
     def user(self):
@@ -0,0 +1,158 @@
+# pylint: disable=too-many-branches,too-many-statements
+import logging as log
+from collections import namedtuple
+
+from . import git
+from .batch_job import BatchMergeJob, CannotBatch
+from .job import CannotMerge, CIFailed
+
+
+class Car(namedtuple('Car', 'slot branch merge_request batch_mr')):
+    """A branch with the target branch plus an MR and all MRs ahead of it in the train.
+
+    If CI has to pass, it is tested through `batch_mr`, which is otherwise None.
+    """
+    __slots__ = ()
+
+
+class MergeTrainJob(BatchMergeJob):
+    """Merges MRs one by one, whilst already testing the ones behind them.
+
+    Each car of the train tests an MR on top of all the MRs ahead of it, so that up to
+    `depth` pipelines run at the same time, and an MR whose car passed CI can be merged
+    right away. If a car fails CI, its MR is to blame: it is taken off the train, and the
+    cars behind it get rebuilt without it.
+    """
+
+    def __init__(
+            self, *, api, user, project, repo, options, merge_requests, depth,
+            snapshots=None, events=None, ci_poller=None,
+    ):
+        super().__init__(
+            api=api, user=user, project=project, repo=repo, options=options,
+            merge_requests=merge_requests, snapshots=snapshots, events=events, ci_poller=ci_poller,
+        )
+        assert depth >= 1
+        self._depth = depth
+        # MRs told about the train already, so that rebuilding their cars doesn't spam them
+        self._boarded_iids = set()
+        # Slots whose car branches were pushed, to remove them once done
+        self._pushed_slots = set()
+
+    def car_branch_name(self, slot):
+        return '{}_{}'.format(self.batch_branch_name, slot)
+
+    def add_car(self, train, merge_request):
+        """Build (and push) a car for `merge_request` behind those in `train`; None if it conflicts."""
+        base = train[-1].branch if train else self.target_branch
+        # Slots are reused, so that there are never more than `depth` car branches around
+        slot = min(set(range(self._depth)) - {car.slot for car in train})
+        branch = self.car_branch_name(slot)
+        try:
+            _, source_repo_url, merge_request_remote = self.fetch_source_project(merge_request)
+            self._repo.checkout_branch(branch, base)
+            self._repo.checkout_branch(
+                merge_request.source_branch,
+                '%s/%s' % (merge_request_remote, merge_request.source_branch),
+            )
+            self.fuse(
+                merge_request.source_branch,
+                branch,
+                source_repo_url=source_repo_url,
+                local=True,
+            )
+            self._repo.fast_forward(branch, merge_request.source_branch, local=True)
+            self._repo.remove_branch(merge_request.source_branch)
+        except git.GitError:
+            log.warning('Skipping MR !%s, got conflicts while rebasing', merge_request.iid)
+            return None
+
+        batch_mr = None
+        if self._project.only_allow_merge_if_pipeline_succeeds:
+            log.info('Pushing merge train car %s for MR !%s', branch, merge_request.iid)
+            self._pushed_slots.add(slot)
+            self._repo.push(branch, force=True)
+            batch_mr = self.create_batch_mr(target_branch=self.target_branch, source_branch=branch)
+            if merge_request.iid not in self._boarded_iids:
+                self._boarded_iids.add(merge_request.iid)
+                merge_request.comment(
+                    'I will attempt to merge this MR in a merge train (!{})...'.format(batch_mr.iid),
+                )
+        return Car(slot=slot, branch=branch, merge_request=merge_request, batch_mr=batch_mr)
+
+    def wait_for_car_ci_to_pass(self, car):
+        try:
+            self.wait_for_ci_to_pass(car.batch_mr)
+        except CIFailed as err:
+            # All MRs ahead of it have been merged, so this one must be to blame
+            self.unassign_from_mr(car.merge_request)
+            car.merge_request.comment("I couldn't merge this branch: %s" % err.reason)
+            raise
+        except CannotMerge as err:
+            # Not the MR's fault (e.g. CI timed out, or was canceled), so give up for now
+            self.comment_batch_failed([car.merge_request], car.batch_mr, err.reason)
+            raise CannotBatch(err.reason) from err
+
+    def remove_car(self, car):
+        if car.batch_mr is not None:
+            log.info('Closing batch MR !%s', car.batch_mr.iid)
+            car.batch_mr.close()
+
+    def remove_car_branches(self):
+        log.info('Removing remote merge train branches')
+        branches = [self.car_branch_name(slot) for slot in sorted(self._pushed_slots)]
+        try:
+            self._repo.remove_remote_branches(*branches)
+        except git.GitError:
+            # Not worth failing over: they get overwritten by the next merge train anyway
+            log.warning('Failed to remove remote merge train branches', exc_info=True)
+        self._pushed_slots.clear()
+
+    def execute(self):
+        # Cleanup previous work
+        self.close_batch_mr()
+
+        target_branch = self.target_branch
+        merge_requests = self.get_mrs_with_common_target_branch(target_branch)
+        pending = self.get_mergeable_mrs(merge_requests)
+
+        if len(pending) <= 1:
+            raise CannotBatch('not enough ready merge requests')
+
+        self._repo.fetch('origin')
+
+        # Save the sha of remote <target_branch> so we can use it to make sure
+        # the remote wasn't changed while we're testing against it
+        remote_target_branch_sha = self._repo.get_commit_hash('origin/%s' % target_branch)
+        self._repo.checkout_branch(target_branch, 'origin/%s' % target_branch)
+
+        train = []
+        try:
+            while True:
+                while pending and len(train) < self._depth:
+                    car = self.add_car(train, pending.pop(0))
+                    if car is not None:
+                        train.append(car)
+                if not train:
+                    return
+
+                car = train.pop(0)
+                merge_request = car.merge_request
+                try:
+                    if car.batch_mr is not None:
+                        self.wait_for_car_ci_to_pass(car)
+                    remote_target_branch_sha = self.accept_tested_mr(merge_request, remote_target_branch_sha)
+                except CannotMerge as err:
+                    log.warning('Taking MR !%s off the merge train: %s', merge_request.iid, err.reason)
+                    # The cars behind were all tested with this MR in them
+                    for invalid_car in train:
+                        self.remove_car(invalid_car)
+                    pending[:0] = [invalid_car.merge_request for invalid_car in train]
+                    train = []
+                finally:
+                    self.remove_car(car)
+        finally:
+            for car in train:
+                self.remove_car(car)
+            if self._pushed_slots:
+                self.remove_car_branches()
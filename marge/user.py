@@ -5,6 +5,15 @@ GET = gitlab.GET
 
 
 class User(gitlab.Resource):
+    FIELDS = ('id', 'username', 'name', 'email', 'state', 'is_admin')
+    # Where fetch_all_by_id keeps users across jobs, e.g. a cache.LRUCache (None to not keep them)
+    cache = None
+    # How many users fetch_all_by_id fetches at the same time
+    fetch_workers = 4
+
+    @classmethod
+    def refetch_command(cls, info):
+        return GET('/users/{0[id]}'.format(info))
 
     @classmethod
     def myself(cls, api):
@@ -29,6 +38,33 @@ class User(gitlab.Resource):
         info = api.call(GET('/users/%s' % user_id))
         return cls(api, info)
 
+    @classmethod
+    def fetch_all_by_id(cls, user_ids, api):
+        """Return the users with `user_ids`, fetching those we don't have in `User.cache` all at once."""
+        users_by_id = {}
+        if cls.cache is not None:
+            for user_id in user_ids:
+                user = cls.cache.get(user_id)
+                if user is not None:
+                    users_by_id[user_id] = user
+
+        missing_user_ids = list(dict.fromkeys(user_id for user_id in user_ids if user_id not in users_by_id))
+
+        if len(missing_user_ids) > 1:
+            max_concurrency = min(cls.fetch_workers, len(missing_user_ids))
+            with gitlab.AsyncApi(api, max_concurrency=max_concurrency) as async_api:
+                fetched_users = async_api.run_concurrently([
+                    async_api.run(cls.fetch_by_id, user_id, api) for user_id in missing_user_ids
+                ])
+        else:
+            fetched_users = [cls.fetch_by_id(user_id, api) for user_id in missing_user_ids]
+
+        for user_id, user in zip(missing_user_ids, fetched_users):
+            users_by_id[user_id] = user
+            if cls.cache is not None:
+                cls.cache.put(user_id, user)
+        return [users_by_id[user_id] for user_id in user_ids]
+
     @classmethod
     def fetch_by_username(cls, username, api):
         info = api.call(GET(
@@ -0,0 +1,123 @@
+"""
+Receives GitLab webhooks, so that marge can react to what happens right away
+instead of waiting for its next poll.
+"""
+import hmac
+import json
+import logging as log
+import threading
+from http.server import BaseHTTPRequestHandler
+
+from . import httpd
+
+
+# Pipelines in these states are yet to tell us anything new
+_UNFINISHED_PIPELINE_STATUSES = frozenset((
+    'created', 'waiting_for_resource', 'preparing', 'pending', 'running', 'scheduled',
+))
+
+
+def project_ids_of(payload):
+    """The ids of the projects that a webhook `payload` says something happened in."""
+    kind = payload.get('object_kind')
+    if kind == 'merge_request':
+        attributes = payload.get('object_attributes') or {}
+        project_ids = {attributes.get('target_project_id'), attributes.get('source_project_id')}
+    elif kind == 'pipeline':
+        attributes = payload.get('object_attributes') or {}
+        if attributes.get('status') in _UNFINISHED_PIPELINE_STATUSES:
+            return set()
+        project_ids = {(payload.get('project') or {}).get('id')}
+        merge_request = payload.get('merge_request') or {}
+        project_ids |= {merge_request.get('target_project_id'), merge_request.get('source_project_id')}
+    elif kind == 'push':
+        project_ids = {payload.get('project_id')}
+    else:
+        return set()
+    return project_ids - {None}
+
+
+class EventHub:
+    """Where webhooks are published, and where the bot and its jobs wait for them.
+
+    Events are only ever hints that something may have changed in a project: it is up
+    to whoever wakes up to go and find out what, using the API as usual.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._seq = 0
+        self._last_seq_by_project_id = {}
+        self._pending_project_ids = set()
+
+    def publish(self, project_ids):
+        with self._condition:
+            self._seq += 1
+            for project_id in project_ids:
+                self._last_seq_by_project_id[project_id] = self._seq
+            self._pending_project_ids.update(project_ids)
+            self._condition.notify_all()
+
+    def cursor(self):
+        """Take note of where we are, to later `wait_for` events that happen from now on."""
+        with self._condition:
+            return self._seq
+
+    def wait_for(self, project_ids, since, timeout):
+        """Wait until there was an event in one of `project_ids` after `since`, or `timeout` secs.
+
+        Return whether there was such an event.
+        """
+        def happened():
+            return any(self._last_seq_by_project_id.get(project_id, 0) > since for project_id in project_ids)
+
+        with self._condition:
+            return self._condition.wait_for(happened, timeout)
+
+    def take_pending(self, timeout):
+        """Wait until there were events in some projects, or `timeout` secs; return their ids.
+
+        Each project is only returned once for however many events happened in it.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending_project_ids, timeout)
+            project_ids, self._pending_project_ids = self._pending_project_ids, set()
+            return project_ids
+
+    def serve(self, port, secret=None, host=''):
+        """Receive webhooks (on any path) from a background thread."""
+        hub = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):  # pylint: disable=invalid-name
+                token = self.headers.get('X-Gitlab-Token', '')
+                if secret is not None and not hmac.compare_digest(token.encode(), secret.encode()):
+                    log.warning('Ignoring webhook with a wrong secret token')
+                    self._respond(401)
+                    return
+
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    if length < 0:
+                        raise ValueError('Negative Content-Length')
+                    payload = json.loads(self.rfile.read(length).decode('utf-8'))
+                except ValueError:
+                    self._respond(400)
+                    return
+
+                project_ids = project_ids_of(payload) if isinstance(payload, dict) else set()
+                log.debug('Got %s webhook for projects %s', self.headers.get('X-Gitlab-Event'), project_ids)
+                if project_ids:
+                    hub.publish(project_ids)
+                # GitLab disables hooks that keep failing, so even uninteresting ones are OK
+                self._respond(200)
+
+            def _respond(self, status_code):
+                self.send_response(status_code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                log.debug('Webhook: ' + format, *args)
+
+        return httpd.serve_in_background(WebhookHandler, port, host)
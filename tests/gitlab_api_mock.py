@@ -136,6 +136,9 @@ class Api(gitlab.Api):
                 side_effect()
             return response()
 
+    def _fetch_page(self, command):
+        return self.call(command), {}
+
     def _find(self, command, sudo):
         more_specific = self._transitions.get(_key(command, sudo, self.state))
         return more_specific or self._transitions[_key(command, sudo, None)]
@@ -0,0 +1,33 @@
+def node(iid, **overrides):
+    result = {
+        'id': 'gid://gitlab/MergeRequest/%s' % (iid + 100),
+        'iid': str(iid),
+        'title': 'MR %s' % iid,
+        'state': 'opened',
+        'draft': False,
+        'squash': False,
+        'webUrl': 'http://git.example.com/a/b/-/merge_requests/%s' % iid,
+        'sourceBranch': 'feature-%s' % iid,
+        'targetBranch': 'master',
+        'sourceProjectId': 5,
+        'targetProjectId': 5,
+        'diffHeadSha': 'abc%s' % iid,
+        'author': {'id': 'gid://gitlab/User/88'},
+        'assignees': {'nodes': [{'id': 'gid://gitlab/User/77'}]},
+        'approvalsLeft': 0,
+        'approvedBy': {'nodes': [{'username': 'alice'}]},
+        'headPipeline': {'sha': 'abc%s' % iid, 'status': 'SUCCESS'},
+    }
+    result.update(overrides)
+    return result
+
+
+def page(nodes, end_cursor=None):
+    return {
+        'project': {
+            'mergeRequests': {
+                'pageInfo': {'hasNextPage': end_cursor is not None, 'endCursor': end_cursor},
+                'nodes': nodes,
+            },
+        },
+    }
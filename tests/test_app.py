@@ -10,8 +10,10 @@ import pytest
 
 import marge.app as app
 import marge.bot as bot_module
+import marge.gitlab as gitlab
 import marge.interval as interval
 import marge.job as job
+import marge.user
 
 import tests.gitlab_api_mock as gitlab_mock
 from tests.test_user import INFO as user_info
@@ -59,10 +61,11 @@ def env(**kwargs):
 
 @contextlib.contextmanager
 def main(cmdline=''):
-    def api_mock(gitlab_url, auth_token):
+    def api_mock(gitlab_url, auth_token, **api_kwargs):
         assert gitlab_url == 'http://foo.com'
         assert auth_token in ('NON-ADMIN-TOKEN', 'ADMIN-TOKEN')
         api = gitlab_mock.Api(gitlab_url=gitlab_url, auth_token=auth_token, initial_state='initial')
+        api.init_kwargs = api_kwargs
         user_info_for_token = dict(user_info, is_admin=auth_token == 'ADMIN-TOKEN')
         api.add_user(user_info_for_token, is_current=True)
         api.add_transition(gitlab_mock.GET('/version'), gitlab_mock.Ok({'version': '11.6.0-ce'}))
@@ -79,7 +82,8 @@ def main(cmdline=''):
         def config(self):
             return self._config
 
-    with mock.patch('marge.bot.Bot', new=DoNothingBot), mock.patch('marge.gitlab.Api', new=api_mock):
+    with mock.patch('marge.bot.Bot', new=DoNothingBot), mock.patch('marge.gitlab.Api', new=api_mock), \
+            mock.patch.object(marge.user.User, 'cache', None):
         app.main(args=shlex.split(cmdline))
         the_bot = DoNothingBot.instance
         assert the_bot is not None
@@ -132,6 +136,46 @@ def test_use_merge_strategy_and_add_tested_are_mutualy_exclusive():
                 pass
 
 
+def test_batch_sizing():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--batch') as bot:
+            assert bot.config.max_batch_size is None
+            assert bot.config.batch_stats_file is None
+        with main('--batch --max-batch-size=8 --batch-stats-file=/var/lib/marge/batches.json') as bot:
+            assert bot.config.max_batch_size == 8
+            assert bot.config.batch_stats_file == '/var/lib/marge/batches.json'
+        with pytest.raises(app.MargeBotCliArgError):
+            with main('--batch --max-batch-size=1'):
+                pass
+
+
+def test_batch_bisect():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--batch') as bot:
+            assert bot.config.batch_bisect is False
+        with main('--batch --batch-bisect') as bot:
+            assert bot.config.batch_bisect is True
+        with pytest.raises(app.MargeBotCliArgError):
+            with main('--batch-bisect'):
+                pass
+
+
+def test_merge_train_depth():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.merge_train_depth == 0
+        with main('--merge-train-depth=3') as bot:
+            assert bot.config.merge_train_depth == 3
+
+
+def test_merge_train_depth_and_batch_are_mutually_exclusive():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        for conflicting_flag in ['--batch', '--use-merge-strategy']:
+            with pytest.raises(app.MargeBotCliArgError):
+                with main('--merge-train-depth=3 %s' % conflicting_flag):
+                    pass
+
+
 def test_add_part_of():
     with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
         with main('--add-part-of') as bot:
@@ -234,6 +278,91 @@ def test_merge_order():
             assert bot.config.merge_order == 'updated_at'
 
 
+def test_api_connection_pool():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main("--api-pool-size=2 --api-max-connections=20") as bot:
+            assert bot.api.init_kwargs['pool_connections'] == 2
+            assert bot.api.init_kwargs['pool_maxsize'] == 20
+
+
+def test_api_rate_limit():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--api-rate-limit=0 --api-rate-limit-burst=1') as bot:
+            assert bot.api.init_kwargs['rate_limiter'] is not None
+        for bad_args in ['--api-rate-limit=-1', '--api-rate-limit-burst=0', '--api-rate-limit-burst=-5']:
+            with pytest.raises(app.MargeBotCliArgError):
+                with main(bad_args):
+                    pass
+
+
+def test_discovery():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.discovery == 'projects'
+        with main('--discovery=assigned') as bot:
+            assert bot.config.discovery == 'assigned'
+
+
+def test_project_refresh_interval():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--project-refresh-interval=1h') as bot:
+            assert bot.config.project_refresh_interval == datetime.timedelta(hours=1)
+
+
+def test_max_project_poll_interval():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.max_project_poll_interval == datetime.timedelta(minutes=2)
+        with main('--max-project-poll-interval=10min') as bot:
+            assert bot.config.max_project_poll_interval == datetime.timedelta(minutes=10)
+
+
+def test_webhook_poll_interval():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--webhook-poll-interval=10min') as bot:
+            assert bot.config.webhook_poll_interval == datetime.timedelta(minutes=10)
+
+
+def test_adaptive_ci_polling():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.adaptive_ci_polling is False
+        with main('--adaptive-ci-polling') as bot:
+            assert bot.config.adaptive_ci_polling is True
+
+
+def test_project_workers():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.project_workers == 1
+        with main('--project-workers=4') as bot:
+            assert bot.config.project_workers == 4
+
+
+def test_use_graphql():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--use-graphql') as bot:
+            assert bot.config.merge_opts.use_graphql is True
+
+
+def test_user_cache_ttl():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main():
+            assert marge.user.User.cache is not None
+        with main('--user-cache-ttl=0'):
+            assert marge.user.User.cache is None
+    assert marge.user.User.cache is None
+
+
+def test_compact_resources():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        try:
+            with main("--compact-resources"):
+                assert gitlab.Resource.compact
+        finally:
+            gitlab.Resource.compact = False
+
+
 # FIXME: I'd reallly prefer this to be a doctest, but adding --doctest-modules
 # seems to seriously mess up the test run
 def test_time_interval():
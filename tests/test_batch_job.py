@@ -1,16 +1,21 @@
 # pylint: disable=protected-access
-from unittest.mock import ANY, patch, create_autospec
+import contextlib
+import threading
+from unittest.mock import ANY, call, patch, create_autospec
 
 import pytest
 
 import marge.git
+import marge.pipeline
 import marge.project
 import marge.user
 from marge.batch_job import BatchMergeJob, CannotBatch
 from marge.gitlab import GET
-from marge.job import CannotMerge, MergeJobOptions
+from marge.graphql import MergeRequestSnapshot
+from marge.job import CannotMerge, CIFailed, Fusion, MergeJobOptions, SkipMerge
 from marge.merge_request import MergeRequest
 from tests.gitlab_api_mock import MockLab, Ok, commit
+from tests.graphql_mock import node
 
 
 class TestBatchJob:
@@ -51,7 +56,7 @@ class TestBatchJob:
         batch_merge_job = self.get_batch_merge_job(api, mocklab, repo=repo)
         batch_merge_job.remove_batch_branch()
         repo.remove_branch.assert_called_once_with(
-            BatchMergeJob.BATCH_BRANCH_NAME,
+            'marge_bot_batch_merge_job_master',
         )
 
     def test_close_batch_mr(self, api, mocklab):
@@ -65,6 +70,7 @@ class TestBatchJob:
             params = {
                 'author_id': batch_merge_job._user.id,
                 'labels': BatchMergeJob.BATCH_BRANCH_NAME,
+                'target_branch': 'master',
                 'state': 'opened',
                 'order_by': 'created_at',
                 'sort': 'desc',
@@ -86,7 +92,7 @@ class TestBatchJob:
             r_batch_mr = batch_merge_job.create_batch_mr(target_branch)
 
             params = {
-                'source_branch': BatchMergeJob.BATCH_BRANCH_NAME,
+                'source_branch': 'marge_bot_batch_merge_job_master',
                 'target_branch': target_branch,
                 'title': 'Marge Bot Batch MR - DO NOT TOUCH',
                 'labels': BatchMergeJob.BATCH_BRANCH_NAME,
@@ -98,6 +104,13 @@ class TestBatchJob:
             )
             assert r_batch_mr is batch_mr
 
+    def test_batch_branch_name(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(
+            api, mocklab, merge_requests=[self._mock_merge_request(target_branch='release/1.0')],
+        )
+        assert batch_merge_job.target_branch == 'release/1.0'
+        assert batch_merge_job.batch_branch_name == 'marge_bot_batch_merge_job_release/1.0'
+
     def test_get_mrs_with_common_target_branch(self, api, mocklab):
         master_mrs = [
             self._mock_merge_request(target_branch='master'),
@@ -130,14 +143,322 @@ class TestBatchJob:
 
         assert str(exc_info.value) == 'This MR has not passed CI.'
 
+    def _mergeable_mr_and_snapshot(self, batch_merge_job, **node_overrides):
+        snapshot = MergeRequestSnapshot.from_node(dict(node(3, **node_overrides), assignees={
+            'nodes': [{'id': 'gid://gitlab/User/%s' % batch_merge_job._user.id}],
+        }))
+        merge_request = self._mock_merge_request(iid=3, sha=snapshot.sha)
+        return merge_request, snapshot
+
+    @patch.object(BatchMergeJob, 'get_mr_ci_status')
+    def test_ensure_mergeable_mr_trusts_snapshot(self, bmj_get_mr_ci_status, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_request, snapshot = self._mergeable_mr_and_snapshot(batch_merge_job)
+
+        batch_merge_job.ensure_mergeable_mr(merge_request, snapshot)
+
+        merge_request.refetch_info.assert_not_called()
+        merge_request.fetch_approvals.assert_not_called()
+        bmj_get_mr_ci_status.assert_not_called()
+
+    @patch.object(BatchMergeJob, 'get_mr_ci_status')
+    def test_ensure_mergeable_mr_snapshot_ci_not_ok(self, bmj_get_mr_ci_status, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_request, snapshot = self._mergeable_mr_and_snapshot(
+            batch_merge_job, headPipeline={'sha': 'abc3', 'status': 'FAILED'},
+        )
+
+        with pytest.raises(CannotBatch) as exc_info:
+            batch_merge_job.ensure_mergeable_mr(merge_request, snapshot)
+
+        assert str(exc_info.value) == 'This MR has not passed CI.'
+        merge_request.refetch_info.assert_not_called()
+        bmj_get_mr_ci_status.assert_not_called()
+
+    @patch.object(BatchMergeJob, 'get_mr_ci_status')
+    def test_ensure_mergeable_mr_snapshot_without_head_pipeline(self, bmj_get_mr_ci_status, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_request, snapshot = self._mergeable_mr_and_snapshot(batch_merge_job, headPipeline=None)
+        bmj_get_mr_ci_status.return_value = 'success'
+
+        batch_merge_job.ensure_mergeable_mr(merge_request, snapshot)
+
+        bmj_get_mr_ci_status.assert_called_once_with(merge_request)
+
+    def test_ensure_mergeable_mr_double_checks_bad_snapshot(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_request, snapshot = self._mergeable_mr_and_snapshot(batch_merge_job, draft=True)
+        merge_request.work_in_progress = True
+
+        with pytest.raises(CannotMerge) as exc_info:
+            batch_merge_job.ensure_mergeable_mr(merge_request, snapshot)
+
+        assert str(exc_info.value) == "Sorry, I can't merge requests marked as Work-In-Progress!"
+        merge_request.refetch_info.assert_called_once_with()
+
+    @patch.object(BatchMergeJob, 'get_mr_ci_status')
+    def test_get_mergeable_mrs_with_snapshots(self, bmj_get_mr_ci_status, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_request, snapshot = self._mergeable_mr_and_snapshot(batch_merge_job)
+        batch_merge_job._snapshots = {snapshot.iid: snapshot}
+
+        assert batch_merge_job.get_mergeable_mrs([merge_request]) == [merge_request]
+        merge_request.refetch_info.assert_not_called()
+        bmj_get_mr_ci_status.assert_not_called()
+
+    def test_get_mergeable_mrs_concurrently(self, api, mocklab):
+        merge_requests = [self._mock_merge_request(iid=iid) for iid in range(6)]
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        # all checks have to be underway at once to get past this
+        all_checking = threading.Barrier(len(merge_requests), timeout=5)
+        outcomes = {
+            1: CannotBatch('This MR has not passed CI.'),
+            2: SkipMerge('It is not assigned to me anymore!'),
+            4: CannotMerge('Insufficient approvals'),
+        }
+
+        def ensure_mergeable_mr(merge_request, snapshot):
+            assert snapshot is None
+            all_checking.wait()
+            if merge_request.iid in outcomes:
+                raise outcomes[merge_request.iid]
+
+        with patch.object(batch_merge_job, 'ensure_mergeable_mr', side_effect=ensure_mergeable_mr), \
+                patch.object(batch_merge_job, 'unassign_from_mr') as unassign_from_mr:
+            mergeable_mrs = batch_merge_job.get_mergeable_mrs(merge_requests)
+
+        assert [merge_request.iid for merge_request in mergeable_mrs] == [0, 3, 5]
+        unassign_from_mr.assert_called_once_with(merge_requests[4])
+        merge_requests[4].comment.assert_called_once_with(
+            "I couldn't merge this branch: Insufficient approvals",
+        )
+        merge_requests[1].comment.assert_not_called()
+
+    def test_get_mergeable_mrs_of_none(self, api, mocklab):
+        assert self.get_batch_merge_job(api, mocklab).get_mergeable_mrs([]) == []
+
     def test_push_batch(self, api, mocklab):
         batch_merge_job = self.get_batch_merge_job(api, mocklab)
         batch_merge_job.push_batch()
         batch_merge_job._repo.push.assert_called_once_with(
-            BatchMergeJob.BATCH_BRANCH_NAME,
+            'marge_bot_batch_merge_job_master',
             force=True,
         )
 
+    def test_push_prefix(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        with patch.object(batch_merge_job, 'create_batch_mr') as create_batch_mr:
+            batch_mr = batch_merge_job.push_prefix('abc', 3)
+        branch = 'marge_bot_batch_merge_job_master_prefix_3'
+        batch_merge_job._repo.checkout_branch.assert_called_once_with(branch, 'abc')
+        batch_merge_job._repo.push.assert_called_once_with(branch, force=True)
+        create_batch_mr.assert_called_once_with(target_branch='master', source_branch=branch)
+        assert batch_mr is create_batch_mr.return_value
+
+    def test_push_prefix_when_push_fails(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        batch_merge_job._repo.push.side_effect = marge.git.GitError('rejected')
+        with patch.object(batch_merge_job, 'create_batch_mr') as create_batch_mr:
+            with pytest.raises(CannotBatch):
+                batch_merge_job.push_prefix('abc', 3)
+        create_batch_mr.assert_not_called()
+
+    @pytest.mark.parametrize('culprit', range(10))
+    def test_bisect(self, api, mocklab, culprit):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab, bisect=True)
+        prefix_shas = ['sha%s' % i for i in range(10)]
+
+        def wait_for_ci_to_pass(batch_mr):
+            if prefix_shas.index(batch_mr.sha) >= culprit:
+                raise CIFailed('CI failed!')
+
+        def push_prefix(prefix_sha, length):
+            assert prefix_shas.index(prefix_sha) == length - 1
+            return self._mock_merge_request(sha=prefix_sha)
+
+        with patch.object(batch_merge_job, 'push_prefix', side_effect=push_prefix) as bmj_push_prefix, \
+                patch.object(batch_merge_job, 'wait_for_ci_to_pass', side_effect=wait_for_ci_to_pass):
+            assert batch_merge_job.bisect(prefix_shas) == culprit
+        # the full batch already failed, and 3 shorter ones are tested at a time
+        assert bmj_push_prefix.call_count <= 6
+        # and all their branches are gone afterwards
+        pushed_lengths = sorted(length for (_, length), _ in bmj_push_prefix.call_args_list)
+        if pushed_lengths:
+            batch_merge_job._repo.remove_remote_branches.assert_called_once_with(
+                *[batch_merge_job.prefix_branch_name(length) for length in pushed_lengths]
+            )
+        else:
+            batch_merge_job._repo.remove_remote_branches.assert_not_called()
+
+    def test_bisect_gives_up_unless_ci_fails(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab, bisect=True)
+        batch_mr = self._mock_merge_request()
+        timeout = CannotMerge('CI is taking too long.')
+        with patch.object(batch_merge_job, 'push_prefix', return_value=batch_mr), \
+                patch.object(batch_merge_job, 'wait_for_ci_to_pass', side_effect=timeout):
+            with pytest.raises(CannotBatch):
+                batch_merge_job.bisect(['sha0', 'sha1', 'sha2'])
+        batch_mr.close.assert_called()
+        batch_merge_job._repo.remove_remote_branches.assert_called_once_with(
+            'marge_bot_batch_merge_job_master_prefix_1', 'marge_bot_batch_merge_job_master_prefix_2',
+        )
+
+    def test_drop_culprit(self, api, mocklab):
+        merge_requests = [self._mock_merge_request(iid=iid) for iid in range(4)]
+        batch_merge_job = self.get_batch_merge_job(api, mocklab, merge_requests=merge_requests, bisect=True)
+        batch_mr = self._mock_merge_request(iid=42)
+        with patch.object(batch_merge_job, 'bisect', return_value=1), \
+                patch.object(batch_merge_job, 'unassign_from_mr') as unassign_from_mr:
+            assert batch_merge_job.drop_culprit(merge_requests, ['sha'] * 4, batch_mr) == merge_requests[:1]
+
+        unassign_from_mr.assert_called_once_with(merge_requests[1])
+        assert "couldn't merge" in merge_requests[1].comment.call_args[0][0]
+        for merge_request in merge_requests[2:]:
+            merge_request.comment.assert_called_once_with(
+                'Batch MR !42 failed because of !1. I will retry later...'
+            )
+        merge_requests[0].comment.assert_not_called()
+
+    def test_comments_when_bisecting_gives_up(self, api, mocklab):
+        merge_requests = [
+            self._mock_merge_request(iid=iid, target_branch='master', source_branch='feature-%s' % iid)
+            for iid in range(3)
+        ]
+        project = create_autospec(
+            marge.project.Project, spec_set=True, id=mocklab.project_info['id'],
+            only_allow_merge_if_pipeline_succeeds=True,
+        )
+        batch_merge_job = self.get_batch_merge_job(
+            api, mocklab, project=project, merge_requests=merge_requests, bisect=True,
+        )
+        batch_mr = self._mock_merge_request(iid=42)
+        batch_mrs = [batch_mr] + [self._mock_merge_request(iid=iid) for iid in (43, 44)]
+
+        def wait_for_ci_to_pass(merge_request):
+            if merge_request is batch_mr:
+                raise CIFailed('CI failed!')
+            raise CannotMerge('CI is taking too long.')
+
+        with patch.object(batch_merge_job, 'close_batch_mr'), \
+                patch.object(batch_merge_job, 'get_mergeable_mrs', return_value=merge_requests), \
+                patch.object(batch_merge_job, 'fetch_source_project', return_value=(None, None, 'origin')), \
+                patch.object(batch_merge_job, 'fuse'), \
+                patch.object(batch_merge_job, 'create_batch_mr', side_effect=batch_mrs), \
+                patch.object(batch_merge_job, 'wait_for_ci_to_pass', side_effect=wait_for_ci_to_pass), \
+                patch.object(batch_merge_job, 'unassign_from_mr') as unassign_from_mr:
+            with pytest.raises(CannotBatch):
+                batch_merge_job.execute()
+
+        unassign_from_mr.assert_not_called()
+        for merge_request in merge_requests:
+            assert merge_request.comment.call_args_list[-1][0][0] == (
+                'Batch MR !42 failed: CI is taking too long. I will retry later...'
+            )
+
+    def test_can_push_atomically(self, api, mocklab, fork):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_requests = batch_merge_job._merge_requests
+        assert batch_merge_job.can_push_atomically(merge_requests) is not fork
+
+        for options in [
+                MergeJobOptions.default(add_tested=True),
+                MergeJobOptions.default(reapprove=True),
+                MergeJobOptions.default(fusion=Fusion.merge),
+        ]:
+            batch_merge_job = self.get_batch_merge_job(api, mocklab, options=options)
+            assert not batch_merge_job.can_push_atomically(merge_requests)
+
+    @contextlib.contextmanager
+    def patched_for_accept_batch(self, batch_merge_job, target_sha):
+        with contextlib.ExitStack() as stack:
+            last_on_branch = stack.enter_context(patch('marge.batch_job.Commit.last_on_branch'))
+            last_on_branch.return_value.id = target_sha
+            stack.enter_context(patch('marge.batch_job.sleep'))
+            stack.enter_context(patch.object(batch_merge_job, 'ensure_mr_not_changed'))
+            yield {
+                name: stack.enter_context(patch.object(batch_merge_job, name))
+                for name in ('ensure_mergeable_mr', 'cancel_pushed_pipelines', 'unassign_from_mr')
+            }
+
+    def _mock_batch(self, api, mocklab):
+        merge_requests = [
+            self._mock_merge_request(
+                iid=iid, sha='old%s' % iid, source_branch='feature-%s' % iid, target_branch='master',
+            )
+            for iid in (1, 2)
+        ]
+        return merge_requests, self.get_batch_merge_job(api, mocklab, merge_requests=merge_requests)
+
+    def test_accept_batch(self, api, mocklab):
+        merge_requests, batch_merge_job = self._mock_batch(api, mocklab)
+        with self.patched_for_accept_batch(batch_merge_job, target_sha='target') as mocks:
+            final_sha = batch_merge_job.accept_batch(merge_requests, ['new1', 'new2', 'new3'], 'target')
+
+        assert final_sha == 'new2'
+        batch_merge_job._repo.push_atomic.assert_called_once_with(
+            'master', 'new2', {'feature-1': ('new1', 'old1'), 'feature-2': ('new2', 'old2')},
+        )
+        batch_merge_job._repo.push.assert_not_called()
+        assert mocks['cancel_pushed_pipelines'].call_args_list == [
+            call(merge_requests[0], 'new1'), call(merge_requests[1], 'new2'),
+        ]
+
+    def test_accept_batch_when_target_branch_was_moved(self, api, mocklab):
+        merge_requests, batch_merge_job = self._mock_batch(api, mocklab)
+        with self.patched_for_accept_batch(batch_merge_job, target_sha='moved'):
+            with pytest.raises(CannotBatch):
+                batch_merge_job.accept_batch(merge_requests, ['new1', 'new2'], 'target')
+        batch_merge_job._repo.push_atomic.assert_not_called()
+
+    def test_accept_batch_when_push_fails(self, api, mocklab):
+        merge_requests, batch_merge_job = self._mock_batch(api, mocklab)
+        batch_merge_job._repo.push_atomic.side_effect = marge.git.GitError('stale info')
+        with self.patched_for_accept_batch(batch_merge_job, target_sha='target') as mocks:
+            with pytest.raises(CannotBatch):
+                batch_merge_job.accept_batch(merge_requests, ['new1', 'new2'], 'target')
+        mocks['cancel_pushed_pipelines'].assert_not_called()
+
+    def test_accept_batch_unassigns_unmergeable(self, api, mocklab):
+        merge_requests, batch_merge_job = self._mock_batch(api, mocklab)
+        with self.patched_for_accept_batch(batch_merge_job, target_sha='target') as mocks:
+            mocks['ensure_mergeable_mr'].side_effect = [None, CannotMerge('Insufficient approvals')]
+            with pytest.raises(CannotMerge):
+                batch_merge_job.accept_batch(merge_requests, ['new1', 'new2'], 'target')
+        mocks['unassign_from_mr'].assert_called_once_with(merge_requests[1])
+        merge_requests[1].comment.assert_called_once_with(
+            "I couldn't merge this branch: Insufficient approvals",
+        )
+        # the MR ahead of it was tested without it, so it still gets merged
+        batch_merge_job._repo.push_atomic.assert_called_once_with(
+            'master', 'new1', {'feature-1': ('new1', 'old1')},
+        )
+        mocks['cancel_pushed_pipelines'].assert_called_once_with(merge_requests[0], 'new1')
+
+    def test_accept_batch_when_first_is_unmergeable(self, api, mocklab):
+        merge_requests, batch_merge_job = self._mock_batch(api, mocklab)
+        with self.patched_for_accept_batch(batch_merge_job, target_sha='target') as mocks:
+            mocks['ensure_mergeable_mr'].side_effect = [SkipMerge('It is not assigned to me anymore!')]
+            with pytest.raises(SkipMerge):
+                batch_merge_job.accept_batch(merge_requests, ['new1', 'new2'], 'target')
+        mocks['unassign_from_mr'].assert_not_called()
+        batch_merge_job._repo.push_atomic.assert_not_called()
+
+    def test_cancel_pushed_pipelines(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_request = self._mock_merge_request(source_project_id=1234, source_branch='feature')
+        pipelines = [
+            create_autospec(marge.pipeline.Pipeline, spec_set=True, status=status)
+            for status in ('created', 'pending', 'running', 'success', 'canceled')
+        ]
+        with patch('marge.batch_job.Pipeline.pipelines_by_branch', return_value=pipelines) as by_branch:
+            batch_merge_job.cancel_pushed_pipelines(merge_request, 'new1')
+
+        by_branch.assert_called_once_with(api=api, project_id=1234, branch='feature', sha='new1')
+        for pipeline in pipelines[:3]:
+            pipeline.cancel.assert_called_once_with()
+        for pipeline in pipelines[3:]:
+            pipeline.cancel.assert_not_called()
+
     def test_ensure_mr_not_changed(self, api, mocklab):
         with patch('marge.batch_job.MergeRequest') as mr_class:
             batch_merge_job = self.get_batch_merge_job(api, mocklab)
@@ -0,0 +1,65 @@
+import json
+import math
+
+from marge.batch_sizer import BatchSizer
+
+
+class TestBatchSizer:
+
+    def test_no_limit_by_default(self):
+        sizer = BatchSizer()
+        assert sizer.batch_size(1234) is None
+        assert BatchSizer(max_size=5).batch_size(1234) == 5
+
+    def test_needs_a_few_batches_to_go_by(self):
+        sizer = BatchSizer(min_batches=5, decay=1)
+        for _ in range(4):
+            sizer.record(1234, 10, passed=False)
+        assert sizer.batch_size(1234) is None
+        sizer.record(1234, 10, passed=False)
+        assert sizer.batch_size(1234) == 2
+
+    def test_no_limit_whilst_batches_pass(self):
+        sizer = BatchSizer(min_batches=1, decay=1)
+        sizer.record(1234, 10, passed=True)
+        assert sizer.batch_size(1234) is None
+        assert BatchSizer(max_size=5, min_batches=1).batch_size(1234) == 5
+
+    def test_optimal_size(self):
+        sizer = BatchSizer(min_batches=1, decay=1)
+        # batches of 10 MRs pass half of the time...
+        for passed in [True, False] * 10:
+            sizer.record(1234, 10, passed)
+        # ...so each MR breaks CI with p = 1 - 0.5 ** (1 / 10)
+        p = 1 - 0.5 ** 0.1
+        assert sizer.batch_size(1234) == round(-1 / math.log(1 - p)) == 14
+        assert sizer.batch_size(5678) is None
+
+    def test_max_size(self):
+        sizer = BatchSizer(max_size=8, min_batches=1, decay=1)
+        for passed in [True, False] * 10:
+            sizer.record(1234, 10, passed)
+        assert sizer.batch_size(1234) == 8
+
+    def test_recent_batches_count_most(self):
+        sizer = BatchSizer(min_batches=1, decay=0.5)
+        for _ in range(10):
+            sizer.record(1234, 10, passed=False)
+        for _ in range(10):
+            sizer.record(1234, 10, passed=True)
+        assert sizer.batch_size(1234) > 1000
+
+    def test_persists_statistics(self, tmp_path):
+        stats_file = str(tmp_path / 'batches.json')
+        sizer = BatchSizer(stats_file=stats_file, min_batches=1)
+        for passed in [True, False] * 10:
+            sizer.record(1234, 10, passed)
+
+        with open(stats_file) as f:
+            assert set(json.load(f)) == {'1234'}
+        assert BatchSizer(stats_file=stats_file, min_batches=1).batch_size(1234) == sizer.batch_size(1234)
+
+    def test_ignores_unreadable_statistics(self, tmp_path):
+        stats_file = tmp_path / 'batches.json'
+        stats_file.write_text('{not json')
+        assert BatchSizer(stats_file=str(stats_file)).batch_size(1234) is None
@@ -0,0 +1,260 @@
+# pylint: disable=protected-access
+import concurrent.futures
+import datetime
+import os.path
+import re
+import threading
+import time
+from unittest.mock import call, create_autospec, patch
+
+import pytest
+
+import marge.git
+import marge.gitlab
+import marge.store
+import marge.user
+from marge.bot import Bot, BotConfig, MergeJobOptions
+from marge.graphql import MergeRequestSnapshot
+from marge.merge_request import MergeRequest
+from marge.project import AccessLevel, Project
+from tests.graphql_mock import node
+
+
+def _config(**overrides):
+    user = create_autospec(marge.user.User, spec_set=True, id=77, username='marge-bot', is_admin=False)
+    params = dict(
+        user=user,
+        ssh_key_file='/tmp/ssh-key',
+        project_regexp=re.compile('.*'),
+        merge_order='created_at',
+        merge_opts=MergeJobOptions.default(),
+        git_timeout=datetime.timedelta(seconds=120),
+        git_reference_repo=None,
+        branch_regexp=re.compile('.*'),
+        source_branch_regexp=re.compile('.*'),
+        batch=False,
+        discovery='projects',
+        project_refresh_interval=None,
+        webhook_poll_interval=datetime.timedelta(minutes=5),
+        adaptive_ci_polling=False,
+        project_workers=1,
+        max_project_poll_interval=datetime.timedelta(minutes=2),
+        merge_train_depth=0,
+        batch_bisect=False,
+        max_batch_size=None,
+        batch_stats_file=None,
+    )
+    params.update(overrides)
+    return BotConfig(**params)
+
+
+def _project(project_id=1234):
+    return create_autospec(
+        Project, spec_set=True, id=project_id, path_with_namespace='a/project-%s' % project_id,
+    )
+
+
+class TestGetMergeRequests:
+
+    def setup_method(self, _method):
+        self.api = create_autospec(marge.gitlab.Api, spec_set=True)
+
+    def test_with_graphql(self):
+        bot = Bot(api=self.api, config=_config(merge_opts=MergeJobOptions.default(use_graphql=True)))
+        snapshots = [MergeRequestSnapshot.from_node(node(iid)) for iid in (1, 2)]
+        with patch('marge.bot.graphql.fetch_open_merge_requests', return_value=snapshots), \
+                patch.object(MergeRequest, 'fetch_all_open_for_user') as fetch_all_open_for_user:
+            merge_requests, snapshots_by_iid = bot._get_merge_requests(_project(), 'a/project')
+
+        assert [merge_request.iid for merge_request in merge_requests] == [1, 2]
+        assert snapshots_by_iid == {1: snapshots[0], 2: snapshots[1]}
+        fetch_all_open_for_user.assert_not_called()
+
+    def test_falls_back_to_rest_when_graphql_fails(self):
+        bot = Bot(api=self.api, config=_config(merge_opts=MergeJobOptions.default(use_graphql=True)))
+        merge_request = create_autospec(
+            MergeRequest, spec_set=True, target_branch='master', source_branch='feature',
+        )
+        error = marge.gitlab.GraphQLError(200, [{'message': 'Field does not exist'}])
+        with patch('marge.bot.graphql.fetch_open_merge_requests', side_effect=error), \
+                patch.object(MergeRequest, 'fetch_all_open_for_user', return_value=[merge_request]):
+            assert bot._get_merge_requests(_project(), 'a/project') == ([merge_request], {})
+
+    def test_passes_snapshots_on_to_jobs(self):
+        bot = Bot(api=self.api, config=_config())
+        merge_request = create_autospec(MergeRequest, spec_set=True, iid=1, target_branch='master')
+        snapshot = MergeRequestSnapshot.from_node(node(1))
+        repo_manager = create_autospec(marge.store.RepoManager, spec_set=True, instance=True)
+        with patch.object(bot, '_get_single_job') as get_single_job:
+            bot._handle_merge_requests(repo_manager, _project(), [merge_request], {1: snapshot})
+        assert get_single_job.call_args[1]['snapshot'] is snapshot
+        get_single_job.return_value.execute.assert_called_once_with()
+
+
+class TestWithoutWorkers:
+
+    def test_one_job_per_cycle(self):
+        bot = Bot(api=create_autospec(marge.gitlab.Api, spec_set=True), config=_config())
+        repo_manager = create_autospec(marge.store.RepoManager, spec_set=True, instance=True)
+        project = _project()
+        merge_requests = [
+            create_autospec(MergeRequest, spec_set=True, iid=iid, target_branch=target_branch)
+            for iid, target_branch in ((1, 'master'), (2, 'stable'), (3, 'master'))
+        ]
+        with patch.object(bot, '_get_single_job') as get_single_job:
+            bot._handle_merge_requests(repo_manager, project, merge_requests)
+
+        repo_manager.repo_for_project.assert_called_once_with(project, None)
+        get_single_job.assert_called_once()
+        assert get_single_job.call_args[1]['merge_request'] is merge_requests[0]
+        assert bot._futures_by_key == {}
+
+
+class StopLoop(Exception):
+    pass
+
+
+class TestWorkers:
+
+    def setup_method(self, _method):
+        self.api = create_autospec(marge.gitlab.Api, spec_set=True)
+        self.repo_manager = create_autospec(marge.store.RepoManager, spec_set=True, instance=True)
+
+    def _merge_request(self, iid, target_branch='master'):
+        return create_autospec(MergeRequest, spec_set=True, iid=iid, target_branch=target_branch)
+
+    def test_one_worker_per_target_branch(self):
+        bot = Bot(api=self.api, config=_config(project_workers=3))
+        project = _project()
+        all_started = threading.Barrier(3, timeout=5)
+        done = threading.Event()
+        processed = []
+
+        def process_merge_requests(_repo_manager, _project, merge_requests, target_branch, _snapshots):
+            processed.append((target_branch, [merge_request.iid for merge_request in merge_requests]))
+            all_started.wait()
+            assert done.wait(timeout=5)
+
+        merge_requests = [self._merge_request(1), self._merge_request(2, 'stable'), self._merge_request(3)]
+        with patch.object(bot, '_process_merge_requests', side_effect=process_merge_requests):
+            bot._handle_merge_requests(self.repo_manager, project, merge_requests)
+            # both target branches are handled at the same time
+            all_started.wait()
+            assert sorted(bot._futures_by_key) == [(1234, 'master'), (1234, 'stable')]
+
+            # whilst they are busy, their MRs are left alone
+            bot._handle_merge_requests(self.repo_manager, project, [self._merge_request(4, 'stable')])
+            assert len(processed) == 2
+
+            done.set()
+            bot._stop_workers()
+        assert sorted(processed) == [('master', [1, 3]), ('stable', [2])]
+
+    def test_skips_listing_when_busy_with_all_target_branches(self):
+        bot = Bot(api=self.api, config=_config(project_workers=3))
+        project = _project()
+        project.access_level = AccessLevel.developer
+        done = threading.Event()
+        stable_runs = []
+
+        def process_merge_requests(_repo_manager, _project, merge_requests, *_args):
+            if merge_requests[0].target_branch == 'stable':
+                stable_runs.append(True)
+                if len(stable_runs) == 1:
+                    return
+            assert done.wait(timeout=5)
+
+        merge_requests = [self._merge_request(1), self._merge_request(2, 'stable')]
+        with patch.object(bot, '_process_merge_requests', side_effect=process_merge_requests), \
+                patch.object(
+                    bot, '_get_merge_requests', return_value=(merge_requests, {}),
+                ) as get_merge_requests:
+            assert bot._process_projects(self.repo_manager, [project]) == [project]
+            assert get_merge_requests.call_count == 1
+            concurrent.futures.wait([bot._futures_by_key[(1234, 'stable')]], timeout=5)
+
+            # stable is free again, so there may be work
+            assert bot._process_projects(self.repo_manager, [project]) == [project]
+            assert get_merge_requests.call_count == 2
+
+            # but now all of them are busy
+            assert bot._process_projects(self.repo_manager, [project]) == [project]
+            assert get_merge_requests.call_count == 2
+
+            done.set()
+            bot._stop_workers()
+
+    def test_stop_waits_for_workers(self):
+        bot = Bot(api=self.api, config=_config(project_workers=2))
+        started = threading.Event()
+        finished = []
+
+        def process_merge_requests(*_args):
+            started.set()
+            time.sleep(0.1)
+            finished.append(True)
+
+        with patch.object(bot, '_process_merge_requests', side_effect=process_merge_requests):
+            bot._handle_merge_requests(self.repo_manager, _project(), [self._merge_request(1)])
+            assert started.wait(timeout=5)
+            bot._stop_workers()
+        assert finished == [True]
+
+    def test_start_stops_workers_before_cleaning_up(self):
+        bot = Bot(api=self.api, config=_config(project_workers=2))
+        root_dirs = []
+
+        def process_merge_requests(repo_manager, *_args):
+            time.sleep(0.1)
+            root_dirs.append(os.path.isdir(repo_manager.root_dir))
+
+        def run(repo_manager):
+            bot._handle_merge_requests(repo_manager, _project(), [self._merge_request(1)])
+            raise StopLoop()
+
+        with patch.object(bot, '_process_merge_requests', side_effect=process_merge_requests), \
+                patch.object(bot, '_run', side_effect=run):
+            with pytest.raises(StopLoop):
+                bot.start()
+        assert root_dirs == [True]
+
+    def test_reaps_failed_workers_every_cycle(self):
+        bot = Bot(api=self.api, config=_config(project_workers=2))
+        with patch.object(bot, '_process_merge_requests', side_effect=marge.git.GitError('broken')):
+            bot._handle_merge_requests(self.repo_manager, _project(), [self._merge_request(1)])
+            concurrent.futures.wait(bot._futures_by_key.values(), timeout=5)
+
+        # even without any MRs to merge
+        with patch.object(bot, '_schedule_projects'), \
+                patch.object(bot, '_wait_for_events', side_effect=StopLoop()):
+            with pytest.raises(marge.git.GitError):
+                bot._run_scheduled(self.repo_manager)
+        assert bot._futures_by_key == {}
+
+
+class TestScheduling:
+
+    def setup_method(self, _method):
+        self.api = create_autospec(marge.gitlab.Api, spec_set=True)
+        self.repo_manager = create_autospec(marge.store.RepoManager, spec_set=True, instance=True)
+
+    def test_busy_projects_are_checked_again_sooner(self):
+        bot = Bot(api=self.api, config=_config())
+        busy_project, idle_project = _project(1), _project(2)
+
+        def schedule_projects():
+            bot._projects_by_id = {1: busy_project, 2: idle_project}
+            bot._scheduler.sync(bot._projects_by_id)
+
+        with patch.object(bot, '_schedule_projects', side_effect=schedule_projects), \
+                patch.object(bot, '_process_projects', return_value=[busy_project]) as process_projects, \
+                patch.object(bot._scheduler, 'done', wraps=bot._scheduler.done) as done, \
+                patch.object(bot, '_wait_for_events', side_effect=StopLoop()) as wait_for_events:
+            with pytest.raises(StopLoop):
+                bot._run_scheduled(self.repo_manager)
+
+        process_projects.assert_called_once_with(self.repo_manager, [busy_project, idle_project])
+        assert sorted(done.call_args_list) == [call(1, busy=True), call(2, busy=False)]
+        # the busy project is next, well before the next listing
+        secs, = wait_for_events.call_args[0]
+        assert secs == pytest.approx(10, abs=1)
@@ -0,0 +1,72 @@
+from marge.cache import LRUCache, ResponseCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache:
+    def test_forgets_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert len(cache) == 2
+
+    def test_default(self):
+        assert LRUCache(maxsize=1).get('missing', 42) == 42
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = LRUCache(maxsize=2, ttl=60, clock=clock)
+        cache.put('a', 1)
+        clock.now = 30
+        cache.put('b', 2)
+        clock.now = 59
+        assert cache.get('a') == 1
+
+        clock.now = 60
+        assert cache.get('a', 42) == 42
+        assert cache.get('b') == 2
+        assert len(cache) == 1
+
+
+class TestResponseCache:
+    def setup_method(self, _method):
+        self.clock = FakeClock()
+        self.cache = ResponseCache(
+            maxsize=10,
+            ttls=[(r'\A/version\Z', 60)],
+            clock=self.clock,
+        )
+
+    def test_per_endpoint_ttls(self):
+        assert self.cache.ttl('/version') == 60
+        assert self.cache.ttl('/projects/1') == 0
+
+    def test_responses_stay_fresh_during_ttl(self):
+        self.cache.store('key', None, b'{}', '/version')
+        cached = self.cache.lookup('key')
+        assert self.cache.is_fresh(cached, '/version')
+
+        self.clock.now = 61
+        assert not self.cache.is_fresh(cached, '/version')
+
+        self.cache.revalidated('key', cached)
+        assert self.cache.is_fresh(self.cache.lookup('key'), '/version')
+
+    def test_only_remembers_what_can_be_revalidated(self):
+        self.cache.store('no-etag', None, b'{}', '/projects/1')
+        self.cache.store('etag', 'W/"abc"', b'{}', '/projects/1')
+        assert self.cache.lookup('no-etag') is None
+        assert self.cache.lookup('etag').etag == 'W/"abc"'
+        assert not self.cache.is_fresh(self.cache.lookup('etag'), '/projects/1')
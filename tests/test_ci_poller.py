@@ -0,0 +1,74 @@
+from unittest.mock import Mock
+
+from marge.ci_poller import CIPoller
+from marge.gitlab import Api, GET
+
+
+def _pipeline(created_at, updated_at):
+    return {'id': 1, 'status': 'success', 'ref': 'master', 'sha': 'abc',
+            'created_at': created_at, 'updated_at': updated_at}
+
+
+# pylint: disable=attribute-defined-outside-init
+class TestCIPoller:
+
+    def setup_method(self, _method):
+        self.poller = CIPoller(
+            min_delay=5, max_delay=300, default_delay=10, smoothing=0.5, slowness_factor=20,
+        )
+
+    def test_polls_as_usual_without_estimate(self):
+        assert self.poller.expected_duration(1) is None
+        assert self.poller.delay(1, elapsed_secs=0) == 10
+        assert self.poller.delay(1, elapsed_secs=500) == 10
+
+    def test_polls_more_often_near_expected_finish(self):
+        self.poller.record(1, 400)
+        delays = [self.poller.delay(1, elapsed_secs=elapsed) for elapsed in (0, 200, 300, 380, 400)]
+        assert delays == [200, 100, 50, 10, 5]
+
+    def test_polls_less_often_when_late(self):
+        self.poller.record(1, 100)
+        assert self.poller.delay(1, elapsed_secs=110) == 5
+        assert self.poller.delay(1, elapsed_secs=300) == 50
+        assert self.poller.delay(1, elapsed_secs=10000) == 300
+
+    def test_backs_off_when_gitlab_is_slow(self):
+        self.poller.record(1, 100)
+        assert self.poller.delay(1, elapsed_secs=90, poll_secs=0.1) == 5
+        assert self.poller.delay(1, elapsed_secs=90, poll_secs=2) == 40
+        assert self.poller.delay(2, elapsed_secs=0, poll_secs=2) == 40
+
+    def test_records_moving_average(self):
+        self.poller.record(1, 100)
+        assert self.poller.expected_duration(1) == 100
+        self.poller.record(1, 200)
+        assert self.poller.expected_duration(1) == 150
+        assert self.poller.expected_duration(2) is None
+
+    def test_learns_from_recent_pipelines(self):
+        api = Mock(Api)
+        api.call = Mock(return_value=[
+            _pipeline('2019-01-01T10:00:00.000Z', '2019-01-01T10:02:00.000Z'),
+            _pipeline('2019-01-01T11:00:00.000Z', '2019-01-01T11:03:00.000Z'),
+            _pipeline('2019-01-01T12:00:00.000Z', '2019-01-01T12:30:00.000Z'),
+        ])
+
+        self.poller.learn_history(1, api)
+        self.poller.learn_history(1, api)
+
+        api.call.assert_called_once_with(GET(
+            '/projects/1/pipelines',
+            {'status': 'success', 'order_by': 'id', 'sort': 'desc', 'per_page': 20},
+        ))
+        assert self.poller.expected_duration(1) == 180
+
+    def test_learns_nothing_without_history(self):
+        api = Mock(Api)
+        api.call = Mock(return_value=[])
+
+        self.poller.learn_history(1, api)
+        self.poller.learn_history(1, api)
+
+        api.call.assert_called_once()
+        assert self.poller.expected_duration(1) is None
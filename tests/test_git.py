@@ -168,6 +168,20 @@ class TestRepo:
             'git -C /tmp/local/path ls-files --others',
         ]
 
+    def test_push_atomic(self, mocked_run):
+        self.repo.push_atomic('master', 'abc', {'feature-b': ('ccc', 'bbb'), 'feature-a': ('aaa', '111')})
+        assert get_calls(mocked_run) == [
+            'git -C /tmp/local/path push --atomic '
+            '--force-with-lease=refs/heads/feature-a:111 --force-with-lease=refs/heads/feature-b:bbb '
+            'origin abc:refs/heads/master aaa:refs/heads/feature-a ccc:refs/heads/feature-b',
+        ]
+
+    def test_remove_remote_branches(self, mocked_run):
+        self.repo.remove_remote_branches('branch_1', 'branch_2')
+        assert get_calls(mocked_run) == [
+            'git -C /tmp/local/path push origin --delete branch_1 branch_2',
+        ]
+
     def test_get_commit_hash(self, mocked_run):
         mocked_run.return_value = mocked_stdout(b'deadbeef')
 
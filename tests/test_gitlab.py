@@ -1,4 +1,13 @@
+import json as json_module
+import threading
+from unittest.mock import ANY, Mock, patch
+
+import pytest
+import requests
+
 import marge.gitlab as gitlab
+from marge.cache import ResponseCache
+from marge.metrics import ApiMetrics
 
 
 class TestVersion:
@@ -11,3 +20,333 @@ class TestVersion:
     def test_is_ee(self):
         assert gitlab.Version.parse('9.4.0-ee').is_ee
         assert not gitlab.Version.parse('9.4.0').is_ee
+
+
+class TestApi:
+    def setup_method(self, _method):
+        self.api = gitlab.Api('http://git.example.com/', 'a-token')
+        self.session = self.api._session = Mock(requests.Session)  # pylint: disable=protected-access
+
+    def respond_with(self, status_code, json=None):
+        self.session.request.return_value = _response(status_code, json)
+
+    def respond_with_pages(self, pages, headers=None):
+        def respond(_method, _url, params, **_kwargs):
+            page_no = int(params['page'])
+            page = pages[page_no - 1] if page_no <= len(pages) else []
+            return _response(200, page, headers(page_no) if headers else {})
+
+        self.session.request.side_effect = respond
+
+    def retry_up_to(self, max_retries, max_backoff=3):
+        retry = gitlab.RetryPolicy(max_retries=max_retries, backoff_factor=1, max_backoff=max_backoff)
+        self.api._retry = retry  # pylint: disable=protected-access
+
+    def requested_pages(self):
+        return [kwargs['params']['page'] for _, kwargs in self.session.request.call_args_list]
+
+    def test_keeps_connections_alive_in_a_pool(self):
+        api = gitlab.Api('http://git.example.com/', 'a-token', pool_connections=3, pool_maxsize=7)
+        # pylint: disable=protected-access
+        adapter = api._session.get_adapter('https://git.example.com/api/v4')
+        assert adapter._pool_connections == 3
+        assert adapter._pool_maxsize == 7
+
+    def test_get_dispatches_through_session(self):
+        self.respond_with(200, {'id': 1})
+        assert self.api.call(gitlab.GET('/projects/1', {'simple': True})) == {'id': 1}
+        self.session.request.assert_called_once_with(
+            'GET', 'http://git.example.com/api/v4/projects/1',
+            headers={'PRIVATE-TOKEN': 'a-token'}, timeout=60, params={'simple': 'true'},
+        )
+
+    def test_put_dispatches_through_session(self):
+        self.respond_with(200, {})
+        self.api.call(gitlab.PUT('/projects/1/merge_requests/2', {'state_event': 'close'}), sudo=42)
+        self.session.request.assert_called_once_with(
+            'PUT', 'http://git.example.com/api/v4/projects/1/merge_requests/2',
+            headers={'PRIVATE-TOKEN': 'a-token', 'SUDO': '42'}, timeout=60, json={'state_event': 'close'},
+        )
+
+    def test_graphql_posts_query(self):
+        self.respond_with(200, {'data': {'project': None}})
+        assert self.api.graphql('query($p: ID!) { project(fullPath: $p) { id } }', {'p': 'a/b'}) == {
+            'project': None,
+        }
+        self.session.request.assert_called_once_with(
+            'POST', 'http://git.example.com/api/graphql',
+            headers={'PRIVATE-TOKEN': 'a-token'}, timeout=60,
+            json={'query': 'query($p: ID!) { project(fullPath: $p) { id } }', 'variables': {'p': 'a/b'}},
+        )
+
+    def test_graphql_errors(self):
+        self.respond_with(200, {'data': None, 'errors': [{'message': 'Field is bogus'}]})
+        with pytest.raises(gitlab.GraphQLError) as exc_info:
+            self.api.graphql('{ bogus }')
+        assert exc_info.value.error_message == 'Field is bogus'
+
+    def test_graphql_queries_are_retried(self):
+        self.retry_up_to(1)
+        self.session.request.side_effect = [_response(502), _response(200, {'data': {}})]
+        with patch('marge.gitlab.time.sleep'):
+            assert self.api.graphql('{ currentUser { id } }') == {}
+        assert self.session.request.call_count == 2
+
+    def test_revalidates_cached_responses(self):
+        self.api = gitlab.Api('http://git.example.com/', 'a-token', cache=ResponseCache(maxsize=10))
+        self.session = self.api._session = Mock(requests.Session)  # pylint: disable=protected-access
+        command = gitlab.GET('/projects/1/merge_requests/2')
+
+        self.session.request.return_value = _response(200, {'iid': 2}, {'ETag': 'W/"abc"'})
+        assert self.api.call(command) == {'iid': 2}
+        _, kwargs = self.session.request.call_args
+        assert 'If-None-Match' not in kwargs['headers']
+
+        self.session.request.return_value = _response(304)
+        assert self.api.call(command) == {'iid': 2}
+        _, kwargs = self.session.request.call_args
+        assert kwargs['headers']['If-None-Match'] == 'W/"abc"'
+
+        self.session.request.return_value = _response(200, {'iid': 2, 'state': 'merged'}, {'ETag': 'W/"def"'})
+        assert self.api.call(command) == {'iid': 2, 'state': 'merged'}
+        assert self.session.request.call_count == 3
+
+    def test_serves_fresh_responses_from_cache(self):
+        response_cache = ResponseCache(maxsize=10, ttls=[(r'\A/version\Z', 60)])
+        self.api = gitlab.Api('http://git.example.com/', 'a-token', cache=response_cache)
+        self.session = self.api._session = Mock(requests.Session)  # pylint: disable=protected-access
+
+        self.session.request.return_value = _response(200, {'version': '11.6.0-ee'})
+        assert self.api.version() == self.api.version() == gitlab.Version.parse('11.6.0-ee')
+        assert self.session.request.call_count == 1
+
+    @patch('marge.gitlab.time.sleep')
+    def test_retries_server_errors_with_backoff(self, sleep):
+        self.retry_up_to(3)
+        self.session.request.side_effect = [
+            _response(502), requests.exceptions.Timeout(), _response(500), _response(200, {'id': 1}),
+        ]
+        with patch('marge.gitlab.random.uniform', side_effect=lambda low, high: high):
+            assert self.api.call(gitlab.GET('/projects/1')) == {'id': 1}
+        assert [args for args, _ in sleep.call_args_list] == [(1,), (2,), (3,)]
+
+    @patch('marge.gitlab.time.sleep')
+    def test_gives_up_eventually(self, sleep):
+        self.retry_up_to(2)
+        self.respond_with(503)
+        with pytest.raises(gitlab.InternalServerError):
+            self.api.call(gitlab.PUT('/projects/1/merge_requests/2/merge'))
+        assert sleep.call_count == 2
+
+    @patch('marge.gitlab.time.sleep')
+    def test_does_not_retry_non_idempotent_calls(self, sleep):
+        self.retry_up_to(2)
+        self.respond_with(500)
+        with pytest.raises(gitlab.InternalServerError):
+            self.api.call(gitlab.POST('/projects/1/merge_requests/2/notes', {'body': 'hi'}))
+        sleep.assert_not_called()
+
+    @patch('marge.gitlab.time.sleep')
+    def test_honors_retry_after(self, sleep):
+        self.retry_up_to(2, max_backoff=60)
+        self.session.request.side_effect = [_response(429, headers={'Retry-After': '17'}), _response(201, {})]
+        assert self.api.call(gitlab.POST('/projects/1/merge_requests/2/notes', {'body': 'hi'})) == {}
+        sleep.assert_called_once_with(17)
+
+    @patch('marge.gitlab.time.sleep')
+    def test_caps_retry_after(self, sleep):
+        self.retry_up_to(2, max_backoff=60)
+        self.session.request.side_effect = [
+            _response(429, headers={'Retry-After': '36000'}), _response(201, {}),
+        ]
+        assert self.api.call(gitlab.POST('/projects/1/merge_requests/2/notes', {'body': 'hi'})) == {}
+        sleep.assert_called_once_with(60)
+
+    def test_records_metrics(self):
+        api_metrics = Mock(ApiMetrics)
+        self.api._metrics = api_metrics  # pylint: disable=protected-access
+        self.respond_with(404, {'message': '404 Not Found'})
+        with pytest.raises(gitlab.NotFound):
+            self.api.call(gitlab.GET('/projects/1'))
+        api_metrics.observe.assert_called_once_with('get', '/projects/1', 404, ANY)
+
+    def test_maps_errors(self):
+        self.respond_with(404, {'message': '404 Not Found'})
+        with pytest.raises(gitlab.NotFound) as exc_info:
+            self.api.call(gitlab.GET('/projects/1'))
+        assert exc_info.value.error_message == '404 Not Found'
+
+    def test_collect_all_pages_uses_total_pages(self):
+        self.respond_with_pages([[1, 2], [3, 4], [5]], headers=lambda _: {'X-Total-Pages': '3'})
+        assert self.api.collect_all_pages(gitlab.GET('/projects/1/merge_requests')) == [1, 2, 3, 4, 5]
+        assert sorted(self.requested_pages()) == ['1', '2', '3']
+
+    def test_collect_all_pages_follows_next_page(self):
+        self.respond_with_pages(
+            [[1, 2], [3, 4], [5]],
+            headers=lambda page_no: {'X-Next-Page': str(page_no + 1) if page_no < 3 else ''},
+        )
+        assert self.api.collect_all_pages(gitlab.GET('/projects/1/merge_requests')) == [1, 2, 3, 4, 5]
+        assert self.requested_pages() == ['1', '2', '3']
+
+    def test_collect_all_pages_without_pagination_headers(self):
+        self.respond_with_pages([[1, 2], [3, 4], [5]])
+        assert self.api.collect_all_pages(gitlab.GET('/projects/1/merge_requests')) == [1, 2, 3, 4, 5]
+        assert self.requested_pages() == ['1', '2', '3', '4']
+
+    def test_iter_pages_streams_pages_in_order(self):
+        pages = [[n, n + 1] for n in range(1, 20, 2)]
+        self.respond_with_pages(pages, headers=lambda _: {'X-Total-Pages': str(len(pages))})
+        assert list(self.api.iter_pages(gitlab.GET('/projects/1/merge_requests'))) == list(range(1, 21))
+
+    def test_iter_pages_stops_fetching_when_caller_stops(self):
+        self.respond_with_pages(
+            [[1, 2], [3, 4], [5]],
+            headers=lambda page_no: {'X-Next-Page': str(page_no + 1) if page_no < 3 else ''},
+        )
+        items = self.api.iter_pages(gitlab.GET('/projects/1/merge_requests'))
+        assert next(item for item in items if item > 2) == 3
+        assert self.requested_pages() == ['1', '2']
+
+    def test_iter_pages_follows_keyset_links(self):
+        next_link = '<https://git.example.com/api/v4/projects?id_after=%d&membership=true&order_by=id' \
+            '&pagination=keyset&per_page=100&sort=asc>; rel="next"'
+        pages = {
+            None: ([1, 2], {'Link': next_link % 2}),
+            '2': ([3, 4], {'Link': next_link % 4}),
+            '4': ([5], {}),
+        }
+
+        def respond(_method, _url, params, **_kwargs):
+            page, headers = pages[params.get('id_after')]
+            return _response(200, page, headers)
+
+        self.session.request.side_effect = respond
+        projects = self.api.iter_pages(gitlab.GET('/projects', {'membership': True}))
+        assert list(projects) == [1, 2, 3, 4, 5]
+
+        requested = [(url, kwargs['params']) for (_, url), kwargs in self.session.request.call_args_list]
+        keyset_args = {
+            'membership': 'true', 'order_by': 'id', 'pagination': 'keyset', 'per_page': '100', 'sort': 'asc',
+        }
+        assert requested == [
+            ('http://git.example.com/api/v4/projects', keyset_args),
+            ('http://git.example.com/api/v4/projects', dict(keyset_args, id_after='2')),
+            ('http://git.example.com/api/v4/projects', dict(keyset_args, id_after='4')),
+        ]
+
+    def test_iter_pages_falls_back_to_offset_if_keyset_is_ignored(self):
+        self.respond_with_pages([[1, 2], [3, 4], [5]], headers=lambda _: {'X-Total-Pages': '3'})
+
+        # respond_with_pages() looks at 'page', which a keyset request does not have
+        def first_page_has_no_page_arg(method, url, params, **kwargs):
+            return respond(method, url, dict(params, page=params.get('page', '1')), **kwargs)
+
+        respond = self.session.request.side_effect
+        self.session.request.side_effect = first_page_has_no_page_arg
+        assert list(self.api.iter_pages(gitlab.GET('/projects'))) == [1, 2, 3, 4, 5]
+
+    def test_only_some_listings_support_keyset_pagination(self):
+        assert gitlab.GET('/projects').supports_keyset_pagination
+        assert not gitlab.GET('/projects', {'order_by': 'name'}).supports_keyset_pagination
+        assert not gitlab.GET('/projects/1/merge_requests').supports_keyset_pagination
+
+
+class TestAsyncApi:
+    def setup_method(self, _method):
+        self.api = Mock(gitlab.Api)
+        self.async_api = gitlab.AsyncApi(self.api, max_concurrency=4)
+
+    def teardown_method(self, _method):
+        self.async_api.shutdown()
+
+    def test_calls_concurrently_and_keeps_order(self):
+        all_started = threading.Barrier(3, timeout=5)
+
+        def call(command, sudo=None):
+            all_started.wait()  # would time out if the calls were made one after the other
+            return {'endpoint': command.endpoint, 'sudo': sudo}
+
+        self.api.call.side_effect = call
+        results = self.async_api.run_concurrently([
+            self.async_api.call(gitlab.GET('/projects/%s' % project_id)) for project_id in range(3)
+        ])
+        assert results == [{'endpoint': '/projects/%s' % project_id, 'sudo': None} for project_id in range(3)]
+
+    def test_raises_the_same_errors(self):
+        self.api.call.side_effect = gitlab.NotFound(404, {'message': '404 Not Found'})
+        with pytest.raises(gitlab.NotFound):
+            self.async_api.run_concurrently([self.async_api.call(gitlab.GET('/projects/1'))])
+
+    def test_runs_blocking_functions(self):
+        self.api.version.return_value = gitlab.Version.parse('11.6.0-ee')
+        version, total = self.async_api.run_concurrently([
+            self.async_api.version(),
+            self.async_api.run(sum, [1, 2]),
+        ])
+        assert version.release == (11, 6, 0)
+        assert total == 3
+
+
+class _Thing(gitlab.Resource):
+    FIELDS = ('id', 'name', 'colour')
+
+    @classmethod
+    def refetch_command(cls, info):
+        return gitlab.GET('/things/{0[id]}'.format(info))
+
+
+# pylint: disable=attribute-defined-outside-init
+class TestCompactResource:
+
+    def setup_method(self, _method):
+        self.api = Mock(gitlab.Api)
+        gitlab.Resource.compact = True
+
+    def teardown_method(self, _method):
+        gitlab.Resource.compact = False
+
+    def test_only_keeps_declared_fields(self):
+        thing = _Thing(self.api, {'id': 1, 'name': 'foo', 'description': 'x' * 1000})
+
+        assert not hasattr(thing.info, '__dict__')
+        assert dict(thing.info) == {'id': 1, 'name': 'foo'}
+        assert thing.id == 1
+        assert 'description' not in thing.info
+        assert thing.info.get('colour', 'blue') == 'blue'
+        with pytest.raises(KeyError):
+            thing.info['colour']  # pylint: disable=pointless-statement
+        self.api.call.assert_not_called()
+
+    def test_refetches_undeclared_fields(self):
+        self.api.call = Mock(return_value={'id': 1, 'name': 'foo', 'description': 'long'})
+        thing = _Thing(self.api, {'id': 1, 'name': 'foo', 'description': 'long'})
+
+        assert thing.info['description'] == 'long'
+        self.api.call.assert_called_once_with(gitlab.GET('/things/1'))
+
+    def test_no_refetch_without_command(self):
+        class Other(gitlab.Resource):
+            FIELDS = ('id',)
+
+        other = Other(self.api, {'id': 1, 'name': 'foo'})
+        with pytest.raises(KeyError):
+            other.info['name']  # pylint: disable=pointless-statement
+        self.api.call.assert_not_called()
+
+    def test_off_by_default(self):
+        gitlab.Resource.compact = False
+        info = {'id': 1, 'description': 'long'}
+        assert _Thing(self.api, info).info is info
+
+    def test_resources_without_fields_keep_everything(self):
+        info = {'id': 1, 'description': 'long'}
+        assert gitlab.Resource(self.api, info).info is info
+
+
+def _response(status_code, json=None, headers=None):
+    content = b'' if json is None else json_module.dumps(json).encode('utf-8')
+    response = Mock(requests.Response, status_code=status_code, content=content, reason='Reason')
+    response.json.return_value = json
+    response.headers = headers or {}
+    return response
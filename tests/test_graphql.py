@@ -0,0 +1,69 @@
+from unittest.mock import call, Mock
+
+from marge.gitlab import Api
+from marge.graphql import fetch_open_merge_requests, MergeRequestSnapshot, OPEN_MERGE_REQUESTS_QUERY
+from tests.graphql_mock import node, page
+
+
+class TestMergeRequestSnapshot:
+
+    def test_from_node(self):
+        snapshot = MergeRequestSnapshot.from_node(node(3))
+        assert snapshot.id == 103
+        assert snapshot.iid == 3
+        assert snapshot.author_id == 88
+        assert snapshot.assignee_ids == [77]
+        assert snapshot.approver_usernames == ['alice']
+        assert snapshot.pipeline_status == 'success'
+        assert snapshot.ci_status == 'success'
+
+    def test_ci_status_is_for_head_only(self):
+        snapshot = MergeRequestSnapshot.from_node(node(3, headPipeline={'sha': 'old', 'status': 'FAILED'}))
+        assert snapshot.pipeline_status == 'failed'
+        assert snapshot.ci_status is None
+
+        assert MergeRequestSnapshot.from_node(node(3, headPipeline=None)).ci_status is None
+
+    def test_missing_approvals(self):
+        snapshot = MergeRequestSnapshot.from_node(node(3, approvalsLeft=None, approvedBy=None))
+        assert snapshot.approvals_left == 0
+        assert snapshot.approver_usernames == []
+
+    def test_merge_request_info(self):
+        info = MergeRequestSnapshot.from_node(node(3)).merge_request_info(project_id=5)
+        assert info['id'] == 103
+        assert info['iid'] == 3
+        assert info['project_id'] == 5
+        assert info['sha'] == 'abc3'
+        assert info['work_in_progress'] is False
+        assert info['author'] == {'id': 88}
+        assert info['assignees'] == [{'id': 77}]
+
+
+# pylint: disable=attribute-defined-outside-init
+class TestFetchOpenMergeRequests:
+
+    def setup_method(self, _method):
+        self.api = Mock(Api)
+
+    def test_follows_cursors(self):
+        self.api.graphql = Mock(side_effect=[page([node(1), node(2)], end_cursor='c1'), page([node(3)])])
+
+        snapshots = fetch_open_merge_requests(self.api, 'a/b', assignee_username='marge-bot')
+
+        assert [snapshot.iid for snapshot in snapshots] == [1, 2, 3]
+        variables = {'fullPath': 'a/b', 'assignee': 'marge-bot', 'sort': 'CREATED_ASC', 'after': None}
+        assert self.api.graphql.call_args_list == [
+            call(OPEN_MERGE_REQUESTS_QUERY, variables),
+            call(OPEN_MERGE_REQUESTS_QUERY, dict(variables, after='c1')),
+        ]
+
+    def test_merge_order(self):
+        self.api.graphql = Mock(return_value=page([]))
+        fetch_open_merge_requests(self.api, 'a/b', merge_order='updated_at')
+        _, variables = self.api.graphql.call_args[0]
+        assert variables['sort'] == 'UPDATED_ASC'
+
+    def test_unknown_project(self):
+        self.api.graphql = Mock(return_value={'project': None})
+        assert fetch_open_merge_requests(self.api, 'a/b') == []
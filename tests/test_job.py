@@ -11,6 +11,8 @@ import marge.gitlab
 import marge.merge_request
 import marge.project
 import marge.user
+from marge.ci_poller import CIPoller
+from marge.webhook import EventHub
 
 
 class TestJob:
@@ -188,6 +190,54 @@ class TestJob:
             local=ANY,
         )
 
+    @patch('marge.job.time.sleep')
+    def test_wait_for_events_without_webhooks(self, sleep):
+        merge_job = self.get_merge_job()
+        merge_job.wait_for_events(self._mock_merge_request(), None, 10)
+        sleep.assert_called_once_with(10)
+
+    @patch('marge.job.time.sleep')
+    def test_wait_for_events_woken_by_webhook(self, sleep):
+        events = EventHub()
+        merge_job = self.get_merge_job(events=events)
+        merge_request = self._mock_merge_request(source_project_id=5678, target_project_id=1234)
+
+        cursor = events.cursor()
+        events.publish({1234})  # e.g. whilst we were polling CI
+        merge_job.wait_for_events(merge_request, cursor, 10)
+        sleep.assert_not_called()
+
+    @patch('marge.job.time.sleep')
+    @patch('marge.job.POLL_SECS_WITH_WEBHOOKS', 0.01)
+    def test_wait_for_events_falls_back_to_polling(self, sleep):
+        events = EventHub()
+        merge_job = self.get_merge_job(events=events)
+        merge_request = self._mock_merge_request(source_project_id=5678, target_project_id=1234)
+
+        cursor = events.cursor()
+        events.publish({42})
+        merge_job.wait_for_events(merge_request, cursor, 0.01)
+        sleep.assert_not_called()
+
+    @patch('marge.job.time.sleep')
+    def test_wait_for_ci_to_pass_adaptively(self, sleep):
+        ci_poller = CIPoller()
+        ci_poller.learn_history = Mock()
+        ci_poller.record(1234, 100)
+        project = create_autospec(marge.project.Project, spec_set=True, id=1234)
+        merge_job = self.get_merge_job(project=project, ci_poller=ci_poller)
+        merge_request = self._mock_merge_request(sha='abc', iid=1)
+
+        with patch.object(merge_job, 'get_mr_ci_status', side_effect=['running', 'running', 'success']):
+            merge_job.wait_for_ci_to_pass(merge_request)
+
+        ci_poller.learn_history.assert_called_once_with(1234, merge_job._api)
+        # no time passes when sleeping is mocked, so CI is always about 100s from finishing
+        delays = [args[0] for args, _ in sleep.call_args_list]
+        assert len(delays) == 2
+        assert all(45 <= delay <= 50 for delay in delays)
+        assert ci_poller.expected_duration(1234) < 100  # that was quick!
+
 
 class TestMergeJobOptions:
     def test_default(self):
@@ -200,6 +250,7 @@ class TestMergeJobOptions:
             embargo=marge.interval.IntervalUnion.empty(),
             ci_timeout=timedelta(minutes=15),
             fusion=Fusion.rebase,
+            use_graphql=False,
         )
 
     def test_default_ci_time(self):
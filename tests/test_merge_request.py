@@ -1,9 +1,10 @@
+import re
 from unittest.mock import call, Mock
 
 import pytest
 
 from marge.gitlab import Api, GET, POST, PUT, Version
-from marge.merge_request import MergeRequest, MergeRequestRebaseFailed
+from marge.merge_request import literal_branch, MergeRequest, MergeRequestRebaseFailed
 
 _MARGE_ID = 77
 
@@ -177,13 +178,44 @@ class TestMergeRequest:
     def test_fetch_all_opened_for_me(self):
         api = self.api
         mr1, mr_not_me, mr2 = INFO, dict(INFO, assignees=[{'id': _MARGE_ID+1}], id=679), dict(INFO, id=678)
-        api.collect_all_pages = Mock(return_value=[mr1, mr_not_me, mr2])
+        api.iter_pages = Mock(return_value=iter([mr1, mr_not_me, mr2]))
         result = MergeRequest.fetch_all_open_for_user(
             1234, user_id=_MARGE_ID, api=api, merge_order='created_at'
         )
-        api.collect_all_pages.assert_called_once_with(GET(
+        api.iter_pages.assert_called_once_with(GET(
             '/projects/1234/merge_requests',
-            {'state': 'opened', 'order_by': 'created_at', 'sort': 'asc'},
+            {'state': 'opened', 'order_by': 'created_at', 'sort': 'asc', 'assignee_id': _MARGE_ID},
+        ))
+        assert [mr.info for mr in result] == [mr1, mr2]
+
+    def test_fetch_all_opened_for_me_on_branches(self):
+        api = self.api
+        api.iter_pages = Mock(return_value=iter([INFO]))
+        result = MergeRequest.fetch_all_open_for_user(
+            1234, user_id=_MARGE_ID, api=api, merge_order='updated_at',
+            target_branch='master', source_branch='useless_new_feature',
+        )
+        api.iter_pages.assert_called_once_with(GET(
+            '/projects/1234/merge_requests',
+            {
+                'state': 'opened',
+                'order_by': 'updated_at',
+                'sort': 'asc',
+                'assignee_id': _MARGE_ID,
+                'target_branch': 'master',
+                'source_branch': 'useless_new_feature',
+            },
+        ))
+        assert [mr.info for mr in result] == [INFO]
+
+    def test_fetch_all_open_assigned_to_me(self):
+        api = self.api
+        mr1, mr2 = INFO, dict(INFO, id=678, project_id=4321)
+        api.iter_pages = Mock(return_value=iter([mr1, mr2]))
+        result = MergeRequest.fetch_all_open_assigned_to_me(api, merge_order='updated_at')
+        api.iter_pages.assert_called_once_with(GET(
+            '/merge_requests',
+            {'scope': 'assigned_to_me', 'state': 'opened', 'order_by': 'updated_at', 'sort': 'asc'},
         ))
         assert [mr.info for mr in result] == [mr1, mr2]
 
@@ -193,3 +225,16 @@ class TestMergeRequest:
         self.merge_request.refetch_info()
         self.api.call.assert_called_with(GET('/projects/1234/merge_requests/54'))
         self.api.call = old_mock
+
+
+def test_literal_branch():
+    assert literal_branch(re.compile(r'master$')) == 'master'
+    assert literal_branch(re.compile(r'^master$')) == 'master'
+    assert literal_branch(re.compile(r'\Arelease/1\.0\Z')) == 'release/1.0'
+
+    assert literal_branch(re.compile(r'master')) is None  # also matches master-foo
+    assert literal_branch(re.compile(r'.*')) is None
+    assert literal_branch(re.compile(r'release/1.0$')) is None
+    assert literal_branch(re.compile(r'master|main$')) is None
+    assert literal_branch(re.compile(r'master$', re.IGNORECASE)) is None
+    assert literal_branch(re.compile(r'$')) is None
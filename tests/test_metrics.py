@@ -0,0 +1,70 @@
+import requests
+
+from marge.metrics import ApiMetrics, endpoint_template, status_class
+
+
+def test_endpoint_template():
+    assert endpoint_template('/projects/1234/merge_requests/54/approvals') == \
+        '/projects/:id/merge_requests/:id/approvals'
+    assert endpoint_template('/projects/1234/repository/branches/feature/foo') == \
+        '/projects/:id/repository/branches/:branch'
+    assert endpoint_template('/projects/1234/repository/commits/505e') == \
+        '/projects/:id/repository/commits/:sha'
+    assert endpoint_template('/users/7') == '/users/:id'
+    assert endpoint_template('/version') == '/version'
+
+
+def test_status_class():
+    assert status_class(200) == '2xx'
+    assert status_class(404) == '4xx'
+    assert status_class(None) == 'error'
+
+
+class TestApiMetrics:
+    def setup_method(self, _method):
+        self.metrics = ApiMetrics(buckets=(0.1, 1))
+        self.metrics.observe('get', '/projects/1/merge_requests/2', 200, 0.05)
+        self.metrics.observe('get', '/projects/3/merge_requests/4', 200, 0.5)
+        self.metrics.observe('put', '/projects/1/merge_requests/2/merge', 406, 2)
+
+    def test_render(self):
+        assert self.metrics.render().splitlines() == [
+            '# HELP marge_gitlab_api_calls_total GitLab API calls made.',
+            '# TYPE marge_gitlab_api_calls_total counter',
+            'marge_gitlab_api_calls_total'
+            '{method="GET",path="/projects/:id/merge_requests/:id",status="2xx"} 2',
+            'marge_gitlab_api_calls_total'
+            '{method="PUT",path="/projects/:id/merge_requests/:id/merge",status="4xx"} 1',
+            '# HELP marge_gitlab_api_call_duration_seconds Latency of GitLab API calls.',
+            '# TYPE marge_gitlab_api_call_duration_seconds histogram',
+            'marge_gitlab_api_call_duration_seconds_bucket'
+            '{method="GET",path="/projects/:id/merge_requests/:id",status="2xx",le="0.1"} 1',
+            'marge_gitlab_api_call_duration_seconds_bucket'
+            '{method="GET",path="/projects/:id/merge_requests/:id",status="2xx",le="1"} 2',
+            'marge_gitlab_api_call_duration_seconds_bucket'
+            '{method="GET",path="/projects/:id/merge_requests/:id",status="2xx",le="+Inf"} 2',
+            'marge_gitlab_api_call_duration_seconds_sum'
+            '{method="GET",path="/projects/:id/merge_requests/:id",status="2xx"} 0.55',
+            'marge_gitlab_api_call_duration_seconds_count'
+            '{method="GET",path="/projects/:id/merge_requests/:id",status="2xx"} 2',
+            'marge_gitlab_api_call_duration_seconds_bucket'
+            '{method="PUT",path="/projects/:id/merge_requests/:id/merge",status="4xx",le="0.1"} 0',
+            'marge_gitlab_api_call_duration_seconds_bucket'
+            '{method="PUT",path="/projects/:id/merge_requests/:id/merge",status="4xx",le="1"} 0',
+            'marge_gitlab_api_call_duration_seconds_bucket'
+            '{method="PUT",path="/projects/:id/merge_requests/:id/merge",status="4xx",le="+Inf"} 1',
+            'marge_gitlab_api_call_duration_seconds_sum'
+            '{method="PUT",path="/projects/:id/merge_requests/:id/merge",status="4xx"} 2.0',
+            'marge_gitlab_api_call_duration_seconds_count'
+            '{method="PUT",path="/projects/:id/merge_requests/:id/merge",status="4xx"} 1',
+        ]
+
+    def test_serve(self):
+        server = self.metrics.serve(port=0, host='127.0.0.1')
+        try:
+            response = requests.get('http://127.0.0.1:%d/metrics' % server.server_address[1], timeout=5)
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert response.status_code == 200
+        assert response.text == self.metrics.render()
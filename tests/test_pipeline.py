@@ -30,6 +30,34 @@ class TestPipeline:
         ))
         assert [pl.info for pl in result] == [pl1, pl2]
 
+    def test_pipelines_by_branch_and_sha(self):
+        api = self.api
+        api.call = Mock(return_value=[INFO])
+
+        Pipeline.pipelines_by_branch(project_id=1234, branch=INFO['ref'], api=api, sha=INFO['sha'])
+        api.call.assert_called_once_with(GET(
+            '/projects/1234/pipelines',
+            {'ref': INFO['ref'], 'order_by': 'id', 'sort': 'desc', 'sha': INFO['sha']},
+        ))
+
+    def test_recent(self):
+        api = self.api
+        api.call = Mock(return_value=[INFO])
+
+        result = Pipeline.recent(project_id=1234, api=api, count=5)
+        api.call.assert_called_once_with(GET(
+            '/projects/1234/pipelines',
+            {'status': 'success', 'order_by': 'id', 'sort': 'desc', 'per_page': 5},
+        ))
+        assert [pl.info for pl in result] == [dict(INFO, project_id=1234)]
+
+    def test_duration(self):
+        times = {'created_at': '2019-01-01T10:00:00.000Z', 'updated_at': '2019-01-01T10:02:30.000Z'}
+        assert Pipeline(self.api, dict(INFO, **times), 1234).duration == 150
+        finished = dict(INFO, finished_at='2019-01-01T10:01:00.000Z', **times)
+        assert Pipeline(self.api, finished, 1234).duration == 60
+        assert Pipeline(self.api, dict(INFO), 1234).duration is None
+
     def test_pipelines_by_merge_request(self):
         api = self.api
         pl1, pl2 = INFO, dict(INFO, id=48)
@@ -1,3 +1,4 @@
+import datetime
 from unittest.mock import Mock
 import pytest
 
@@ -55,22 +56,22 @@ class TestProject:
         prj1 = INFO
         prj2 = dict(INFO, id=1235, path_with_namespace='foo/bar')
         prj3 = dict(INFO, id=1240, path_with_namespace='foo/foo')
-        api.collect_all_pages = Mock(return_value=[prj1, prj2, prj3])
+        api.iter_pages = Mock(return_value=iter([prj1, prj2, prj3]))
 
         project = Project.fetch_by_path('foo/bar', api)
 
-        api.collect_all_pages.assert_called_once_with(GET('/projects'))
+        api.iter_pages.assert_called_once_with(GET('/projects'))
         assert project and project.info == prj2
 
     def fetch_all_mine_with_permissions(self):
         prj1, prj2 = INFO, dict(INFO, id=678)
 
         api = self.api
-        api.collect_all_pages = Mock(return_value=[prj1, prj2])
+        api.iter_pages = Mock(return_value=iter([prj1, prj2]))
         api.version = Mock(return_value=Version.parse("11.0.0-ee"))
 
         result = Project.fetch_all_mine(api)
-        api.collect_all_pages.assert_called_once_with(GET(
+        api.iter_pages.assert_called_once_with(GET(
             '/projects',
             {
                 'membership': True,
@@ -84,11 +85,11 @@ class TestProject:
         prj1, prj2 = dict(INFO, permissions=NONE_ACCESS), dict(INFO, id=678, permissions=NONE_ACCESS)
 
         api = self.api
-        api.collect_all_pages = Mock(return_value=[prj1, prj2])
+        api.iter_pages = Mock(return_value=iter([prj1, prj2]))
         api.version = Mock(return_value=Version.parse("11.2.0-ee"))
 
         result = Project.fetch_all_mine(api)
-        api.collect_all_pages.assert_called_once_with(GET(
+        api.iter_pages.assert_called_once_with(GET(
             '/projects',
             {
                 'membership': True,
@@ -100,6 +101,24 @@ class TestProject:
         assert all(prj.info["permissions"]["marge"] for prj in result)
         assert all(prj.access_level == AccessLevel.developer for prj in result)
 
+    def test_fetch_all_mine_with_recent_activity(self):
+        api = self.api
+        api.iter_pages = Mock(return_value=iter([dict(INFO, permissions=dict(INFO['permissions']))]))
+        api.version = Mock(return_value=Version.parse("11.2.0-ee"))
+
+        result = Project.fetch_all_mine(api, last_activity_after=datetime.datetime(2019, 1, 2, 3, 4, 5))
+        api.iter_pages.assert_called_once_with(GET(
+            '/projects',
+            {
+                'membership': True,
+                'with_merge_requests_enabled': True,
+                'archived': False,
+                'min_access_level': AccessLevel.developer.value,
+                'last_activity_after': '2019-01-02T03:04:05Z',
+            },
+        ))
+        assert [prj.id for prj in result] == [1234]
+
     def test_properties(self):
         project = Project(api=self.api, info=INFO)
         assert project.id == 1234
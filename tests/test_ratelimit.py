@@ -0,0 +1,94 @@
+from marge import ratelimit
+from marge.ratelimit import Priority, RateLimiter
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+
+# pylint: disable=attribute-defined-outside-init
+class TestRateLimiter:
+    def setup_method(self, _method):
+        self.time = FakeTime()
+
+    def limiter(self, **kwargs):
+        return RateLimiter(clock=self.time.clock, wall_clock=self.time.clock, sleep=self.time.sleep, **kwargs)
+
+    def test_no_limit_by_default(self):
+        limiter = self.limiter()
+        for _ in range(100):
+            limiter.acquire()
+        assert self.time.sleeps == []
+
+    def test_paces_after_burst(self):
+        limiter = self.limiter(rate=2, burst=4)
+        for _ in range(6):
+            limiter.acquire()
+        assert self.time.sleeps == [0.5, 0.5]
+
+    def test_follows_gitlab_headers(self):
+        limiter = self.limiter(burst=4)
+        limiter.update({'RateLimit-Remaining': '10', 'RateLimit-Reset': str(int(self.time.now) + 5)})
+        for _ in range(6):
+            limiter.acquire()
+        # spend what is left evenly until the limit resets: 10 requests in 5 secs
+        assert self.time.sleeps == [0.5, 0.5]
+
+    def test_waits_for_reset_when_exhausted(self):
+        limiter = self.limiter()
+        limiter.update({'RateLimit-Remaining': '0', 'RateLimit-Reset': str(int(self.time.now) + 30)})
+        limiter.acquire()
+        assert self.time.sleeps == [30]
+
+    def test_ignores_missing_headers(self):
+        limiter = self.limiter()
+        limiter.update({'RateLimit-Remaining': '0'})
+        limiter.acquire()
+        assert self.time.sleeps == []
+
+    def test_background_calls_leave_a_reserve(self):
+        limiter = self.limiter(rate=1, burst=4, background_reserve=0.5)
+        limiter.acquire(Priority.normal)
+        limiter.acquire(Priority.normal)
+        assert self.time.sleeps == []
+
+        # 2 tokens left, but background calls need to leave 2 spare
+        limiter.acquire(Priority.background)
+        assert self.time.sleeps == [1]
+
+        limiter.acquire(Priority.normal)
+        assert self.time.sleeps == [1]
+
+    def test_zero_rate_means_no_limit(self):
+        limiter = self.limiter(rate=0, burst=2)
+        for _ in range(10):
+            limiter.acquire()
+        assert self.time.sleeps == []
+
+    def test_zero_rate_still_waits_for_gitlab_reset(self):
+        limiter = self.limiter(rate=0, burst=2)
+        limiter.update({'RateLimit-Remaining': '0', 'RateLimit-Reset': str(int(self.time.now) + 30)})
+        for _ in range(3):
+            limiter.acquire()
+        assert self.time.sleeps == [30]
+
+    def test_background_calls_with_smallest_burst(self):
+        limiter = self.limiter(rate=1, burst=1)
+        limiter.acquire(Priority.background)
+        limiter.acquire(Priority.background)
+        assert self.time.sleeps == [1]
+
+    def test_priority_context(self):
+        assert ratelimit.current_priority() == Priority.normal
+        with ratelimit.background():
+            assert ratelimit.current_priority() == Priority.background
+        assert ratelimit.current_priority() == Priority.normal
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+from unittest.mock import call, Mock, patch
+
+from marge.gitlab import Api
+from marge.project import Project
+from marge.registry import ProjectRegistry
+from tests.test_project import INFO
+
+
+def _project(project_id):
+    return Project(Mock(Api), dict(INFO, id=project_id))
+
+
+# pylint: disable=attribute-defined-outside-init
+@patch('marge.registry.Project.fetch_all_mine')
+class TestProjectRegistry:
+
+    def setup_method(self, _method):
+        self.api = Mock(Api)
+        self.now = datetime(2019, 1, 1, 12, 0)
+        self.registry = ProjectRegistry(
+            self.api,
+            full_refresh_interval=timedelta(hours=1),
+            activity_margin=timedelta(minutes=10),
+            clock=lambda: self.now,
+        )
+
+    def ids(self, projects):
+        return [project.id for project in projects]
+
+    def test_lists_all_projects_first(self, fetch_all_mine):
+        fetch_all_mine.return_value = [_project(1), _project(2)]
+        assert self.ids(self.registry.refresh()) == [1, 2]
+        assert self.ids(self.registry.projects()) == [1, 2]
+        fetch_all_mine.assert_called_once_with(self.api)
+
+    def test_only_lists_active_projects_in_between(self, fetch_all_mine):
+        fetch_all_mine.return_value = [_project(1), _project(2), _project(3)]
+        self.registry.refresh()
+
+        self.now += timedelta(minutes=1)
+        fetch_all_mine.return_value = [_project(2)]
+        assert self.ids(self.registry.refresh()) == [2]
+        fetch_all_mine.assert_called_with(self.api, last_activity_after=datetime(2019, 1, 1, 11, 50))
+
+        self.now += timedelta(minutes=1)
+        fetch_all_mine.return_value = []
+        assert self.ids(self.registry.refresh()) == []
+        fetch_all_mine.assert_called_with(self.api, last_activity_after=datetime(2019, 1, 1, 11, 51))
+        assert self.ids(self.registry.projects()) == [1, 2, 3]
+
+    def test_picks_up_new_projects(self, fetch_all_mine):
+        fetch_all_mine.return_value = [_project(1)]
+        self.registry.refresh()
+
+        self.now += timedelta(minutes=1)
+        fetch_all_mine.return_value = [_project(2)]
+        assert self.ids(self.registry.refresh()) == [2]
+        assert self.ids(self.registry.projects()) == [1, 2]
+        assert self.registry.get(2).id == 2
+        assert self.registry.get(3) is None
+
+    def test_lists_all_projects_again_eventually(self, fetch_all_mine):
+        fetch_all_mine.return_value = [_project(1), _project(2)]
+        self.registry.refresh()
+
+        self.now += timedelta(hours=1)
+        fetch_all_mine.return_value = [_project(1)]
+        assert self.ids(self.registry.refresh()) == [1]
+        assert self.ids(self.registry.projects()) == [1]
+        assert fetch_all_mine.call_args_list == [call(self.api), call(self.api)]
@@ -0,0 +1,82 @@
+from marge.scheduler import Scheduler
+
+
+# pylint: disable=attribute-defined-outside-init
+class TestScheduler:
+
+    def setup_method(self, _method):
+        self.now = 1000
+        self.scheduler = Scheduler(min_interval=10, max_interval=60, backoff=2, clock=lambda: self.now)
+
+    def test_new_projects_are_due_right_away(self):
+        self.scheduler.sync([3, 1, 2])
+        assert len(self.scheduler) == 3
+        assert self.scheduler.secs_until_next() == 0
+        assert sorted(self.scheduler.pop_due()) == [1, 2, 3]
+        assert self.scheduler.pop_due() == []
+        assert self.scheduler.secs_until_next() is None
+
+    def test_idle_projects_back_off(self):
+        self.scheduler.sync([1])
+        intervals = []
+        for _ in range(5):
+            assert self.scheduler.pop_due() == [1]
+            self.scheduler.done(1, busy=False)
+            intervals.append(self.scheduler.secs_until_next())
+            self.now += intervals[-1]
+        assert intervals == [20, 40, 60, 60, 60]
+
+    def test_busy_projects_are_checked_again_soon(self):
+        self.scheduler.sync([1])
+        for busy in [False, False, True]:
+            self.scheduler.pop_due()
+            self.scheduler.done(1, busy=busy)
+            self.now += self.scheduler.secs_until_next()
+        assert self.scheduler.secs_until_next() == 0
+        self.scheduler.pop_due()
+        self.scheduler.done(1, busy=False)
+        assert self.scheduler.secs_until_next() == 20
+
+    def test_most_overdue_first(self):
+        self.scheduler.sync([1])
+        self.scheduler.pop_due()
+        self.scheduler.done(1, busy=False)  # due at 1020
+        self.now += 5
+        self.scheduler.sync([1, 2])  # 2 is due at 1005
+        self.now += 100
+        assert self.scheduler.pop_due() == [2, 1]
+
+    def test_wake(self):
+        self.scheduler.sync([1, 2])
+        self.scheduler.pop_due()
+        for project_id in [1, 2]:
+            self.scheduler.done(project_id, busy=False)
+        self.now += 5
+
+        self.scheduler.wake([2, 42])
+        assert self.scheduler.pop_due() == [2]
+        assert 42 not in self.scheduler
+        self.scheduler.done(2, busy=False)
+        assert self.scheduler.secs_until_next() == 15  # 1 is still due as before
+
+    def test_wake_whilst_being_checked(self):
+        self.scheduler.sync([1])
+        for _ in range(3):
+            self.scheduler.pop_due()
+            self.scheduler.done(1, busy=False)
+            self.now += self.scheduler.secs_until_next()
+        assert self.scheduler.pop_due() == [1]
+        self.scheduler.wake([1])
+        assert self.scheduler.pop_due() == []
+        self.scheduler.done(1, busy=False)
+        assert self.scheduler.secs_until_next() == 20
+
+    def test_sync_drops_gone_projects(self):
+        self.scheduler.sync([1, 2])
+        self.scheduler.sync([2])
+        assert 1 not in self.scheduler
+        assert self.scheduler.pop_due() == [2]
+        self.scheduler.done(1, busy=True)  # e.g. it was being checked
+        assert 1 not in self.scheduler
+        self.scheduler.done(2, busy=True)
+        assert self.scheduler.secs_until_next() == 10
@@ -16,9 +16,11 @@ import marge.project
 import marge.single_merge_job
 import marge.user
 from marge.gitlab import GET, PUT
+from marge.graphql import MergeRequestSnapshot
 from marge.job import Fusion
 from marge.merge_request import MergeRequest
 from tests.git_repo_mock import RepoMock
+from tests.graphql_mock import node
 from tests.gitlab_api_mock import Error, Ok, MockLab
 import tests.test_commit as test_commit
 
@@ -323,6 +325,25 @@ class TestUpdateAndAccept:  # pylint: disable=too-many-public-methods
         assert api.state == 'merged'
         assert api.notes == []
 
+    def test_trusts_mergeable_snapshot(self, mocks):
+        _, api, job = mocks
+        job._snapshot = MergeRequestSnapshot.from_node(
+            node(54, assignees={'nodes': [{'id': 'gid://gitlab/User/%s' % job._user.id}]}),
+        )
+        with patch.object(job, 'ensure_mergeable_mr', wraps=job.ensure_mergeable_mr) as ensure_mergeable_mr:
+            job.execute()
+        assert api.state == 'merged'
+        # only right before accepting it, as by then the snapshot is out of date
+        ensure_mergeable_mr.assert_called_once_with(job._merge_request)
+
+    def test_double_checks_unmergeable_snapshot(self, mocks):
+        _, api, job = mocks
+        job._snapshot = MergeRequestSnapshot.from_node(node(54, approvalsLeft=1))
+        with patch.object(job, 'ensure_mergeable_mr', wraps=job.ensure_mergeable_mr) as ensure_mergeable_mr:
+            job.execute()
+        assert api.state == 'merged'
+        assert ensure_mergeable_mr.call_count == 2
+
     def test_succeeds_with_updated_branch(self, mocks):
         mocklab, api, job = mocks
         api.add_transition(
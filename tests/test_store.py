@@ -1,5 +1,6 @@
 import os.path
 import tempfile
+import threading
 import unittest.mock as mock
 
 import marge.git
@@ -69,6 +70,25 @@ class TestRepoManager:
         assert repo_second_call is repo_first_call
         assert git_run.call_count == 3
 
+    def test_separate_repos_by_target_branch(self, git_run):
+        repo_manager = self.repo_manager
+        project = self.new_project(1234, 'some/stuff')
+
+        repo = repo_manager.repo_for_project(project)
+        assert git_run.call_count == 3
+
+        release_repo = repo_manager.repo_for_project(project, 'release/1.0')
+        assert release_repo is not repo
+        assert release_repo.reference == repo.local_path
+        assert git_run.call_count == 6
+        assert repo_manager.repo_for_project(project, 'release/1.0') is release_repo
+        assert repo_manager.repo_for_project(project) is repo
+        assert git_run.call_count == 6
+
+        repo_manager.forget_repo(project)
+        assert repo_manager.repo_for_project(project, 'release/1.0') is not release_repo
+        assert git_run.call_count == 12
+
     def test_stops_caching_if_ssh_url_changed(self, git_run):
         repo_manager = self.repo_manager
         project = self.new_project(1234, 'some/stuff')
@@ -129,3 +149,37 @@ class TestRepoManager:
 
         # shouldn't fail
         repo_manager.forget_repo(self.new_project(90, 'non/existent'))
+
+    def test_clones_do_not_block_other_projects(self, git_run):
+        repo_manager = self.repo_manager
+        project_1 = self.new_project(1234, 'some/stuff')
+        project_2 = self.new_project(5678, 'other/things')
+        repo_2 = repo_manager.repo_for_project(project_2)
+
+        cloning = threading.Event()
+        may_finish = threading.Event()
+
+        def run(*args, **_kwargs):
+            if 'clone' in args and project_1.ssh_url_to_repo in args:
+                cloning.set()
+                assert may_finish.wait(timeout=5)
+        git_run.side_effect = run
+
+        repos_1 = []
+        threads = [
+            threading.Thread(target=lambda: repos_1.append(repo_manager.repo_for_project(project_1)))
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        assert cloning.wait(timeout=5)
+
+        # whilst project_1 is being cloned
+        assert repo_manager.repo_for_project(project_2) is repo_2
+
+        may_finish.set()
+        for thread in threads:
+            thread.join()
+        # it got cloned just the once
+        assert repos_1[0] is repos_1[1]
+        assert git_run.call_count == 6
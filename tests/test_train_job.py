@@ -0,0 +1,213 @@
+# pylint: disable=protected-access
+from unittest.mock import create_autospec, patch
+
+import pytest
+
+import marge.git
+import marge.gitlab
+import marge.merge_request
+import marge.project
+import marge.user
+from marge.batch_job import CannotBatch
+from marge.job import CannotMerge, CIFailed, MergeJobOptions, SkipMerge
+from marge.train_job import MergeTrainJob
+
+
+class TestMergeTrainJob:
+
+    def _mock_merge_request(self, iid):
+        return create_autospec(
+            marge.merge_request.MergeRequest, spec_set=True,
+            iid=iid, target_branch='master', source_branch='feature-%s' % iid,
+        )
+
+    def get_train_job(self, merge_requests, depth=2, ci=True):
+        project = create_autospec(
+            marge.project.Project, spec_set=True, only_allow_merge_if_pipeline_succeeds=ci,
+        )
+        return MergeTrainJob(
+            api=create_autospec(marge.gitlab.Api, spec_set=True),
+            user=create_autospec(marge.user.User, spec_set=True),
+            project=project,
+            repo=create_autospec(marge.git.Repo, spec_set=True),
+            options=MergeJobOptions.default(),
+            merge_requests=merge_requests,
+            depth=depth,
+        )
+
+    def run_train(self, train_job, failing_iids=(), ci_error=CIFailed('CI failed!')):
+        """Execute `train_job`; return the iids of the MRs merged and of those each car tested."""
+        merged = []
+        cars = []
+
+        def create_batch_mr(target_branch, source_branch):
+            assert target_branch == 'master'
+            batch_mr = self._mock_merge_request(1000 + len(cars))
+            batch_mr.source_branch = source_branch
+            cars.append(batch_mr)
+            return batch_mr
+
+        def wait_for_ci_to_pass(batch_mr):
+            car = next(car for car in train_job_cars if car.batch_mr is batch_mr)
+            if car.merge_request.iid in failing_iids:
+                raise ci_error
+
+        def accept_mr(merge_request, expected_sha, source_repo_url=None):
+            merged.append(merge_request.iid)
+            return expected_sha
+
+        train_job_cars = []
+        add_car = train_job.add_car
+
+        def add_car_spy(train, merge_request):
+            car = add_car(train, merge_request)
+            train_job_cars.append(car)
+            return car
+
+        with patch.object(train_job, 'get_mergeable_mrs', side_effect=lambda mrs: mrs), \
+                patch.object(train_job, 'close_batch_mr'), \
+                patch.object(train_job, 'fetch_source_project', return_value=(None, None, 'origin')), \
+                patch.object(train_job, 'create_batch_mr', side_effect=create_batch_mr), \
+                patch.object(train_job, 'wait_for_ci_to_pass', side_effect=wait_for_ci_to_pass), \
+                patch.object(train_job, 'ensure_mr_not_changed'), \
+                patch.object(train_job, 'ensure_mergeable_mr'), \
+                patch.object(train_job, 'accept_mr', side_effect=accept_mr), \
+                patch.object(train_job, 'add_car', side_effect=add_car_spy):
+            train_job.execute()
+        return merged, [car.merge_request.iid for car in train_job_cars if car is not None]
+
+    def test_car_branch_name(self):
+        train_job = self.get_train_job([self._mock_merge_request(1)])
+        assert train_job.car_branch_name(1) == 'marge_bot_batch_merge_job_master_1'
+
+    def test_needs_more_than_one_merge_request(self):
+        train_job = self.get_train_job([self._mock_merge_request(1)])
+        with patch.object(train_job, 'get_mergeable_mrs', side_effect=lambda mrs: mrs), \
+                patch.object(train_job, 'close_batch_mr'):
+            with pytest.raises(CannotBatch):
+                train_job.execute()
+
+    def test_add_car_on_top_of_train(self):
+        merge_requests = [self._mock_merge_request(iid) for iid in (1, 2)]
+        train_job = self.get_train_job(merge_requests)
+        repo = train_job._repo
+        with patch.object(train_job, 'fetch_source_project', return_value=(None, None, 'origin')), \
+                patch.object(train_job, 'create_batch_mr') as create_batch_mr:
+            first = train_job.add_car([], merge_requests[0])
+            second = train_job.add_car([first], merge_requests[1])
+
+        assert (first.slot, second.slot) == (0, 1)
+        repo.checkout_branch.assert_any_call('marge_bot_batch_merge_job_master_0', 'master')
+        repo.checkout_branch.assert_any_call(
+            'marge_bot_batch_merge_job_master_1', 'marge_bot_batch_merge_job_master_0',
+        )
+        repo.push.assert_called_with('marge_bot_batch_merge_job_master_1', force=True)
+        create_batch_mr.assert_called_with(
+            target_branch='master', source_branch='marge_bot_batch_merge_job_master_1',
+        )
+        assert second.batch_mr is create_batch_mr.return_value
+
+    def test_add_car_with_conflicts(self):
+        merge_request = self._mock_merge_request(1)
+        train_job = self.get_train_job([merge_request])
+        train_job._repo.rebase.side_effect = marge.git.GitError('conflicts')
+        with patch.object(train_job, 'fetch_source_project', return_value=(None, None, 'origin')):
+            assert train_job.add_car([], merge_request) is None
+
+    def test_add_car_without_ci(self):
+        merge_request = self._mock_merge_request(1)
+        train_job = self.get_train_job([merge_request], ci=False)
+        with patch.object(train_job, 'fetch_source_project', return_value=(None, None, 'origin')):
+            car = train_job.add_car([], merge_request)
+        assert car.batch_mr is None
+        train_job._repo.push.assert_not_called()
+
+    def test_merges_all(self):
+        merge_requests = [self._mock_merge_request(iid) for iid in (1, 2, 3, 4)]
+        train_job = self.get_train_job(merge_requests, depth=2)
+        merged, tested = self.run_train(train_job)
+        assert merged == [1, 2, 3, 4]
+        assert tested == [1, 2, 3, 4]
+        # and their car branches are gone afterwards
+        train_job._repo.remove_remote_branches.assert_called_once_with(
+            'marge_bot_batch_merge_job_master_0', 'marge_bot_batch_merge_job_master_1',
+        )
+
+    def test_merges_all_without_ci(self):
+        merge_requests = [self._mock_merge_request(iid) for iid in (1, 2)]
+        train_job = self.get_train_job(merge_requests, depth=2, ci=False)
+        merged, _ = self.run_train(train_job)
+        assert merged == [1, 2]
+        # nothing was pushed, so there is nothing to remove
+        train_job._repo.remove_remote_branches.assert_not_called()
+
+    def test_keeps_going_when_removing_car_branches_fails(self):
+        merge_requests = [self._mock_merge_request(iid) for iid in (1, 2)]
+        train_job = self.get_train_job(merge_requests, depth=2)
+        train_job._repo.remove_remote_branches.side_effect = marge.git.GitError('no such ref')
+        merged, _ = self.run_train(train_job)
+        assert merged == [1, 2]
+
+    def test_restarts_train_behind_failure(self):
+        merge_requests = [self._mock_merge_request(iid) for iid in (1, 2, 3, 4)]
+        train_job = self.get_train_job(merge_requests, depth=3)
+        with patch.object(train_job, 'unassign_from_mr') as unassign_from_mr:
+            merged, tested = self.run_train(train_job, failing_iids={2})
+        assert merged == [1, 3, 4]
+        # 3 and 4 had been tested on top of 2, so they got tested again without it
+        assert tested == [1, 2, 3, 4, 3, 4]
+
+        unassign_from_mr.assert_called_once_with(merge_requests[1])
+        merge_requests[1].comment.assert_called_with("I couldn't merge this branch: CI failed!")
+        # rebuilding their cars doesn't tell them about the train again
+        merge_requests[2].comment.assert_called_once_with(
+            'I will attempt to merge this MR in a merge train (!1002)...'
+        )
+
+    def test_gives_up_without_blaming_when_ci_did_not_fail(self):
+        merge_requests = [self._mock_merge_request(iid) for iid in (1, 2, 3)]
+        train_job = self.get_train_job(merge_requests, depth=3)
+        with patch.object(train_job, 'unassign_from_mr') as unassign_from_mr:
+            with pytest.raises(CannotBatch):
+                self.run_train(train_job, failing_iids={2}, ci_error=CannotMerge('CI is taking too long.'))
+        unassign_from_mr.assert_not_called()
+        merge_requests[1].comment.assert_called_with(
+            'Batch MR !1001 failed: CI is taking too long. I will retry later...'
+        )
+
+    def test_skipped_merge_request_stays_assigned(self):
+        merge_requests = [self._mock_merge_request(iid) for iid in (1, 2)]
+        train_job = self.get_train_job(merge_requests, depth=2)
+        ensure_mergeable_mr = [SkipMerge('It is not assigned to me anymore!'), None]
+        with patch.object(train_job, 'ensure_mergeable_mr', side_effect=ensure_mergeable_mr), \
+                patch.object(train_job, 'accept_mr', return_value='sha') as accept_mr, \
+                patch.object(train_job, 'get_mergeable_mrs', side_effect=lambda mrs: mrs), \
+                patch.object(train_job, 'close_batch_mr'), \
+                patch.object(train_job, 'fetch_source_project', return_value=(None, None, 'origin')), \
+                patch.object(train_job, 'create_batch_mr'), \
+                patch.object(train_job, 'wait_for_ci_to_pass'), \
+                patch.object(train_job, 'ensure_mr_not_changed'), \
+                patch.object(train_job, 'unassign_from_mr') as unassign_from_mr:
+            train_job.execute()
+        unassign_from_mr.assert_not_called()
+        assert [args[0].iid for args, _ in accept_mr.call_args_list] == [2]
+
+    def test_aborts_when_target_branch_moved(self):
+        merge_requests = [self._mock_merge_request(iid) for iid in (1, 2, 3)]
+        train_job = self.get_train_job(merge_requests, depth=2)
+        with patch.object(train_job, 'accept_mr', side_effect=CannotBatch('Someone was naughty')), \
+                patch.object(train_job, 'get_mergeable_mrs', side_effect=lambda mrs: mrs), \
+                patch.object(train_job, 'close_batch_mr'), \
+                patch.object(train_job, 'fetch_source_project', return_value=(None, None, 'origin')), \
+                patch.object(train_job, 'create_batch_mr') as create_batch_mr, \
+                patch.object(train_job, 'wait_for_ci_to_pass'), \
+                patch.object(train_job, 'ensure_mr_not_changed'), \
+                patch.object(train_job, 'ensure_mergeable_mr'):
+            with pytest.raises(CannotBatch):
+                train_job.execute()
+        # both cars' MRs get closed
+        assert create_batch_mr.return_value.close.call_count == 2
+        # and their branches removed
+        train_job._repo.remove_remote_branches.assert_called_once_with(
+            'marge_bot_batch_merge_job_master_0', 'marge_bot_batch_merge_job_master_1',
+        )
@@ -1,5 +1,6 @@
-from unittest.mock import ANY, Mock
+from unittest.mock import ANY, call, Mock, patch
 
+from marge.cache import LRUCache
 from marge.gitlab import Api, GET
 from marge.user import User
 
@@ -31,6 +32,30 @@ class TestProjectWithUser:
         api.call.assert_called_once_with(GET('/users/1234'))
         assert user.info == INFO
 
+    def test_fetch_all_by_id(self):
+        api = self.api
+        api.call = Mock(side_effect=lambda command: dict(INFO, id=int(command.endpoint.rsplit('/', 1)[-1])))
+
+        users = User.fetch_all_by_id([3, 1, 3, 2], api)
+
+        assert [user.id for user in users] == [3, 1, 3, 2]
+        assert sorted(api.call.call_args_list) == [
+            call(GET('/users/1')), call(GET('/users/2')), call(GET('/users/3')),
+        ]
+
+    def test_fetch_all_by_id_cached(self):
+        api = self.api
+        api.call = Mock(side_effect=lambda command: dict(INFO, id=int(command.endpoint.rsplit('/', 1)[-1])))
+
+        with patch.object(User, 'cache', LRUCache(maxsize=10)):
+            first_users = User.fetch_all_by_id([1, 2], api)
+            assert User.fetch_all_by_id([2, 1], api) == first_users[::-1]
+            assert api.call.call_count == 2
+
+            User.fetch_all_by_id([2, 3], api)
+            api.call.assert_called_with(GET('/users/3'))
+            assert api.call.call_count == 3
+
     def test_fetch_by_username_exists(self):
         api = self.api
         api.call = Mock(return_value=INFO)
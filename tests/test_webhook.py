@@ -0,0 +1,112 @@
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+from marge.webhook import EventHub, project_ids_of
+
+
+def test_project_ids_of_merge_request_hook():
+    payload = {
+        'object_kind': 'merge_request',
+        'project': {'id': 1},
+        'object_attributes': {'iid': 3, 'target_project_id': 1, 'source_project_id': 2},
+    }
+    assert project_ids_of(payload) == {1, 2}
+
+
+def test_project_ids_of_pipeline_hook():
+    payload = {
+        'object_kind': 'pipeline',
+        'project': {'id': 2},
+        'object_attributes': {'status': 'success', 'sha': 'abc'},
+        'merge_request': {'iid': 3, 'target_project_id': 1, 'source_project_id': 2},
+    }
+    assert project_ids_of(payload) == {1, 2}
+    assert project_ids_of(dict(payload, merge_request=None)) == {2}
+
+    running = dict(payload, object_attributes={'status': 'running', 'sha': 'abc'})
+    assert project_ids_of(running) == set()
+
+
+def test_project_ids_of_push_hook():
+    assert project_ids_of({'object_kind': 'push', 'project_id': 4, 'ref': 'refs/heads/master'}) == {4}
+
+
+def test_project_ids_of_other_hooks():
+    assert project_ids_of({'object_kind': 'issue', 'project': {'id': 1}}) == set()
+
+
+class TestEventHub:
+    def setup_method(self, _method):
+        self.hub = EventHub()
+
+    def test_wait_for_events_since_cursor(self):
+        cursor = self.hub.cursor()
+        self.hub.publish({1})
+
+        assert self.hub.wait_for({1, 2}, cursor, timeout=0)
+        assert not self.hub.wait_for({3}, cursor, timeout=0)
+        assert not self.hub.wait_for({1}, self.hub.cursor(), timeout=0)
+
+    def test_wait_for_wakes_up(self):
+        cursor = self.hub.cursor()
+        threading.Timer(0.05, self.hub.publish, [{1}]).start()
+        started_at = time.monotonic()
+        assert self.hub.wait_for({1}, cursor, timeout=10)
+        assert time.monotonic() - started_at < 5
+
+    def test_take_pending(self):
+        assert self.hub.take_pending(timeout=0) == set()
+
+        self.hub.publish({1, 2})
+        self.hub.publish({2})
+        assert self.hub.take_pending(timeout=0) == {1, 2}
+        assert self.hub.take_pending(timeout=0) == set()
+
+
+class TestWebhookServer:
+    def setup_method(self, _method):
+        self.hub = EventHub()
+        self.server = self.hub.serve(0, secret='s3cr3t', host='127.0.0.1')
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_address[1]
+
+    def teardown_method(self, _method):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, payload, token='s3cr3t', event='Pipeline Hook'):
+        headers = {'X-Gitlab-Token': token, 'X-Gitlab-Event': event}
+        return requests.post(self.url, json=payload, headers=headers)
+
+    def test_publishes_hooks(self):
+        response = self.post({'object_kind': 'push', 'project_id': 4})
+        assert response.status_code == 200
+        assert self.hub.take_pending(timeout=0) == {4}
+
+    def test_accepts_uninteresting_hooks(self):
+        response = self.post({'object_kind': 'issue', 'project': {'id': 1}}, event='Issue Hook')
+        assert response.status_code == 200
+        assert self.hub.take_pending(timeout=0) == set()
+
+    def test_rejects_wrong_secret(self):
+        response = self.post({'object_kind': 'push', 'project_id': 4}, token='guess')
+        assert response.status_code == 401
+        assert self.hub.take_pending(timeout=0) == set()
+
+    def test_rejects_garbage(self):
+        response = requests.post(self.url, data=b'{nope', headers={'X-Gitlab-Token': 's3cr3t'})
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize('content_length', ['lots', '-1'])
+    def test_rejects_bad_content_length(self, content_length):
+        with socket.create_connection(self.server.server_address, timeout=5) as connection:
+            connection.sendall(
+                'POST / HTTP/1.1\r\nX-Gitlab-Token: s3cr3t\r\nContent-Length: {}\r\n\r\n{{}}'.format(
+                    content_length,
+                ).encode()
+            )
+            status_line = connection.makefile('rb').readline()
+        assert status_line.split()[1] == b'400'